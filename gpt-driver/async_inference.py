@@ -0,0 +1,343 @@
+import openai
+import asyncio
+import json
+import time
+import argparse
+from prompt_message import SYSTEM_MESSAGES, generate_user_messages, generate_user_message_parts, generate_assistant_messages
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from trajectory_parser import REASONS
+from self_consistency import SelfConsistency, METHODS
+from compact_encoding import ENCODINGS
+from spatial_index import SpatialIndex, load_spatial_index
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter, TokenUsage
+from retrieval import load_or_build_index, sequential_examples
+from incontext_cache import IncontextExamples
+from prompt_packer import PromptPacker
+from completion_backend import OpenAIBackend, get_backend
+from metrics import Metrics, count_retry
+from finetune import resolve_model_id
+from tenacity import (
+    retry,
+    stop_after_attempt,
+    wait_random_exponential,
+    RetryError,
+)  # for exponential backoff
+
+class RateLimiter:
+    """
+    Token bucket limiter over requests-per-minute and tokens-per-minute.
+    Both buckets refill continuously and hold at most one minute of budget, a limit <= 0 disables that bucket.
+    The budgets outlive an event loop, e.g. the asyncio.run of every planning step of closed_loop.py,
+    the lock is created in the loop that uses it.
+    """
+    def __init__(self, rpm=3500, tpm=90000):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_budget = float(rpm)
+        self.token_budget = float(tpm)
+        self.last_refill = time.monotonic()
+        self.loop = None
+        self.lock = None
+
+    def _lock(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop: # an asyncio.Lock is bound to the first loop it waits in
+            self.loop = loop
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm > 0:
+            self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60.0)
+        if self.tpm > 0:
+            self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60.0)
+
+    async def acquire(self, num_tokens=0):
+        if self.tpm > 0:
+            num_tokens = min(num_tokens, self.tpm) # an oversize request still has to go through eventually
+        async with self._lock(): # waiters are served in arrival order
+            while True:
+                self._refill()
+                request_ok = self.rpm <= 0 or self.request_budget >= 1
+                token_ok = self.tpm <= 0 or self.token_budget >= num_tokens
+                if request_ok and token_ok:
+                    if self.rpm > 0:
+                        self.request_budget -= 1
+                    if self.tpm > 0:
+                        self.token_budget -= num_tokens
+                    return
+                wait_time = 0.0
+                if not request_ok:
+                    wait_time = max(wait_time, (1 - self.request_budget) * 60.0 / self.rpm)
+                if not token_ok:
+                    wait_time = max(wait_time, (num_tokens - self.token_budget) * 60.0 / self.tpm)
+                await asyncio.sleep(max(wait_time, 1e-3))
+
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=count_retry)
+async def acompletion_with_backoff(backend, limiter, num_tokens, metrics, **kwargs):
+    # every attempt, including retries, is charged against the rate budget
+    with metrics.timer("rate_limit_wait"):
+        await limiter.acquire(num_tokens)
+    metrics.inc("api_calls")
+    with metrics.timer("api"):
+        return await backend.acomplete(**kwargs)
+
+def build_requests(data, test_tokens, train_tokens, counter, incontext=False, num_incontext_prompts=5, completion_tokens=256, completed_tokens=None, example_tokens=None, packer=None, metrics=None, encoding="text", max_objects=None, index=None):
+    """
+    Render the prompts of test.py (incontext=False) or incontext_learning.py (incontext=True) for every token not in completed_tokens.
+    In-context examples come from example_tokens ({token: [train tokens]}) if given, otherwise from sequential_examples,
+    and are packed with the nearest objects under the budget of `packer` (4096 tokens by default).
+    num_tokens is the estimated prompt + completion cost used by the rate limiter.
+    encoding="compact" renders the prompts of test.py in the format of compact_encoding.py.
+    max_objects lists only the nearest objects of every prompt, ordered by `index`, a spatial_index.SpatialIndex built for the tokens if not given.
+    """
+    if incontext and encoding != "text":
+        raise ValueError("The in-context prompts are only rendered in the text encoding")
+    if metrics is None:
+        metrics = Metrics()
+    pending = [(token_index, token) for token_index, token in enumerate(test_tokens) if completed_tokens is None or token not in completed_tokens]
+    pending_tokens = [token for _, token in pending]
+    with metrics.timer("prompt"):
+        if index is None and max_objects is not None:
+            index = SpatialIndex(data, pending_tokens)
+        assitant_messages = generate_assistant_messages(data, pending_tokens, encoding=encoding, index=index, max_objects=max_objects)
+        if incontext:
+            user_message_parts = generate_user_message_parts(data, pending_tokens, index=index, max_objects=max_objects)
+        else:
+            user_messages = generate_user_messages(data, pending_tokens, encoding=encoding, index=index, max_objects=max_objects)
+    with metrics.timer("count"):
+        if incontext:
+            if packer is None:
+                packer = PromptPacker(counter)
+            user_counts = packer.count_user_parts(user_message_parts)
+            examples = IncontextExamples(data, counter)
+        else:
+            num_user_tokens_list = counter.count_batch(user_messages)
+    requests = []
+    with metrics.timer("pack"): # the packing of the in-context prompts, or only the system message counts
+        for i, ((token_index, token), assitant_message) in enumerate(zip(pending, assitant_messages)):
+            if incontext:
+                if example_tokens is not None:
+                    train_example_tokens = example_tokens[token]
+                else:
+                    train_example_tokens = sequential_examples(token_index, train_tokens, num_incontext_prompts)
+                incontext_messages, incontext_counts = examples.get(train_example_tokens)
+                system_incontext_message, user_message, num_system_tokens, num_user_tokens = packer.pack(
+                    user_message_parts[i], user_counts[i], incontext_messages, incontext_counts)
+            else:
+                user_message, num_user_tokens = user_messages[i], num_user_tokens_list[i]
+                system_incontext_message = SYSTEM_MESSAGES[encoding]
+                num_system_tokens = counter.count(system_incontext_message)
+            requests.append({
+                "token": token,
+                "messages": [
+                    {"role": "system", "content": system_incontext_message},
+                    {"role": "user", "content": user_message},
+                ],
+                "num_tokens": num_system_tokens + num_user_tokens + completion_tokens,
+                "num_system_tokens": num_system_tokens,
+                "num_user_tokens": num_user_tokens,
+                "GT": assitant_message,
+            })
+    return requests
+
+async def run_inference(requests, model_id, limiter, concurrency=8, temp_text_name=None, checkpoint=None, usage=None, cache=None, backend=None, sampler=None, metrics=None):
+    """
+    Query all requests with at most `concurrency` calls in flight to `backend` (the OpenAI API by default), recording every outcome
+    in `checkpoint` and the prompt / completion token counts in `usage` if given. Requests found in `cache` are not sent,
+    except for the tokens `checkpoint` records as invalid, whose cached answer is the invalid one.
+    `sampler` sets the samples per request, the samples are parsed, aggregated and recorded in batches of `concurrency` answered tokens.
+    Stage timings and counters go to `metrics` if given.
+    Returns (text_dict, traj_dict, invalid_tokens, failed_tokens) with dicts ordered like `requests`.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if backend is None:
+        backend = OpenAIBackend()
+    if sampler is None:
+        sampler = SelfConsistency()
+    semaphore = asyncio.Semaphore(concurrency)
+    text_dict, traj_dict, invalid_tokens, failed_tokens = {}, {}, [], []
+    retried_tokens = checkpoint.invalid_tokens() if checkpoint is not None else set()
+
+    answered = []
+
+    def record():
+        """
+        Parse, aggregate and record the buffered answers in one batch across their tokens and samples.
+        Called every `concurrency` answers, so an interrupted run loses fewer than `concurrency` of them, which are in `cache` too.
+        """
+        batch = answered[:]
+        answered.clear()
+        if len(batch) == 0:
+            return
+        with metrics.timer("parse"):
+            texts, trajs, reasons = sampler.select([request["token"] for request, _ in batch], [result for _, result in batch])
+        for (request, _), text, traj, reason in zip(batch, texts, trajs, reasons):
+            token = request["token"]
+            print(f"{token}\nGPT  Planner:\n {text}\nGround Truth:\n {request['GT']}")
+            text_dict[token] = text
+            if traj is None:
+                print(f"Invalid token: {token} ({REASONS[reason]})")
+                invalid_tokens.append(token)
+                metrics.inc("invalid")
+                if checkpoint is not None:
+                    checkpoint.record(token, "invalid", text=text)
+                continue
+            traj_dict[token] = traj
+            if checkpoint is not None:
+                checkpoint.record(token, "done", text=text, traj=traj)
+
+            if temp_text_name is not None:
+                output_dict = {
+                    "token": token,
+                    "GPT": text,
+                    "GT": request["GT"],
+                }
+                with open(temp_text_name, "a+") as file:
+                    file.write(json.dumps(output_dict) + '\n')
+
+    async def infer(request):
+        token = request["token"]
+        result = None
+        if cache is not None and token not in retried_tokens:
+            with metrics.timer("cache"):
+                result = cache.get(model_id, request["messages"], **backend.cache_params, **sampler.params)
+        if result is not None:
+            metrics.inc("cache_hits")
+        else:
+            async with semaphore:
+                try:
+                    completion = await acompletion_with_backoff(
+                        backend,
+                        limiter,
+                        request["num_tokens"],
+                        metrics=metrics,
+                        model=model_id,
+                        messages=request["messages"],
+                        **sampler.params,
+                    )
+                except RetryError:
+                    print(f"Failed token: {token}")
+                    failed_tokens.append(token)
+                    metrics.inc("failed")
+                    if checkpoint is not None:
+                        checkpoint.record(token, "failed")
+                    return
+            result = sampler.encode(completion)
+            metrics.inc("prompt_tokens", completion.prompt_tokens)
+            metrics.inc("completion_tokens", completion.completion_tokens)
+            if cache is not None:
+                cache.put(model_id, request["messages"], result, **backend.cache_params, **sampler.params)
+            if usage is not None: # cached responses are not billed
+                usage.add(
+                    system=request["num_system_tokens"],
+                    user=request["num_user_tokens"],
+                    assistant=completion.completion_tokens,
+                )
+        answered.append((request, result))
+        if len(answered) >= concurrency:
+            record()
+
+    try:
+        async with backend.session():
+            await asyncio.gather(*[infer(request) for request in requests])
+    finally:
+        record()
+
+    order = {request["token"]: i for i, request in enumerate(requests)}
+    text_dict = {token: text_dict[token] for token in sorted(text_dict, key=order.get)}
+    traj_dict = {token: traj_dict[token] for token in sorted(traj_dict, key=order.get)}
+    invalid_tokens.sort(key=order.get)
+    failed_tokens.sort(key=order.get)
+    return text_dict, traj_dict, invalid_tokens, failed_tokens
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT-Driver concurrent test.")
+    parser.add_argument("-i", "--id", type=str, default="gpt-3.5-turbo", help="GPT model id, latest for the last model of finetune.py")
+    parser.add_argument("-o", "--output", type=str, help="output file name")
+    parser.add_argument("--incontext", action="store_true", help="use the in-context learning prompts of incontext_learning.py")
+    parser.add_argument("--selection", type=str, default="retrieval", choices=["retrieval", "sequential"], help="nearest train scenes or the train tokens token_index * 5 + i as in-context examples")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of requests in flight")
+    parser.add_argument("--rpm", type=int, default=3500, help="requests-per-minute limit, <= 0 disables it")
+    parser.add_argument("--tpm", type=int, default=90000, help="tokens-per-minute limit, <= 0 disables it")
+    parser.add_argument("--budget", type=int, default=4096, help="prompt token budget of the in-context prompts, 16384 for the 16k models")
+    parser.add_argument("--max_cost", type=float, default=None, help="cap on the estimated USD cost of every in-context request")
+    parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache shared by the runs")
+    parser.add_argument("--cache_size", type=float, default=1024, help="maximum size of the cached responses in MB")
+    parser.add_argument("--refresh_cache", action="store_true", help="query the API even for cached prompts, as for the tokens the checkpoint records as invalid")
+    parser.add_argument("--backend", type=str, default="openai", choices=["openai", "mock"], help="OpenAI API, or ground truth answers in-process")
+    parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+    parser.add_argument("-n", "--num_samples", type=int, default=1, help="completions sampled per prompt and aggregated into one plan")
+    parser.add_argument("--aggregation", type=str, default="median", choices=METHODS, help="aggregation of the sampled trajectories")
+    parser.add_argument("--temperature", type=float, default=None, help="sampling temperature, the API default if not given")
+    parser.add_argument("--metrics", type=str, default=None, help="export stage timings and counters to this .jsonl or Prometheus .prom file")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="seconds between metrics exports")
+    parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding the model was fine-tuned on, text only with --incontext")
+    parser.add_argument("--max_objects", type=int, default=None, help="list at most this many objects per prompt, nearest first, as the fine-tuning data")
+    parser.add_argument("--mock_noise", type=float, default=0.0, help="noise in meters on the waypoints of the mock backend")
+    args = parser.parse_args()
+    args.id = resolve_model_id(args.id)
+    if args.incontext and args.encoding != "text":
+        parser.error("--incontext prompts are only rendered in the text encoding")
+
+    saved_traj_name = "outputs/" + args.output + ".pkl"
+    saved_text_name = "outputs/" + args.output + "_text.pkl"
+    temp_text_name = "outputs/" + args.output + "_temp.jsonl"
+    checkpoint_name = "outputs/" + args.output + ".db"
+
+    openai.api_key = "" # insert your API key here
+
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+
+    train_tokens = split["train"]
+    test_tokens = split["val"]
+
+    # tokens with a valid result in the checkpoint are skipped, invalid and failed ones are retried
+    checkpoint = InferenceCheckpoint(checkpoint_name)
+
+    completed_tokens = checkpoint.completed_tokens()
+    example_tokens = None
+    if args.incontext and args.selection == "retrieval":
+        example_tokens = load_or_build_index(data, train_tokens).query_tokens(data, checkpoint.pending(test_tokens), k=5)
+
+    # disabled without --metrics
+    metrics = Metrics(args.metrics, interval=args.metrics_interval)
+    counter = TokenCounter("gpt-3.5-turbo")
+    packer = PromptPacker(counter, budget=args.budget, max_cost=args.max_cost, model=args.id, completion_tokens=256)
+    requests = build_requests(data, test_tokens, train_tokens, counter, incontext=args.incontext, completed_tokens=completed_tokens, example_tokens=example_tokens, packer=packer, metrics=metrics, encoding=args.encoding, max_objects=args.max_objects,
+        index=load_spatial_index(data) if args.max_objects is not None else None)
+    if args.incontext:
+        packer.summary()
+    limiter = RateLimiter(rpm=args.rpm, tpm=args.tpm)
+    usage = TokenUsage()
+    cache = ResponseCache(args.cache, max_size_mb=args.cache_size, refresh=args.refresh_cache)
+    backend = get_backend(args.backend, api_base=args.api_base, data=data, tokens=test_tokens, counter=counter, noise=args.mock_noise, encoding=args.encoding)
+    sampler = SelfConsistency(args.num_samples, args.aggregation, data=data, temperature=args.temperature, encoding=args.encoding)
+
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(
+        run_inference(requests, args.id, limiter, concurrency=args.concurrency, temp_text_name=temp_text_name, checkpoint=checkpoint, usage=usage, cache=cache, backend=backend, sampler=sampler, metrics=metrics)
+    )
+
+    print("#### Invalid Tokens ####")
+    for token in invalid_tokens:
+        print(token)
+    print("#### Failed Tokens ####")
+    for token in failed_tokens:
+        print(token)
+
+    usage.summary(args.id)
+    cache.summary()
+    cache.close()
+
+    with metrics.timer("merge"):
+        checkpoint.merge(saved_traj_name, saved_text_name, tokens=test_tokens)
+    checkpoint.close()
+    metrics.summary()
+    metrics.close()
@@ -0,0 +1,243 @@
+import os
+import io
+import json
+import time
+import argparse
+import openai
+import requests as http
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from trajectory_parser import REASONS
+from compact_encoding import ENCODINGS, decode_trajectory
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter, TokenUsage
+from retrieval import load_or_build_index
+from prompt_packer import PromptPacker
+from async_inference import build_requests
+from finetune import resolve_model_id
+
+"""
+Val inference through the Batch API: all prompts are rendered up front into one request file with custom_id = token,
+the file is submitted as a batch, and its output file is streamed back into the checkpoint of test.py.
+The batch ids, the model, the encoding and the submitted requests are kept in outputs/<output>_batch.json,
+so the client can exit after submitting and collect later, from exactly what was submitted.
+"""
+
+class BatchClient:
+    """Files and batches endpoints, against api_base, e.g. http://localhost:8765/v1 for mock_server.py."""
+    def __init__(self, api_base=None, api_key=None):
+        self.api_base = (api_base or openai.api_base).rstrip("/")
+        self.session = http.Session()
+        self.session.headers["Authorization"] = "Bearer " + (api_key or openai.api_key or "")
+        self.cache_params = {} if api_base is None else {"api_base": api_base} # as OpenAIBackend
+
+    def _check(self, response):
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.request.method} {response.url}: {response.status_code} {response.text}")
+        return response
+
+    def upload(self, content, filename="batch_input.jsonl"):
+        files = {"file": (filename, io.BytesIO(content), "application/jsonl")}
+        return self._check(self.session.post(self.api_base + "/files", data={"purpose": "batch"}, files=files)).json()["id"]
+
+    def create_batch(self, input_file_id, endpoint="/v1/chat/completions", completion_window="24h"):
+        body = {"input_file_id": input_file_id, "endpoint": endpoint, "completion_window": completion_window}
+        return self._check(self.session.post(self.api_base + "/batches", json=body)).json()
+
+    def get_batch(self, batch_id):
+        return self._check(self.session.get(self.api_base + "/batches/" + batch_id)).json()
+
+    def iter_file(self, file_id):
+        """The lines of a file, streamed without holding the whole file in memory."""
+        with self._check(self.session.get(self.api_base + "/files/" + file_id + "/content", stream=True)) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+def render_batches(requests, model_id, max_requests=50000, max_bytes=100 * 1024 * 1024):
+    """Batch input files of at most max_requests lines and max_bytes, the limits of the Batch API."""
+    batches, lines, size = [], [], 0
+    for request in requests:
+        line = json.dumps({
+            "custom_id": request["token"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model_id, "messages": request["messages"]},
+        }).encode("utf-8") + b"\n"
+        if len(lines) > 0 and (len(lines) >= max_requests or size + len(line) > max_bytes):
+            batches.append(b"".join(lines))
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line)
+    if len(lines) > 0:
+        batches.append(b"".join(lines))
+    return batches
+
+def submit(client, requests, model_id):
+    """Upload and create the batches, returns {batch id: submitted tokens} in submission order."""
+    batches = {}
+    for content in render_batches(requests, model_id):
+        batch = client.create_batch(client.upload(content))
+        batches[batch["id"]] = [json.loads(line)["custom_id"] for line in content.splitlines()]
+    return batches
+
+def wait(client, batch_ids, poll_interval=10.0, max_poll_interval=300.0):
+    """Poll until every batch reaches a final status, with the interval growing by half every poll up to max_poll_interval."""
+    batches = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id not in batches or batches[batch_id]["status"] not in ("completed", "failed", "expired", "cancelled"):
+                batches[batch_id] = client.get_batch(batch_id)
+        statuses = [batches[batch_id]["status"] for batch_id in batch_ids]
+        print("Batch status: " + ", ".join(f"{batch_id} {status}" for batch_id, status in zip(batch_ids, statuses)))
+        if all(status in ("completed", "failed", "expired", "cancelled") for status in statuses):
+            return [batches[batch_id] for batch_id in batch_ids]
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 1.5, max_poll_interval)
+
+def collect(client, batch, requests, model_id, checkpoint, temp_text_name=None, cache=None, usage=None, encoding="text", tokens=None):
+    """
+    Stream the output and error files of a finished batch into the checkpoint, returns (invalid_tokens, failed_tokens).
+    `tokens` are the tokens submitted in the batch, those in neither file, e.g. of a failed, expired or cancelled batch, are recorded as failed.
+    """
+    requests = {request["token"]: request for request in requests}
+    invalid_tokens, failed_tokens = [], []
+    seen_tokens = set()
+    if batch.get("output_file_id") is not None:
+        for output in client.iter_file(batch["output_file_id"]):
+            token = output["custom_id"]
+            seen_tokens.add(token)
+            response = output.get("response")
+            if response is None or response["status_code"] != 200:
+                failed_tokens.append(token)
+                checkpoint.record(token, "failed")
+                continue
+            body = response["body"]
+            result = body["choices"][0]["message"]["content"]
+            if usage is not None and token in requests:
+                usage.add(
+                    system=requests[token]["num_system_tokens"],
+                    user=requests[token]["num_user_tokens"],
+                    assistant=body["usage"]["completion_tokens"],
+                )
+            if cache is not None and token in requests:
+                cache.put(model_id, requests[token]["messages"], result, **client.cache_params)
+
+            traj, reason = decode_trajectory(result, encoding)
+            if traj is None:
+                print(f"Invalid token: {token} ({REASONS[reason]})")
+                invalid_tokens.append(token)
+                checkpoint.record(token, "invalid", text=result)
+                continue
+            checkpoint.record(token, "done", text=result, traj=traj)
+            if temp_text_name is not None:
+                output_dict = {
+                    "token": token,
+                    "GPT": result,
+                    "GT": requests[token]["GT"] if token in requests else None,
+                }
+                with open(temp_text_name, "a+") as file:
+                    file.write(json.dumps(output_dict) + '\n')
+    if batch.get("error_file_id") is not None:
+        for error in client.iter_file(batch["error_file_id"]):
+            seen_tokens.add(error["custom_id"])
+            failed_tokens.append(error["custom_id"])
+            checkpoint.record(error["custom_id"], "failed")
+    if tokens is not None:
+        for token in tokens:
+            if token not in seen_tokens:
+                failed_tokens.append(token)
+                checkpoint.record(token, "failed")
+    return invalid_tokens, failed_tokens
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT-Driver test through the Batch API.")
+    parser.add_argument("-i", "--id", type=str, default="gpt-3.5-turbo", help="GPT model id, latest for the last model of finetune.py")
+    parser.add_argument("-o", "--output", type=str, help="output file name")
+    parser.add_argument("--incontext", action="store_true", help="use the in-context learning prompts of incontext_learning.py")
+    parser.add_argument("--budget", type=int, default=4096, help="prompt token budget of the in-context prompts")
+    parser.add_argument("--detach", action="store_true", help="exit after submitting or checking the batches, re-run the same command to collect")
+    parser.add_argument("--poll_interval", type=float, default=10.0, help="first polling interval in seconds")
+    parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache to store the results in")
+    parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding the model was fine-tuned on, text only with --incontext")
+    parser.add_argument("--max_objects", type=int, default=None, help="list at most this many objects per prompt, nearest first, as the fine-tuning data")
+    parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+    args = parser.parse_args()
+    args.id = resolve_model_id(args.id)
+    if args.incontext and args.encoding != "text":
+        parser.error("--incontext prompts are only rendered in the text encoding")
+
+    saved_traj_name = "outputs/" + args.output + ".pkl"
+    saved_text_name = "outputs/" + args.output + "_text.pkl"
+    temp_text_name = "outputs/" + args.output + "_temp.jsonl"
+    checkpoint_name = "outputs/" + args.output + ".db"
+    batch_state_name = "outputs/" + args.output + "_batch.json"
+
+    openai.api_key = "" # insert your API key here
+
+    split = json.load(open('data/split.json', 'r'))
+
+    train_tokens = split["train"]
+    test_tokens = split["val"]
+
+    # tokens with a valid result in the checkpoint are skipped, invalid and failed ones are submitted again
+    checkpoint = InferenceCheckpoint(checkpoint_name)
+    client = BatchClient(api_base=args.api_base)
+
+    if os.path.exists(batch_state_name):
+        # collect with the submitted prompts and encoding, the checkpoint and the prompt arguments may have changed since
+        state = json.load(open(batch_state_name, "r"))
+        if state["model"] != args.id:
+            parser.error(f"{batch_state_name} holds batches of {state['model']}, not {args.id}")
+        if state["encoding"] != args.encoding:
+            print(f"Collecting in the submitted encoding {state['encoding']}")
+        requests = [dict(token=token, **request) for token, request in state["requests"].items()]
+    else:
+        data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+        pending_tokens = checkpoint.pending(test_tokens)
+        example_tokens = None
+        if args.incontext:
+            example_tokens = load_or_build_index(data, train_tokens).query_tokens(data, pending_tokens, k=5)
+        counter = TokenCounter("gpt-3.5-turbo")
+        requests = build_requests(data, test_tokens, train_tokens, counter, incontext=args.incontext, completed_tokens=checkpoint.completed_tokens(),
+            example_tokens=example_tokens, packer=PromptPacker(counter, budget=args.budget), encoding=args.encoding, max_objects=args.max_objects)
+        state = {
+            "model": args.id,
+            "encoding": args.encoding,
+            "batches": submit(client, requests, args.id),
+            "requests": {request["token"]: {key: request[key] for key in ("messages", "num_system_tokens", "num_user_tokens", "GT")} for request in requests},
+        }
+        with open(batch_state_name + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(batch_state_name + ".tmp", batch_state_name)
+        print(f"Submitted {len(requests)} requests in {len(state['batches'])} batches")
+    batch_ids = list(state["batches"])
+
+    if args.detach:
+        for batch_id in batch_ids:
+            batch = client.get_batch(batch_id)
+            print(f"{batch_id}: {batch['status']} {batch.get('request_counts')}")
+    else:
+        cache = ResponseCache(args.cache)
+        usage = TokenUsage()
+        invalid_tokens, failed_tokens = [], []
+        for batch in wait(client, batch_ids, poll_interval=args.poll_interval):
+            batch_invalid_tokens, batch_failed_tokens = collect(client, batch, requests, args.id, checkpoint, temp_text_name=temp_text_name,
+                cache=cache, usage=usage, encoding=state["encoding"], tokens=state["batches"][batch["id"]])
+            print(f"{batch['id']}: {batch['status']} {batch.get('request_counts')}, {len(batch_failed_tokens)} failed tokens")
+            invalid_tokens.extend(batch_invalid_tokens)
+            failed_tokens.extend(batch_failed_tokens)
+        os.remove(batch_state_name)
+
+        print("#### Invalid Tokens ####")
+        for token in invalid_tokens:
+            print(token)
+        print("#### Failed Tokens ####")
+        for token in failed_tokens:
+            print(token)
+        usage.summary(args.id)
+        print("The Batch API bills half of the estimated cost")
+        cache.close()
+
+        checkpoint.merge(saved_traj_name, saved_text_name, tokens=test_tokens)
+    checkpoint.close()
@@ -0,0 +1,93 @@
+import io
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+import numpy as np
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter, TokenUsage
+from async_inference import RateLimiter, build_requests, run_inference
+from completion_backend import OpenAIBackend, MockBackend
+from mock_server import MockResponder, MockServer, start_server
+
+class TimedBackend:
+    """Records the latency of every attempt of the wrapped backend, failed ones included."""
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache_params = backend.cache_params
+        self.latencies = []
+        self.num_errors = 0
+
+    async def acomplete(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.backend.acomplete(**kwargs)
+        except Exception:
+            self.num_errors += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def session(self):
+        return self.backend.session()
+
+async def benchmark(requests, backend, concurrency, rpm, tpm):
+    timed_backend = TimedBackend(backend)
+    usage = TokenUsage()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # per-token logs of run_inference
+        text_dict, traj_dict, invalid_tokens, failed_tokens = await run_inference(
+            requests, "gpt-3.5-turbo", RateLimiter(rpm=rpm, tpm=tpm), concurrency=concurrency, usage=usage, backend=timed_backend)
+    elapsed = time.perf_counter() - start
+    latencies = np.array(timed_backend.latencies) if timed_backend.latencies else np.zeros(1)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+    print(
+        f"concurrency {concurrency}: {elapsed:.2f}s, {len(requests) / elapsed:.1f} req/s, {usage.num_total_tokens / elapsed:.0f} tokens/s, "
+        f"latency p50 {p50 * 1000:.0f} ms, p90 {p90 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms, max {latencies.max() * 1000:.0f} ms, "
+        f"errors {timed_backend.num_errors}, invalid {len(invalid_tokens)}, failed {len(failed_tokens)}"
+    )
+
+async def main(args):
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    tokens = split[args.split][:args.num_samples]
+    counter = TokenCounter("gpt-3.5-turbo")
+    requests = build_requests(data, tokens, split["train"], counter, incontext=args.incontext)
+    responder = MockResponder(data, tokens)
+
+    runner = None
+    if args.transport == "http":
+        server = MockServer(responder, counter, latency=args.latency, latency_sigma=args.latency_sigma, token_latency=args.token_latency,
+            error_rate=args.error_rate, rpm=args.server_rpm, tpm=args.server_tpm)
+        runner = await start_server(server, port=args.port)
+        backend = OpenAIBackend(api_base=f"http://localhost:{args.port}/v1", api_key="mock")
+    else:
+        backend = MockBackend(responder, counter=counter, latency=args.latency)
+
+    print(f"#### {len(requests)} {args.split} requests over {args.transport} ####")
+    for concurrency in args.concurrency:
+        await benchmark(requests, backend, concurrency, args.rpm, args.tpm)
+    if runner is not None:
+        server.summary()
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark of the inference pipeline against the mock server.")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split to benchmark on")
+    parser.add_argument("-n", "--num_samples", type=int, default=None, help="number of samples, defaults to the whole split")
+    parser.add_argument("--incontext", action="store_true", help="in-context learning prompts")
+    parser.add_argument("--transport", type=str, default="http", choices=["http", "inprocess"], help="mock_server.py over HTTP, or the responder in-process")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128], help="numbers of requests in flight to benchmark")
+    parser.add_argument("--rpm", type=int, default=0, help="client requests-per-minute limit, <= 0 disables it")
+    parser.add_argument("--tpm", type=int, default=0, help="client tokens-per-minute limit, <= 0 disables it")
+    parser.add_argument("--latency", type=float, default=0.5, help="median server latency in seconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="log-normal sigma of the server latency")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="additional server seconds per completion token")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="ratio of 500 / 503 server responses")
+    parser.add_argument("--server_rpm", type=int, default=0, help="server requests-per-minute limit, answered with 429")
+    parser.add_argument("--server_tpm", type=int, default=0, help="server tokens-per-minute limit, answered with 429")
+    parser.add_argument("--port", type=int, default=8765, help="port of the mock server")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,36 @@
+import json
+import time
+import argparse
+from prompt_message import generate_user_message, generate_user_messages, generate_assistant_message, generate_assistant_messages
+from nuscenes_cache import load_nuscenes_info
+
+parser = argparse.ArgumentParser(description="Benchmark prompt generation on a split.")
+parser.add_argument("-s", "--split", type=str, default="train", help="split to benchmark on")
+args = parser.parse_args()
+
+data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+split = json.load(open('data/split.json', 'r'))
+
+tokens = split[args.split]
+
+def benchmark(name, serial_fn, batch_fn):
+    start = time.perf_counter()
+    serial_outputs = serial_fn()
+    serial_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batch_outputs = batch_fn()
+    batch_time = time.perf_counter() - start
+    assert serial_outputs == batch_outputs, f"{name}: batched outputs differ from the serial ones"
+    print(f"{name}: serial {serial_time:.2f}s, batched {batch_time:.2f}s, speedup {serial_time / batch_time:.1f}x")
+
+print(f"#### {len(tokens)} {args.split} samples ####")
+benchmark(
+    "generate_user_message",
+    lambda: [generate_user_message(data, token) for token in tokens],
+    lambda: generate_user_messages(data, tokens),
+)
+benchmark(
+    "generate_assistant_message",
+    lambda: [generate_assistant_message(data, token) for token in tokens],
+    lambda: generate_assistant_messages(data, tokens),
+)
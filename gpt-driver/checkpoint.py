@@ -0,0 +1,68 @@
+import sqlite3
+import pickle
+import time
+
+class InferenceCheckpoint:
+    """
+    Crash-safe, token-indexed store of inference results backed by SQLite.
+    Each result is one committed row, so recording costs O(1) regardless of how many tokens are done.
+    Status is one of "done" (valid trajectory), "invalid" (unparsable output) or "failed" (API error).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "token TEXT PRIMARY KEY, status TEXT NOT NULL, text TEXT, traj BLOB, updated REAL)"
+        )
+        self.conn.commit()
+
+    def record(self, token, status, text=None, traj=None):
+        # a later attempt of the same token supersedes the earlier one
+        blob = pickle.dumps(traj) if traj is not None else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (token, status, text, traj, updated) VALUES (?, ?, ?, ?, ?)",
+            (token, status, text, blob, time.time()),
+        )
+        self.conn.commit()
+
+    def status(self):
+        return dict(self.conn.execute("SELECT token, status FROM results"))
+
+    def completed_tokens(self):
+        return set(row[0] for row in self.conn.execute("SELECT token FROM results WHERE status = 'done'"))
+
+    def invalid_tokens(self):
+        return set(row[0] for row in self.conn.execute("SELECT token FROM results WHERE status = 'invalid'"))
+
+    def pending(self, tokens):
+        """Tokens without a valid result yet, i.e. never tried, invalid or failed, in their original order."""
+        completed = self.completed_tokens()
+        return [token for token in tokens if token not in completed]
+
+    def load(self):
+        """Return (text_dict, traj_dict) of all recorded results in a single pass."""
+        text_dict, traj_dict = {}, {}
+        for token, status, text, blob in self.conn.execute("SELECT token, status, text, traj FROM results"):
+            if text is not None:
+                text_dict[token] = text
+            if status == "done":
+                traj_dict[token] = pickle.loads(blob)
+        return text_dict, traj_dict
+
+    def merge(self, saved_traj_name, saved_text_name, tokens=None):
+        """Write the final trajectory and text pickles, ordered like `tokens` when given."""
+        text_dict, traj_dict = self.load()
+        if tokens is not None:
+            text_dict = {token: text_dict[token] for token in tokens if token in text_dict}
+            traj_dict = {token: traj_dict[token] for token in tokens if token in traj_dict}
+        with open(saved_text_name, "wb") as f:
+            pickle.dump(text_dict, f)
+        with open(saved_traj_name, "wb") as f:
+            pickle.dump(traj_dict, f)
+        return text_dict, traj_dict
+
+    def close(self):
+        self.conn.close()
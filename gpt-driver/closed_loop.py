@@ -0,0 +1,280 @@
+import json
+import time
+import pickle
+import asyncio
+import argparse
+import numpy as np
+import openai
+from prompt_message import SYSTEM_MESSAGES, generate_user_messages, pad_objects
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter
+from response_cache import ResponseCache
+from completion_backend import get_backend
+from compact_encoding import ENCODINGS
+from self_consistency import SelfConsistency
+from async_inference import RateLimiter, run_inference
+from evaluation import EGO_SIZE, HORIZONS, box_overlaps
+from finetune import resolve_model_id
+
+"""
+Closed-loop replay of the cached samples: starting from each token, ego executes the first waypoints of its plan,
+the objects follow their logged futures (gt_boxes + gt_agent_fut_trajs), and the planner is queried again with the user
+message regenerated in the new ego frame, for up to 6 steps of 0.5 seconds, the length of the logged object futures.
+All rollouts advance together, poses and objects are [B, ...] arrays in the frame of the first sample ("world"),
+and are re-expressed in the current ego frames with one batched rotation per step.
+Ego frame: x to the right, y forward, yaw counterclockwise from the world y axis, as evaluation.trajectory_yaws.
+"""
+
+NUM_STEPS = 6
+DT = 0.5
+
+def rotate(points, yaws):
+    """Rotate [B, ..., 2] points by [B] yaws counterclockwise."""
+    cos, sin = np.cos(yaws), np.sin(yaws)
+    cos = cos.reshape(cos.shape + (1,) * (points.ndim - 2))
+    sin = sin.reshape(sin.shape + (1,) * (points.ndim - 2))
+    return np.stack([cos * points[..., 0] - sin * points[..., 1], sin * points[..., 0] + cos * points[..., 1]], axis=-1)
+
+def to_ego(points, poses):
+    """World [B, ..., 2] points in the ego frames of [B, 3] (x, y, yaw) poses."""
+    offsets = points - poses[:, None, :2].reshape((len(poses),) + (1,) * (points.ndim - 2) + (2,))
+    return rotate(offsets, -poses[:, 2])
+
+def to_world(points, poses):
+    """Ego frame [B, ..., 2] points of [B, 3] poses in world coordinates."""
+    return rotate(points, poses[:, 2]) + poses[:, None, :2].reshape((len(poses),) + (1,) * (points.ndim - 2) + (2,))
+
+def extend(trajs, length):
+    """[B, T, 2] trajectories extended to [B, length, 2] at the velocity of their last step."""
+    velocity = trajs[:, -1] - trajs[:, -2]
+    extra = trajs[:, -1:] + velocity[:, None] * np.arange(1, length - trajs.shape[1] + 1)[None, :, None]
+    return np.concatenate([trajs, extra], axis=1)
+
+class Scenes:
+    """Batched state of the rollouts started from `tokens`."""
+    def __init__(self, data, tokens):
+        self.tokens = tokens
+        self.data_dicts = [data[token] for token in tokens]
+        object_boxes, object_rel_fut_trajs, object_fut_mask, self.object_sizes, self.object_valid = pad_objects(self.data_dicts)
+        batch_size, max_objects = self.object_valid.shape
+        # object positions at t = 0 .. 3s, [B, N, 7, 2], masks [B, N, 7]
+        self.object_trajs = np.concatenate([object_boxes[:, :, None], np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None]], axis=2)
+        self.object_masks = np.concatenate([np.ones((batch_size, max_objects, 1), dtype=bool), object_fut_mask > 0], axis=2)
+        # the columns the rollouts use: center, size and yaw, boxes with velocities carry them in further columns
+        box_dims = [d['gt_boxes'].shape[1] for d in self.data_dicts if d['gt_boxes'].shape[0] > 0]
+        if min(box_dims, default=7) < 7:
+            raise ValueError(f"gt_boxes need at least 7 columns (x, y, z, dx, dy, dz, yaw), got {min(box_dims)}")
+        self.object_boxes = np.zeros((batch_size, max_objects, 7))
+        self.object_boxes[self.object_valid] = np.concatenate([d['gt_boxes'][:, :7] for d in self.data_dicts])
+        self.object_names = np.full((batch_size, max_objects), "", dtype=object)
+        self.object_names[self.object_valid] = np.concatenate([np.asarray(d['gt_names'], dtype=object) for d in self.data_dicts])
+        # logged ego path, t = 0 .. 3s, extended by constant velocity for the replay planner at the later steps
+        self.logged_trajs = extend(np.stack([d['gt_ego_fut_trajs'] for d in self.data_dicts]).astype(np.float64), 2 * NUM_STEPS + 1)
+        self.poses = np.zeros((batch_size, 3))
+        self.yaw_rates = np.zeros(batch_size)
+        self.history = np.stack([d['gt_ego_his_trajs'] for d in self.data_dicts]).astype(np.float64) # [B, 5, 2], the last one is ego now
+        self.step = 0
+
+    def step_data(self):
+        """{rollout key: info dict} of the current step in the current ego frames, in the layout of cached_nuscenes_info."""
+        k = self.step
+        future = self.object_trajs[:, :, k+1:]
+        future_masks = self.object_masks[:, :, k+1:]
+        if future.shape[2] < NUM_STEPS: # unknown past the logged 3 seconds
+            pad = NUM_STEPS - future.shape[2]
+            future = np.concatenate([future, np.repeat(self.object_trajs[:, :, -1:], pad, axis=2)], axis=2)
+            future_masks = np.concatenate([future_masks, np.zeros(future_masks.shape[:2] + (pad,), dtype=bool)], axis=2)
+        positions = to_ego(np.concatenate([self.object_trajs[:, :, k:k+1], future], axis=2), self.poses) # [B, N, 7, 2]
+        rel_trajs = np.diff(positions, axis=2)
+        history = to_ego(self.history, self.poses)
+        logged = to_ego(self.logged_trajs[:, k:k+NUM_STEPS+1], self.poses)
+        velocities = np.diff(history[:, -2:], axis=1)[:, 0] / DT
+
+        step_data = {}
+        for b, token in enumerate(self.tokens):
+            d = self.data_dicts[b]
+            keep = self.object_valid[b] & self.object_masks[b, :, k] # objects seen now
+            boxes = self.object_boxes[b, keep].copy()
+            boxes[:, :2] = positions[b, keep, 0]
+            boxes[:, 6] -= self.poses[b, 2]
+            # the logged ego-states at the first step, so that its prompt is the one of test.py
+            ego_lcf_feat = np.array(d['gt_ego_lcf_feat'], dtype=np.float64)
+            ego_his_diff = d['gt_ego_his_diff']
+            if k > 0:
+                ego_lcf_feat[0:2] = velocities[b]
+                ego_lcf_feat[4] = self.yaw_rates[b]
+                ego_lcf_feat[7] = np.linalg.norm(velocities[b])
+                ego_his_diff = np.diff(history[b], axis=0)
+            step_data[f"{b}:{token}:{k}"] = {
+                'gt_boxes': boxes,
+                'gt_names': self.object_names[b, keep],
+                'gt_agent_fut_trajs': rel_trajs[b, keep].reshape(-1, 12),
+                'gt_agent_fut_masks': future_masks[b, keep].astype(np.float64),
+                'gt_ego_lcf_feat': ego_lcf_feat,
+                'gt_ego_his_trajs': history[b],
+                'gt_ego_his_diff': ego_his_diff,
+                'gt_ego_fut_cmd': d['gt_ego_fut_cmd'],
+                'gt_ego_fut_trajs': logged[b],
+                'gt_ego_fut_diff': np.diff(logged[b], axis=0),
+                'gt_ego_fut_masks': np.ones(NUM_STEPS),
+            }
+        return step_data
+
+    def advance(self, waypoints):
+        """Move ego to the [B, 2] world waypoints, heading along the step unless it (almost) stands still."""
+        steps = waypoints - self.poses[:, :2]
+        moving = np.linalg.norm(steps, axis=-1) > 0.1
+        headings = np.arctan2(steps[:, 1], steps[:, 0]) - np.pi / 2
+        yaws = np.where(moving, headings, self.poses[:, 2])
+        self.yaw_rates = (np.mod(yaws - self.poses[:, 2] + np.pi, 2 * np.pi) - np.pi) / DT
+        self.poses = np.concatenate([waypoints, yaws[:, None]], axis=1)
+        self.history = np.concatenate([self.history[:, 1:], waypoints[:, None]], axis=1)
+        self.step += 1
+
+    def collisions(self):
+        """[B] True where the ego box overlaps an object box now."""
+        k = self.step
+        overlaps = box_overlaps(
+            self.poses[:, None, :2], self.poses[:, None, 2], np.array(EGO_SIZE),
+            self.object_trajs[:, :, k], self.object_boxes[:, :, 6], self.object_sizes,
+        )
+        return (overlaps & self.object_valid & self.object_masks[:, :, k]).any(axis=1)
+
+class ReplayPlanner:
+    """The logged ego path, deterministic and free."""
+    def plan(self, step_data, keys, user_messages):
+        return np.stack([step_data[key]['gt_ego_fut_trajs'][1:] for key in keys])
+
+class ConstantVelocityPlanner:
+    def plan(self, step_data, keys, user_messages):
+        velocities = np.stack([step_data[key]['gt_ego_lcf_feat'][:2] * DT for key in keys])
+        return np.arange(1, NUM_STEPS + 1)[None, :, None] * velocities[:, None]
+
+class LLMPlanner:
+    """
+    A completion backend prompted like test.py, e.g. a fine-tuned model or mock_server.py.
+    Invalid outputs fall back to a constant velocity plan.
+    """
+    def __init__(self, backend, model_id, counter, limiter=None, concurrency=8, cache=None, encoding="text"):
+        self.backend = backend
+        self.model_id = model_id
+        self.counter = counter
+        self.limiter = limiter if limiter is not None else RateLimiter(rpm=0, tpm=0)
+        self.concurrency = concurrency
+        self.cache = cache
+        self.encoding = encoding
+        self.sampler = SelfConsistency(encoding=encoding)
+        self.fallback = ConstantVelocityPlanner()
+        self.num_invalid = 0
+
+    def plan(self, step_data, keys, user_messages):
+        system_message = SYSTEM_MESSAGES[self.encoding]
+        num_system_tokens = self.counter.count(system_message)
+        requests = []
+        for key, user_message, num_user_tokens in zip(keys, user_messages, self.counter.count_batch(user_messages)):
+            requests.append({
+                "token": key,
+                "messages": [
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": user_message},
+                ],
+                "num_tokens": num_system_tokens + num_user_tokens + 256,
+                "num_system_tokens": num_system_tokens,
+                "num_user_tokens": num_user_tokens,
+                "GT": "",
+            })
+        _, traj_dict, _, _ = asyncio.run(run_inference(
+            requests, self.model_id, self.limiter, concurrency=self.concurrency, cache=self.cache, backend=self.backend, sampler=self.sampler))
+        plans = self.fallback.plan(step_data, keys, user_messages)
+        for i, key in enumerate(keys):
+            if key in traj_dict:
+                plans[i] = traj_dict[key]
+            else:
+                self.num_invalid += 1
+        return plans
+
+def simulate(data, tokens, planner, replan_every=1, encoding="text", batch_size=1024):
+    """
+    Roll out every token in closed loop, returns (executed [N, 6, 2] world ego positions, collided [N, 6]),
+    world being the ego frame of the token.
+    """
+    executed, collided = [], []
+    for start in range(0, len(tokens), batch_size):
+        scenes = Scenes(data, tokens[start:start+batch_size])
+        batch_executed = np.zeros((len(scenes.tokens), NUM_STEPS, 2))
+        batch_collided = np.zeros((len(scenes.tokens), NUM_STEPS), dtype=bool)
+        while scenes.step < NUM_STEPS:
+            step_data = scenes.step_data()
+            keys = list(step_data)
+            user_messages = generate_user_messages(step_data, keys, encoding=encoding)
+            waypoints = to_world(planner.plan(step_data, keys, user_messages), scenes.poses)
+            for i in range(min(replan_every, NUM_STEPS - scenes.step)):
+                scenes.advance(waypoints[:, i])
+                batch_executed[:, scenes.step - 1] = scenes.poses[:, :2]
+                batch_collided[:, scenes.step - 1] = scenes.collisions()
+        executed.append(batch_executed)
+        collided.append(batch_collided)
+    return np.concatenate(executed), np.concatenate(collided)
+
+def report(data, tokens, executed, collided):
+    """L2 to the logged ego positions and ratio of rollouts that collided, up to 1s, 2s and 3s."""
+    logged = np.stack([data[token]['gt_ego_fut_trajs'][1:7] for token in tokens]).astype(np.float64)
+    errors = np.linalg.norm(executed - logged, axis=-1)
+    result = {"L2": {}, "collision": {}}
+    for name, num_steps in HORIZONS.items():
+        result["L2"][name] = float(errors[:, :num_steps].mean()) if len(tokens) else float("nan")
+        result["collision"][name] = float(collided[:, :num_steps].any(axis=1).mean()) * 100 if len(tokens) else float("nan")
+    result["num_rollouts"] = len(tokens)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop replay of a split with a planner in the loop.")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split whose tokens start the rollouts")
+    parser.add_argument("-n", "--num_rollouts", type=int, default=None, help="number of rollouts, defaults to the whole split")
+    parser.add_argument("-p", "--planner", type=str, default="replay", choices=["replay", "constant_velocity", "llm"], help="planner in the loop")
+    parser.add_argument("-i", "--id", type=str, default="gpt-3.5-turbo", help="GPT model id of the llm planner, latest for the last model of finetune.py")
+    parser.add_argument("-o", "--output", type=str, default=None, help="save the executed trajectories to outputs/<output>.pkl and the report to outputs/<output>_closed_loop.json")
+    parser.add_argument("--replan_every", type=int, default=1, help="waypoints executed between two planner calls")
+    parser.add_argument("--backend", type=str, default="openai", choices=["openai", "mock"], help="backend of the llm planner")
+    parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight of the llm planner")
+    parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache of the llm planner, replays identical prompts, empty to disable")
+    parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding the model was fine-tuned on")
+    args = parser.parse_args()
+    args.id = resolve_model_id(args.id)
+
+    openai.api_key = "" # insert your API key here
+
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    tokens = split[args.split][:args.num_rollouts]
+
+    cache = None
+    if args.planner == "replay":
+        planner = ReplayPlanner()
+    elif args.planner == "constant_velocity":
+        planner = ConstantVelocityPlanner()
+    else:
+        counter = TokenCounter("gpt-3.5-turbo")
+        cache = ResponseCache(args.cache) if args.cache else None
+        backend = get_backend(args.backend, api_base=args.api_base, data=data, tokens=tokens, counter=counter, encoding=args.encoding)
+        planner = LLMPlanner(backend, args.id, counter, concurrency=args.concurrency, cache=cache, encoding=args.encoding)
+
+    start = time.time()
+    executed, collided = simulate(data, tokens, planner, replan_every=args.replan_every, encoding=args.encoding)
+    elapsed = time.time() - start
+    result = report(data, tokens, executed, collided)
+    print(f"#### Closed Loop: {args.planner} ####")
+    for name in HORIZONS:
+        print(f"{name}: L2 {result['L2'][name]:.2f} m, collision {result['collision'][name]:.2f} %")
+    print(f"{len(tokens)} rollouts in {elapsed:.2f}s, {len(tokens) / max(elapsed, 1e-9) * 60:.0f} rollouts per minute")
+    if isinstance(planner, LLMPlanner):
+        print(f"Invalid plans replaced by constant velocity: {planner.num_invalid}")
+    if cache is not None:
+        cache.summary()
+        cache.close()
+    if args.output is not None:
+        with open("outputs/" + args.output + ".pkl", "wb") as f:
+            pickle.dump(dict(zip(tokens, executed)), f)
+        with open("outputs/" + args.output + "_closed_loop.json", "w") as f:
+            json.dump(result, f, indent=4)
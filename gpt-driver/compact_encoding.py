@@ -0,0 +1,165 @@
+import re
+import numpy as np
+from trajectory_parser import parse_trajectory, parse_trajectories
+
+"""
+Compact serialization of the prompts, for models fine-tuned on it (dataset_builder.py --encoding compact).
+Numbers are integers: positions, velocities, the can bus and the heading speed in decimeters (x10),
+accelerations, the heading angular velocity and the steering in hundredths (x100). Classes are abbreviated.
+    Objects:
+    c 12 85>15 140          car at (1.2,8.5) moving to (1.5,14.0)
+    p -30 40>?              pedestrian moving to an unknown location
+    Ego:
+     v 0 42                 velocity (vx,vy)
+     w 1                    heading angular velocity
+     a 0 -3                 acceleration (ax,ay)
+     cb 2 41                can bus
+     hs 42                  heading speed
+     st 0                   steering
+    History: 0 -170;0 -127;0 -85;0 -42
+    Goal: F
+The trajectory is [(x1,y1),(x2,y2),...,(x6,y6)] in decimeters, which trajectory_parser.py reads as is.
+decode_user_message and decode_trajectory invert the encoding up to the quantization.
+"""
+
+ENCODINGS = ("text", "compact")
+POSITION_SCALE = 10.0
+FINE_SCALE = 100.0
+# multiplier from the parsed trajectory to meters
+TRAJECTORY_SCALES = {"text": 1.0, "compact": 1.0 / POSITION_SCALE}
+# first line of the ego-states, where the sample specific end of every user message starts
+TAIL_STARTS = {"text": "Ego-States:\n", "compact": "Ego:\n"}
+
+CLASS_CODES = {
+    "car": "c",
+    "truck": "t",
+    "bus": "b",
+    "trailer": "tr",
+    "construction_vehicle": "cv",
+    "pedestrian": "p",
+    "motorcycle": "m",
+    "bicycle": "bc",
+    "traffic_cone": "tc",
+    "barrier": "br",
+}
+CLASS_NAMES = {code: name for name, code in CLASS_CODES.items()}
+MISSION_CODES = {"RIGHT": "R", "LEFT": "L", "FORWARD": "F"}
+MISSION_GOALS = {code: goal for goal, code in MISSION_CODES.items()}
+
+def quantize(values, scale=POSITION_SCALE):
+    """Nested lists of the integers of an array."""
+    return np.rint(np.asarray(values, dtype=np.float64) * scale).astype(np.int64).tolist()
+
+def class_code(object_name):
+    """Code of the last component of a nuScenes class name, e.g. vehicle.car, unknown classes are kept."""
+    object_name = object_name.split(".")[-1]
+    return CLASS_CODES.get(object_name, object_name)
+
+def format_objects(names, boxes, trajs, masks, short=True):
+    """
+    Object lines from the names [K], box centers [K, 2], future positions [K, 6, 2] and masks [K, 6] of the kept objects.
+    short keeps the last future position only, otherwise all of them with ? for the unknown ones.
+    """
+    boxes = quantize(boxes)
+    trajs = quantize(trajs)
+    object_lines = []
+    for name, (ox, oy), traj, mask in zip(names, boxes, trajs, masks):
+        if short:
+            end = f"{traj[-1][0]} {traj[-1][1]}" if mask[-1] else "?"
+            object_lines.append(f"{class_code(name)} {ox} {oy}>{end}\n")
+        else:
+            waypoints = ";".join(f"{x} {y}" if valid else "?" for (x, y), valid in zip(traj, mask))
+            object_lines.append(f"{class_code(name)} {ox} {oy}>{waypoints}\n")
+    return object_lines
+
+def format_tails(ego_states, ego_his_trajs, mission_goals):
+    """
+    Ego-states, historical trajectory and mission goal of every sample from
+    ego_states [B, 9] (vx, vy, v_yaw, ax, ay, cx, cy, vhead, steering), ego_his_trajs [B, 4, 2] and mission_goals [B].
+    """
+    ego_states = np.asarray(ego_states, dtype=np.float64)
+    scales = np.array([POSITION_SCALE, POSITION_SCALE, FINE_SCALE, FINE_SCALE, FINE_SCALE, POSITION_SCALE, POSITION_SCALE, POSITION_SCALE, FINE_SCALE])
+    ego_states = quantize(ego_states, scales)
+    ego_his_trajs = quantize(ego_his_trajs)
+    tails = []
+    for (vx, vy, v_yaw, ax, ay, cx, cy, vhead, steeling), history, mission_goal in zip(ego_states, ego_his_trajs, mission_goals):
+        tails.append("".join([
+            "Ego:\n",
+            f" v {vx} {vy}\n",
+            f" w {v_yaw}\n",
+            f" a {ax} {ay}\n",
+            f" cb {cx} {cy}\n",
+            f" hs {vhead}\n",
+            f" st {steeling}\n",
+            "History: " + ";".join(f"{x} {y}" for x, y in history) + "\n",
+            f"Goal: {MISSION_CODES[mission_goal]}\n",
+        ]))
+    return tails
+
+def format_notable_object(name, box, time):
+    ox, oy = quantize(box)
+    return f" - {class_code(name)} {ox} {oy} at {time}s\n"
+
+def format_trajectory(traj):
+    """[(x1,y1),...] in decimeters of a [6, 2] trajectory in meters."""
+    return "[" + ",".join(f"({x},{y})" for x, y in quantize(traj)) + "]"
+
+def format_trajectories(trajs):
+    return [format_trajectory(traj) for traj in np.asarray(trajs)]
+
+OBJECT_RE = re.compile(r"^(\S+) (-?\d+) (-?\d+)>(.*)$")
+EGO_RE = re.compile(r"^ (v|w|a|cb|hs|st) (-?\d+)(?: (-?\d+))?$")
+
+def _point(text):
+    if text == "?":
+        return None
+    x, y = text.split(" ")
+    return (int(x) / POSITION_SCALE, int(y) / POSITION_SCALE)
+
+def decode_user_message(user_message):
+    """
+    The values of a compact user message in meters, as a dict with
+        objects: [(class name, (x, y), [future (x, y) or None])], one future position in the short format
+        velocity, v_yaw, acceleration, can_bus, heading_speed, steering, history [4, 2], mission_goal
+    """
+    decoded = {"objects": []}
+    fields = {
+        "v": ("velocity", POSITION_SCALE),
+        "w": ("v_yaw", FINE_SCALE),
+        "a": ("acceleration", FINE_SCALE),
+        "cb": ("can_bus", POSITION_SCALE),
+        "hs": ("heading_speed", POSITION_SCALE),
+        "st": ("steering", FINE_SCALE),
+    }
+    for line in user_message.split("\n"):
+        match = EGO_RE.match(line)
+        if match is not None:
+            name, scale = fields[match.group(1)]
+            values = [int(value) / scale for value in match.groups()[1:] if value is not None]
+            decoded[name] = tuple(values) if len(values) > 1 else values[0]
+        elif line.startswith("History: "):
+            decoded["history"] = np.array([_point(point) for point in line[len("History: "):].split(";")])
+        elif line.startswith("Goal: "):
+            decoded["mission_goal"] = MISSION_GOALS[line[len("Goal: "):]]
+        else:
+            match = OBJECT_RE.match(line)
+            if match is not None:
+                code, ox, oy, future = match.groups()
+                decoded["objects"].append((
+                    CLASS_NAMES.get(code, code),
+                    (int(ox) / POSITION_SCALE, int(oy) / POSITION_SCALE),
+                    [_point(point) for point in future.split(";")],
+                ))
+    return decoded
+
+def decode_trajectory(text, encoding="compact"):
+    """Returns (traj [6, 2] in meters or None, reason) like trajectory_parser.parse_trajectory."""
+    traj, reason = parse_trajectory(text)
+    if traj is not None:
+        traj = traj * TRAJECTORY_SCALES[encoding]
+    return traj, reason
+
+def decode_trajectories(texts, encoding="compact"):
+    """Bulk decode_trajectory, returns (trajs [N, 6, 2] in meters with NaN rows for failures, reasons [N])."""
+    trajs, reasons = parse_trajectories(texts)
+    return trajs * TRAJECTORY_SCALES[encoding], reasons
@@ -0,0 +1,92 @@
+import time
+import asyncio
+import contextlib
+import collections
+import openai
+import aiohttp
+from mock_server import MockResponder
+
+"""
+Completion backends of the inference runners. A backend has
+    complete(model, messages, **params) -> Completion
+    async acomplete(model, messages, **params) -> Completion
+    async with backend.session(): shared resources of concurrent acomplete calls
+    cache_params: what identifies the endpoint in the response cache keys, so that other endpoints do not share responses
+and raises on API errors, which the runners retry with exponential backoff.
+"""
+
+# text is the first of the choices, one per sample when n > 1 is requested
+Completion = collections.namedtuple("Completion", ["text", "prompt_tokens", "completion_tokens", "choices"])
+
+class OpenAIBackend:
+    """
+    openai.ChatCompletion, against api_base when given, e.g. http://localhost:8765/v1 for mock_server.py.
+    api_key overrides openai.api_key, mock_server.py accepts any non-empty key.
+    """
+    def __init__(self, api_base=None, api_key=None):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.cache_params = {} if api_base is None else {"api_base": api_base}
+
+    def _kwargs(self, kwargs):
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+        if self.api_key is not None:
+            kwargs["api_key"] = self.api_key
+        return kwargs
+
+    @staticmethod
+    def _parse(completion):
+        usage = completion.get("usage", {})
+        choices = [choice.message["content"] for choice in completion.choices]
+        return Completion(choices[0], usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), choices)
+
+    def complete(self, **kwargs):
+        return self._parse(openai.ChatCompletion.create(**self._kwargs(kwargs)))
+
+    async def acomplete(self, **kwargs):
+        return self._parse(await openai.ChatCompletion.acreate(**self._kwargs(kwargs)))
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        async with aiohttp.ClientSession() as session:
+            openai.aiosession.set(session) # reuse connections across requests
+            yield
+
+class MockBackend:
+    """In-process mock_server.MockResponder with a fixed latency, to measure the pipeline without HTTP."""
+    def __init__(self, responder, counter=None, latency=0.0):
+        self.responder = responder
+        self.counter = counter
+        self.latency = latency
+        self.cache_params = {"backend": "mock"}
+
+    def _complete(self, messages, n):
+        choices = [self.responder.respond(messages) for _ in range(n)]
+        if self.counter is None:
+            return Completion(choices[0], 0, 0, choices)
+        prompt_tokens = sum(self.counter.count_batch([message["content"] for message in messages]))
+        return Completion(choices[0], prompt_tokens, sum(self.counter.count_batch(choices)), choices)
+
+    def complete(self, model, messages, n=1, **params):
+        time.sleep(self.latency)
+        return self._complete(messages, n)
+
+    async def acomplete(self, model, messages, n=1, **params):
+        await asyncio.sleep(self.latency)
+        return self._complete(messages, n)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        yield
+
+def get_backend(name="openai", api_base=None, data=None, tokens=None, counter=None, noise=0.0, encoding="text"):
+    """
+    The backend of the --backend flag of the runners, "mock" answers the prompts of `tokens` in `encoding` from the ground truth,
+    with noise on the trajectories so that several samples differ.
+    """
+    if name == "openai":
+        return OpenAIBackend(api_base)
+    if name == "mock":
+        return MockBackend(MockResponder(data, tokens, noise=noise, encoding=encoding), counter=counter)
+    raise ValueError(f"Unknown backend: {name}")
@@ -0,0 +1,252 @@
+import json
+import difflib
+import argparse
+import itertools
+import multiprocessing
+from prompt_message import SYSTEM_MESSAGES, generate_user_messages, generate_assistant_messages
+from compact_encoding import ENCODINGS
+from nuscenes_cache import load_nuscenes_info
+from uniad_cache import load_uniad_perceptions, PerceptionOverride
+from token_counter import TokenCounter, TokenUsage
+from spatial_index import load_spatial_index
+from dataset_cache import DatasetCache, USER_MESSAGE_CODE, ASSISTANT_MESSAGE_CODE, code_hash, input_hash
+
+def load_data(perception="gt"):
+    """Cached info with GT perception, or with the UniAD detections and predictions in place of the GT ones."""
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    if perception == "uniad":
+        data = PerceptionOverride(data, load_uniad_perceptions('data/detection_motion_result_trainval.jsonl'))
+    return data
+
+# per-process state, inherited from the parent under fork and loaded by _init_worker otherwise
+_data = None
+_counter = None
+_index = None
+
+def _init_worker(perception, with_index=False):
+    global _data, _counter, _index
+    if _data is None:
+        _data = load_data(perception)
+    if _counter is None:
+        _counter = TokenCounter("gpt-3.5-turbo")
+    if with_index and _index is None:
+        _index = load_spatial_index(_data, perception)
+
+def build_shard(tokens, traj_only=False, encoding="text", max_objects=None):
+    """Render the fine-tuning records of one shard, returns (lines, usage, long_outputs)."""
+    system_message = SYSTEM_MESSAGES[encoding]
+    index = _index if max_objects is not None else None
+    user_messages = generate_user_messages(_data, tokens, encoding=encoding, index=index, max_objects=max_objects)
+    assitant_messages = generate_assistant_messages(_data, tokens, traj_only=traj_only, encoding=encoding, index=index, max_objects=max_objects)
+    usage = TokenUsage()
+    usage.add(
+        system=_counter.count(system_message) * len(tokens),
+        user=sum(_counter.count_batch(user_messages)),
+        assistant=sum(_counter.count_batch(assitant_messages)),
+    )
+    lines, long_outputs = [], []
+    for token, user_message, assitant_message in zip(tokens, user_messages, assitant_messages):
+        if len(assitant_message.split("\n")) > 6:
+            long_outputs.append((token, user_message, assitant_message))
+        train_message = {"messages":
+            [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": assitant_message}
+            ]
+        }
+        lines.append(json.dumps(train_message))
+    return lines, usage, long_outputs
+
+def _build_shard(args):
+    return build_shard(*args)
+
+def _hash_shard(tokens):
+    return [input_hash(_data[token]) for token in tokens]
+
+def render_shard(tokens, part, traj_only=False, encoding="text", max_objects=None):
+    """The user or assistant messages of one shard."""
+    index = _index if max_objects is not None else None
+    if part == "user":
+        return generate_user_messages(_data, tokens, encoding=encoding, index=index, max_objects=max_objects)
+    return generate_assistant_messages(_data, tokens, traj_only=traj_only, encoding=encoding, index=index, max_objects=max_objects)
+
+def _render_shard(args):
+    return render_shard(*args)
+
+def build_dataset(tokens, output, perception="gt", traj_only=False, num_workers=None, shard_size=256, encoding="text", max_objects=None, cache=None, show_diffs=0):
+    """
+    Shard `tokens` across a process pool and stream the records to an NDJSON file in token order.
+    The file is byte-identical to ndjson.dump of the serially built list of records.
+    encoding="compact" writes the prompts of compact_encoding.py, test the model with the same --encoding.
+    max_objects keeps the nearest objects of every prompt, test the model with the same --max_objects.
+    With a cache (see dataset_cache.py), only the messages whose inputs or code changed since the last build are rendered again.
+    """
+    if cache is not None:
+        return update_dataset(tokens, output, cache, perception, traj_only, num_workers, shard_size, encoding, max_objects, show_diffs)
+    global _data, _index
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if multiprocessing.get_start_method() == "fork" or num_workers <= 1:
+        _data = load_data(perception) # shared copy-on-write with the forked workers
+        _index = load_spatial_index(_data, perception) if max_objects is not None else None
+    shards = [(tokens[i:i+shard_size], traj_only, encoding, max_objects) for i in range(0, len(tokens), shard_size)]
+
+    usage = TokenUsage()
+    with open(output, "w") as f:
+        if num_workers <= 1:
+            _init_worker(perception, max_objects is not None)
+            results = map(_build_shard, shards)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(perception, max_objects is not None))
+            results = pool.imap(_build_shard, shards) # ordered, so the output is deterministic
+        num_records = 0
+        for lines, shard_usage, long_outputs in results:
+            for token, user_message, assitant_message in long_outputs:
+                print()
+                print(token)
+                print(SYSTEM_MESSAGES[encoding])
+                print(user_message)
+                print(assitant_message)
+            for line in lines:
+                if num_records > 0:
+                    f.write("\n")
+                f.write(line)
+                num_records += 1
+            usage.merge(shard_usage)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    usage.summary("fine-tune")
+
+def update_dataset(tokens, output, cache, perception="gt", traj_only=False, num_workers=None, shard_size=256, encoding="text", max_objects=None, show_diffs=0):
+    """
+    Incremental build_dataset: the samples are hashed, the messages whose sample or code changed are rendered again,
+    the changed ones are tokenized, and the records are written from the cache, byte-identical to a full build.
+    Prints what changed since the last build and the first show_diffs changed messages.
+    """
+    global _data, _index
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if multiprocessing.get_start_method() == "fork" or num_workers <= 1:
+        _data = load_data(perception)
+        _index = load_spatial_index(_data, perception) if max_objects is not None else None
+    system_message = SYSTEM_MESSAGES[encoding]
+    user_key = code_hash(USER_MESSAGE_CODE, encoding=encoding, max_objects=max_objects)
+    assistant_key = code_hash(ASSISTANT_MESSAGE_CODE, encoding=encoding, traj_only=traj_only, max_objects=max_objects)
+    dataset_cache = DatasetCache(cache)
+    cached = dataset_cache.load()
+    counter = TokenCounter("gpt-3.5-turbo")
+
+    if num_workers <= 1:
+        _init_worker(perception, max_objects is not None)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(perception, max_objects is not None))
+    def run(fn, tasks):
+        results = map(fn, tasks) if pool is None else pool.imap(fn, tasks)
+        return list(itertools.chain.from_iterable(results))
+    def shards(part_tokens):
+        return [part_tokens[i:i+shard_size] for i in range(0, len(part_tokens), shard_size)]
+
+    input_hashes = dict(zip(tokens, run(_hash_shard, shards(tokens))))
+    new_tokens = [token for token in tokens if token not in cached]
+    changed_inputs = [token for token in tokens if token in cached and cached[token][0] != input_hashes[token]]
+    stale = {}
+    for part, key, key_column in [("user", user_key, 1), ("assistant", assistant_key, 4)]:
+        stale[part] = [
+            token for token in tokens
+            if token not in cached or cached[token][0] != input_hashes[token] or cached[token][key_column] != key
+        ]
+    messages = {
+        part: dict(zip(stale[part], run(_render_shard, [(shard, part, traj_only, encoding, max_objects) for shard in shards(stale[part])])))
+        for part in ("user", "assistant")
+    }
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # only messages whose text changed are tokenized again
+    changed, counts = {}, {}
+    for part, message_column in [("user", 2), ("assistant", 5)]:
+        changed[part] = [
+            token for token, message in messages[part].items()
+            if token not in cached or cached[token][message_column] != message
+        ]
+        counts[part] = dict(zip(changed[part], counter.count_batch([messages[part][token] for token in changed[part]])))
+
+    rows, records = [], []
+    for token in tokens:
+        row = cached.get(token, (None, None, None, 0, None, None, 0))
+        user_message = messages["user"].get(token, row[2])
+        assistant_message = messages["assistant"].get(token, row[5])
+        user_tokens = counts["user"].get(token, row[3])
+        assistant_tokens = counts["assistant"].get(token, row[6])
+        if token in messages["user"] or token in messages["assistant"]:
+            rows.append((token, input_hashes[token], user_key, user_message, user_tokens, assistant_key, assistant_message, assistant_tokens))
+        records.append((user_message, assistant_message, user_tokens, assistant_tokens))
+
+    for token in changed["assistant"]:
+        assitant_message = messages["assistant"][token]
+        if len(assitant_message.split("\n")) > 6:
+            print()
+            print(token)
+            print(system_message)
+            print(messages["user"].get(token, cached[token][2] if token in cached else ""))
+            print(assitant_message)
+
+    usage = TokenUsage()
+    with open(output, "w") as f:
+        for i, (user_message, assitant_message, user_tokens, assistant_tokens) in enumerate(records):
+            train_message = {"messages":
+                [
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": user_message},
+                    {"role": "assistant", "content": assitant_message}
+                ]
+            }
+            if i > 0:
+                f.write("\n")
+            f.write(json.dumps(train_message))
+            usage.add(user=user_tokens, assistant=assistant_tokens)
+    usage.add(system=counter.count(system_message) * len(tokens))
+    dataset_cache.store(rows)
+
+    print("#### Dataset Diff ####")
+    previous_system_message = dataset_cache.get_meta("system_message")
+    print(f"Samples: {len(tokens)}, new {len(new_tokens)}, changed inputs {len(changed_inputs)}, "
+        f"cached but not in this build {len(set(cached) - set(tokens))}")
+    print(f"Re-rendered: user {len(stale['user'])}, assistant {len(stale['assistant'])} messages")
+    for part, message_column, count_column in [("user", 2, 3), ("assistant", 5, 6)]:
+        modified = [token for token in changed[part] if token in cached]
+        delta = sum(counts[part][token] - cached[token][count_column] for token in modified)
+        print(f"Changed {part} messages: {len(modified)} ({delta:+d} tokens), new {len(changed[part]) - len(modified)}")
+        for token in modified[:show_diffs]:
+            print("".join(difflib.unified_diff(
+                cached[token][message_column].splitlines(keepends=True), messages[part][token].splitlines(keepends=True),
+                fromfile=f"{token} {part} (cached)", tofile=f"{token} {part}", n=1)))
+    if previous_system_message is not None and previous_system_message != system_message:
+        print("System message changed")
+    dataset_cache.set_meta("system_message", system_message)
+    dataset_cache.close()
+
+    usage.summary("fine-tune")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the fine-tuning NDJSON file.")
+    parser.add_argument("-o", "--output", type=str, default="data/train.json", help="output NDJSON file")
+    parser.add_argument("-p", "--perception", type=str, default="gt", choices=["gt", "uniad"], help="perception source")
+    parser.add_argument("-s", "--split", type=str, default="train", help="split to build")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes, defaults to all cores")
+    parser.add_argument("--traj_only", action="store_true", help="trajectory-only assistant messages without chain of thoughts")
+    parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding, compact for integers in decimeters and class codes")
+    parser.add_argument("--max_objects", type=int, default=None, help="list at most this many objects per prompt, nearest first")
+    parser.add_argument("--cache", type=str, default=None, help="cache of the rendered messages for incremental rebuilds, e.g. data/train_cache.db")
+    parser.add_argument("--show_diffs", type=int, default=3, help="print the diffs of this many changed messages of an incremental rebuild")
+    args = parser.parse_args()
+
+    split = json.load(open('data/split.json', 'r'))
+    build_dataset(split[args.split], args.output, perception=args.perception, traj_only=args.traj_only, num_workers=args.workers, encoding=args.encoding, max_objects=args.max_objects,
+        cache=args.cache, show_diffs=args.show_diffs)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import sqlite3
+import inspect
+import hashlib
+import numpy as np
+import prompt_message
+import spatial_index
+
+"""
+Rendered fine-tuning messages of every sample, with what they were rendered from:
+    input_hash: hash of the sample's info dict
+    user_key / assistant_key: hash of the prompt-generation code the message depends on and of the build parameters
+A message is re-rendered only if the sample's inputs or the key of its code changed since it was cached,
+and re-tokenized only if its text changed.
+The code is found by following the global names that the message generators use, through every function, class and module
+of gpt-driver they reach, the whole source of a module being hashed when it is used as a module. Objects that reach the generators
+as arguments, the spatial index, are listed explicitly.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _is_local(obj):
+    try:
+        return os.path.dirname(os.path.abspath(inspect.getsourcefile(obj))) == HERE
+    except TypeError: # builtins and extension modules
+        return False
+
+def _global_names(code):
+    names = list(code.co_names)
+    for const in code.co_consts: # comprehensions, lambdas and nested functions
+        if inspect.iscode(const):
+            names.extend(_global_names(const))
+    return names
+
+def dependencies(functions):
+    """The functions, classes and modules of gpt-driver and the constants that `functions` use, directly or through each other."""
+    found, order = set(), []
+
+    def visit(obj):
+        if id(obj) in found:
+            return
+        found.add(id(obj))
+        order.append(obj)
+        if inspect.isclass(obj):
+            members = [member for member in vars(obj).values() if inspect.isfunction(member)]
+        elif inspect.isfunction(obj):
+            members = [obj]
+        else:
+            return
+        for function in members:
+            for name in _global_names(function.__code__):
+                value = function.__globals__.get(name)
+                if inspect.ismodule(value) or inspect.isclass(value) or inspect.isfunction(value):
+                    if _is_local(value):
+                        visit(value)
+                elif isinstance(value, (bool, int, float, str, tuple, dict)):
+                    visit(value)
+
+    for function in functions:
+        visit(function)
+    return order
+
+USER_MESSAGE_CODE = dependencies([prompt_message.generate_user_messages]) + [spatial_index]
+
+ASSISTANT_MESSAGE_CODE = dependencies([prompt_message.generate_assistant_messages]) + [spatial_index]
+
+def code_hash(objects, **params):
+    """Hash of the source of functions, classes and modules, of the values of constants and of the parameters they are called with."""
+    h = hashlib.sha256()
+    for obj in objects:
+        source = inspect.getsource(obj) if inspect.ismodule(obj) or inspect.isclass(obj) or inspect.isfunction(obj) else repr(obj)
+        h.update(source.encode("utf-8"))
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def input_hash(data_dict):
+    """Hash of the keys, dtypes, shapes and bytes of the values of an info dict."""
+    h = hashlib.sha256()
+    for key in sorted(data_dict):
+        value = data_dict[key]
+        h.update(key.encode("utf-8"))
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = np.ascontiguousarray(value)
+            h.update(f"{value.dtype.str}{value.shape}".encode("utf-8"))
+            h.update(value.tobytes())
+        else:
+            h.update(repr(value).encode("utf-8"))
+    return h.hexdigest()
+
+INFO_NAME = 'data/cached_nuscenes_info.pkl'
+UNIAD_NAME = 'data/detection_motion_result_trainval.jsonl'
+
+def source_stats(perception="gt", info_name=INFO_NAME, uniad_name=UNIAD_NAME):
+    """
+    [name, size, mtime_ns] of the files the info of `perception` is loaded from: the info pickle, its columnar copy
+    and for "uniad" the UniAD detections. A cheap key of data derived from the whole split, in place of hashing every info dict.
+    """
+    names = [info_name, os.path.join(os.path.splitext(info_name)[0], "meta.json")] + ([uniad_name] if perception == "uniad" else [])
+    stats = []
+    for name in names:
+        if os.path.exists(name):
+            stat = os.stat(name)
+            stats.append([name, stat.st_size, stat.st_mtime_ns])
+    return stats
+
+class DatasetCache:
+    """
+    SQLite store of the rendered messages and token counts of every sample, plus the system message of the last build, to report when it changes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "token TEXT PRIMARY KEY, input_hash TEXT NOT NULL, "
+            "user_key TEXT NOT NULL, user_message TEXT NOT NULL, user_tokens INTEGER NOT NULL, "
+            "assistant_key TEXT NOT NULL, assistant_message TEXT NOT NULL, assistant_tokens INTEGER NOT NULL, updated REAL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def load(self):
+        """{token: (input_hash, user_key, user_message, user_tokens, assistant_key, assistant_message, assistant_tokens)}"""
+        return {row[0]: row[1:] for row in self.conn.execute(
+            "SELECT token, input_hash, user_key, user_message, user_tokens, assistant_key, assistant_message, assistant_tokens FROM records"
+        )}
+
+    def store(self, rows):
+        """Insert or replace rows of (token, input_hash, user_key, user_message, user_tokens, assistant_key, assistant_message, assistant_tokens)."""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [tuple(row) + (now,) for row in rows],
+        )
+        self.conn.commit()
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,263 @@
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import asyncio
+import hashlib
+import argparse
+import subprocess
+import openai
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter, TokenUsage
+from completion_backend import get_backend
+from compact_encoding import ENCODINGS
+from self_consistency import SelfConsistency
+from spatial_index import load_spatial_index
+from async_inference import RateLimiter, build_requests, run_inference
+from finetune import resolve_model_id
+
+"""
+Sharded val / test inference over workers that share the outputs/ directory, local processes or separate hosts.
+    plan:  partition the tokens without a valid result into shards of small chunks, outputs/<output>_shards/plan.json
+    work:  one worker, claims the chunks of its shard first, then unclaimed chunks of other shards, then chunks
+           claimed more than --steal_after seconds ago and still not done (stragglers, run again as a backup)
+    merge: combine the results of all workers into outputs/<output>.pkl and <output>_text.pkl, replaced atomically
+    run:   plan, start --num_shards local workers and merge
+Chunks are claimed by creating claims/<chunk> exclusively, a straggler's claim is taken over by renaming it away,
+which only one worker can do. Every worker records into its own checkpoint, so no database is written by two hosts,
+and has its own rate budget of --rpm / --num_shards and --tpm / --num_shards (at least 1 each, 0 still disables a limit).
+Running plan again after a round plans the tokens still missing (invalid or failed) as a new round.
+"""
+
+def partition(tokens, num_shards, method="hash", scenes=None):
+    """
+    Shard index of every token.
+        hash: sha1 of the token, stable when the token list changes
+        contiguous: consecutive runs of the token list, which keeps the samples of a scene together since the splits list them scene by scene
+        scene: the scene of every token from `scenes` ({token: scene}), scenes assigned by hash
+    """
+    if method == "hash":
+        return [int(hashlib.sha1(token.encode("utf-8")).hexdigest()[:8], 16) % num_shards for token in tokens]
+    if method == "contiguous":
+        return [i * num_shards // max(len(tokens), 1) for i in range(len(tokens))]
+    if method == "scene":
+        return [int(hashlib.sha1(scenes[token].encode("utf-8")).hexdigest()[:8], 16) % num_shards for token in tokens]
+    raise ValueError(f"Unknown partition: {method}")
+
+class ShardDirectory:
+    """Plan, claims, done markers and worker checkpoints of a sharded run under outputs/<output>_shards/."""
+    def __init__(self, path):
+        self.path = path
+        self.plan_path = os.path.join(path, "plan.json")
+        self.claims_path = os.path.join(path, "claims")
+        self.done_path = os.path.join(path, "done")
+        for directory in (self.path, self.claims_path, self.done_path):
+            os.makedirs(directory, exist_ok=True)
+
+    def load_plan(self):
+        if not os.path.exists(self.plan_path):
+            return None
+        with open(self.plan_path, "r") as f:
+            return json.load(f)
+
+    def save_plan(self, plan):
+        with open(self.plan_path + ".tmp", "w") as f:
+            json.dump(plan, f)
+        os.replace(self.plan_path + ".tmp", self.plan_path)
+
+    def checkpoint_paths(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".db"))
+
+    def is_done(self, chunk_id):
+        return os.path.exists(os.path.join(self.done_path, chunk_id))
+
+    def mark_done(self, chunk_id, worker_id):
+        with open(os.path.join(self.done_path, chunk_id), "w") as f:
+            f.write(worker_id)
+
+    def claim(self, chunk_id, worker_id, steal_after=None):
+        """True if worker_id now holds the chunk. With steal_after, a claim older than that is taken over."""
+        path = os.path.join(self.claims_path, chunk_id)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if steal_after is None or self.is_done(chunk_id):
+                return False
+            try:
+                if time.time() - os.path.getmtime(path) < steal_after:
+                    return False
+                os.rename(path, f"{path}.{worker_id}.stale") # fails for all stealers but one
+            except FileNotFoundError:
+                return False
+            return self.claim(chunk_id, worker_id)
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_id)
+        return True
+
+def completed_tokens(shards):
+    completed = set()
+    for path in shards.checkpoint_paths():
+        checkpoint = InferenceCheckpoint(path)
+        completed |= checkpoint.completed_tokens()
+        checkpoint.close()
+    return completed
+
+def plan(shards, tokens, num_shards, method="hash", scenes=None, chunk_size=32):
+    """Add a round of chunks for the tokens without a valid result, returns the plan."""
+    previous = shards.load_plan()
+    rounds = previous["rounds"] if previous is not None else []
+    completed = completed_tokens(shards)
+    pending_tokens = [token for token in tokens if token not in completed]
+    if len(rounds) > 0 and not all(shards.is_done(chunk["id"]) for chunk in rounds[-1]):
+        print("The last round is not finished, keeping it")
+        return previous
+    shard_tokens = [[] for _ in range(num_shards)]
+    for token, shard in zip(pending_tokens, partition(pending_tokens, num_shards, method, scenes)):
+        shard_tokens[shard].append(token)
+    chunks = []
+    for shard, tokens_of_shard in enumerate(shard_tokens):
+        for start in range(0, len(tokens_of_shard), chunk_size):
+            chunk_id = f"r{len(rounds)}-s{shard:03d}-c{start // chunk_size:05d}"
+            chunks.append({"id": chunk_id, "shard": shard, "tokens": tokens_of_shard[start:start+chunk_size]})
+    if len(chunks) > 0:
+        rounds.append(chunks)
+    new_plan = {"num_shards": num_shards, "partition": method, "tokens": tokens, "rounds": rounds}
+    shards.save_plan(new_plan)
+    print(f"Planned {len(pending_tokens)} tokens in {len(chunks)} chunks over {num_shards} shards, {len(completed)} tokens already done")
+    return new_plan
+
+def next_chunk(shards, chunks, shard, worker_id, steal_after):
+    """Own chunks, then unclaimed chunks of other shards, then stragglers. None when nothing is claimable now."""
+    own = [chunk for chunk in chunks if chunk["shard"] == shard]
+    others = [chunk for chunk in chunks if chunk["shard"] != shard]
+    for chunk in own + others:
+        if not shards.is_done(chunk["id"]) and shards.claim(chunk["id"], worker_id):
+            return chunk
+    for chunk in own + others:
+        if not shards.is_done(chunk["id"]) and shards.claim(chunk["id"], worker_id, steal_after=steal_after):
+            print(f"Stealing {chunk['id']}")
+            return chunk
+    return None
+
+def worker_limit(limit, num_shards):
+    """Share of a worker in a rate limit of all workers together, never rounded down to 0, which would disable it."""
+    return max(1, limit // num_shards) if limit > 0 else limit
+
+async def work(shards, args, shard, worker_id):
+    """
+    Process chunks until every chunk of the last round is done.
+    All chunks run in one event loop, which the rate limiter of the worker is bound to.
+    """
+    current_plan = shards.load_plan()
+    if current_plan is None or len(current_plan["rounds"]) == 0:
+        print("Nothing to do, run plan first")
+        return
+    chunks = current_plan["rounds"][-1]
+    num_shards = current_plan["num_shards"]
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    all_tokens = [token for chunk in chunks for token in chunk["tokens"]]
+
+    checkpoint = InferenceCheckpoint(os.path.join(shards.path, worker_id + ".db"))
+    cache = ResponseCache(args.cache) if args.cache else None
+    counter = TokenCounter("gpt-3.5-turbo")
+    limiter = RateLimiter(rpm=worker_limit(args.rpm, num_shards), tpm=worker_limit(args.tpm, num_shards))
+    backend = get_backend(args.backend, api_base=args.api_base, data=data, tokens=all_tokens, counter=counter, encoding=args.encoding)
+    sampler = SelfConsistency(encoding=args.encoding)
+    index = load_spatial_index(data) if args.max_objects is not None else None
+    usage = TokenUsage()
+    num_chunks = 0
+    while not all(shards.is_done(chunk["id"]) for chunk in chunks):
+        chunk = next_chunk(shards, chunks, shard, worker_id, args.steal_after)
+        if chunk is None: # the rest is claimed by other workers, wait for them or until they become stragglers
+            await asyncio.sleep(args.poll_interval)
+            continue
+        requests = build_requests(data, chunk["tokens"], split["train"], counter, completed_tokens=checkpoint.completed_tokens(), encoding=args.encoding, max_objects=args.max_objects, index=index)
+        await run_inference(requests, args.id, limiter, concurrency=args.concurrency, checkpoint=checkpoint, usage=usage,
+            cache=cache, backend=backend, sampler=sampler)
+        shards.mark_done(chunk["id"], worker_id)
+        num_chunks += 1
+    print(f"#### Worker {worker_id}: {num_chunks} chunks ####")
+    usage.summary(args.id)
+    if cache is not None:
+        cache.close()
+    checkpoint.close()
+
+def merge(shards, saved_traj_name, saved_text_name):
+    """
+    Combine the worker checkpoints into the final pickles, a valid trajectory wins over an invalid or failed attempt
+    of another worker. Both pickles are written to temporary files first and renamed into place.
+    """
+    tokens = shards.load_plan()["tokens"]
+    text_dict, traj_dict = {}, {}
+    for path in shards.checkpoint_paths():
+        checkpoint = InferenceCheckpoint(path)
+        worker_text_dict, worker_traj_dict = checkpoint.load()
+        checkpoint.close()
+        for token, text in worker_text_dict.items():
+            if token in worker_traj_dict:
+                traj_dict[token] = worker_traj_dict[token]
+                text_dict[token] = text
+            elif token not in traj_dict:
+                text_dict[token] = text
+    text_dict = {token: text_dict[token] for token in tokens if token in text_dict}
+    traj_dict = {token: traj_dict[token] for token in tokens if token in traj_dict}
+    for name, result in [(saved_text_name, text_dict), (saved_traj_name, traj_dict)]:
+        with open(name + ".tmp", "wb") as f:
+            pickle.dump(result, f)
+        os.replace(name + ".tmp", name)
+    print(f"#### Merged {len(traj_dict)} / {len(tokens)} tokens, {len(tokens) - len(traj_dict)} missing ####")
+    return text_dict, traj_dict
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT-Driver sharded test over several workers.")
+    parser.add_argument("mode", type=str, choices=["plan", "work", "merge", "run"], help="see distributed_inference.py")
+    parser.add_argument("-i", "--id", type=str, default="gpt-3.5-turbo", help="GPT model id, latest for the last model of finetune.py")
+    parser.add_argument("-o", "--output", type=str, help="output file name")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split to run")
+    parser.add_argument("-n", "--num_shards", type=int, default=4, help="number of shards, one worker each")
+    parser.add_argument("--partition", type=str, default="hash", choices=["hash", "contiguous", "scene"], help="token to shard assignment")
+    parser.add_argument("--scenes", type=str, default=None, help="JSON {token: scene} for --partition scene")
+    parser.add_argument("--chunk_size", type=int, default=32, help="tokens per claimable chunk")
+    parser.add_argument("--shard", type=int, default=0, help="shard of this worker")
+    parser.add_argument("--worker_id", type=str, default=None, help="worker name, defaults to <host>-<shard>")
+    parser.add_argument("--steal_after", type=float, default=600.0, help="seconds after which an unfinished chunk is run again by an idle worker")
+    parser.add_argument("--poll_interval", type=float, default=5.0, help="seconds between claim attempts of an idle worker")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight per worker")
+    parser.add_argument("--rpm", type=int, default=3500, help="requests-per-minute limit of all workers together")
+    parser.add_argument("--tpm", type=int, default=90000, help="tokens-per-minute limit of all workers together")
+    parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache, use a local path per host on a network file system, empty to disable")
+    parser.add_argument("--backend", type=str, default="openai", choices=["openai", "mock"], help="OpenAI API, or ground truth answers in-process")
+    parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+    parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding the model was fine-tuned on")
+    parser.add_argument("--max_objects", type=int, default=None, help="list at most this many objects per prompt, nearest first, as the fine-tuning data")
+    args = parser.parse_args()
+    args.id = resolve_model_id(args.id)
+
+    openai.api_key = "" # insert your API key here
+
+    shards = ShardDirectory("outputs/" + args.output + "_shards")
+    saved_traj_name = "outputs/" + args.output + ".pkl"
+    saved_text_name = "outputs/" + args.output + "_text.pkl"
+
+    if args.mode in ("plan", "run"):
+        split = json.load(open('data/split.json', 'r'))
+        scenes = json.load(open(args.scenes, 'r')) if args.scenes else None
+        plan(shards, split[args.split], args.num_shards, args.partition, scenes, args.chunk_size)
+    if args.mode == "work":
+        asyncio.run(work(shards, args, args.shard, args.worker_id or f"{socket.gethostname()}-{args.shard}"))
+    if args.mode == "run":
+        worker_args = sys.argv[1:]
+        worker_args.remove("run")
+        workers = [
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "work", "--shard", str(shard)] + worker_args)
+            for shard in range(shards.load_plan()["num_shards"])
+        ]
+        for worker in workers:
+            worker.wait()
+    if args.mode in ("merge", "run"):
+        merge(shards, saved_traj_name, saved_text_name)
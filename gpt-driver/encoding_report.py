@@ -0,0 +1,55 @@
+import json
+import argparse
+import numpy as np
+from prompt_message import SYSTEM_MESSAGES, generate_user_messages, generate_assistant_messages
+from compact_encoding import ENCODINGS, POSITION_SCALE, decode_user_message, decode_trajectories
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter, estimate_cost
+
+"""
+Tokens per fine-tuning record of each prompt encoding on a split, and the round-trip error of the compact one.
+"""
+
+def count_tokens(data, tokens, counter, encoding, traj_only=False):
+    """Returns (system, user, assistant) token totals of the records of `tokens`."""
+    user_messages = generate_user_messages(data, tokens, encoding=encoding)
+    assitant_messages = generate_assistant_messages(data, tokens, traj_only=traj_only, encoding=encoding)
+    return (
+        counter.count(SYSTEM_MESSAGES[encoding]) * len(tokens),
+        sum(counter.count_batch(user_messages)),
+        sum(counter.count_batch(assitant_messages)),
+    )
+
+def round_trip_errors(data, tokens):
+    """Largest absolute errors in meters of the decoded compact history and trajectories."""
+    user_messages = generate_user_messages(data, tokens, encoding="compact")
+    histories = np.stack([decode_user_message(user_message)["history"] for user_message in user_messages])
+    trajs, _ = decode_trajectories(generate_assistant_messages(data, tokens, traj_only=True, encoding="compact"))
+    gt_histories = np.stack([data[token]['gt_ego_his_trajs'][:4] for token in tokens])
+    gt_trajs = np.stack([data[token]['gt_ego_fut_trajs'][1:7] for token in tokens])
+    return np.abs(histories - gt_histories).max(), np.abs(trajs - gt_trajs).max()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Token counts of the prompt encodings.")
+    parser.add_argument("-s", "--split", type=str, default="train", help="split to measure")
+    parser.add_argument("--traj_only", action="store_true", help="trajectory-only assistant messages without chain of thoughts")
+    args = parser.parse_args()
+
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    tokens = split[args.split]
+    counter = TokenCounter("gpt-3.5-turbo")
+
+    print(f"#### {len(tokens)} {args.split} records ####")
+    totals = {}
+    for encoding in ENCODINGS:
+        num_system, num_user, num_assistant = count_tokens(data, tokens, counter, encoding, traj_only=args.traj_only)
+        totals[encoding] = (num_system, num_user, num_assistant)
+        print(f"{encoding}: system {num_system / len(tokens):.0f}, user {num_user / len(tokens):.1f}, assistant {num_assistant / len(tokens):.1f} tokens per record, "
+            f"fine-tuning cost {estimate_cost('fine-tune', num_system + num_user + num_assistant):.2f} USD per epoch")
+    for name, i in [("system", 0), ("user", 1), ("assistant", 2)]:
+        print(f"{name} tokens: -{100 * (1 - totals['compact'][i] / max(totals['text'][i], 1)):.1f} %")
+    print(f"prompt tokens: -{100 * (1 - sum(totals['compact'][:2]) / max(sum(totals['text'][:2]), 1)):.1f} %")
+    print(f"total tokens: -{100 * (1 - sum(totals['compact']) / max(sum(totals['text']), 1)):.1f} %")
+    history_error, traj_error = round_trip_errors(data, tokens)
+    print(f"Max round-trip error: history {history_error:.3f} m, trajectory {traj_error:.3f} m (quantization {0.5 / POSITION_SCALE:.2f} m)")
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import pickle
+import warnings
+import argparse
+import numpy as np
+from prompt_message import pad_objects
+from nuscenes_cache import load_nuscenes_info
+
+"""
+Open-loop planning metrics of the predicted trajectories (outputs/*.pkl, {token: [6, 2]}):
+    L2: distance between the planned and the ground-truth ego waypoints
+    collision rate: ratio of samples where the ego box at a planned waypoint overlaps a ground-truth object box
+      at the same timestep, with the objects moved along gt_agent_fut_trajs
+Both are reported at 1s, 2s and 3s, either averaged over the timesteps up to the horizon (stp3)
+or at the horizon only (uniad).
+Boxes are (x, y) centers with sizes along their axes before a rotation by yaw, as the boxes of the info files.
+"""
+
+EGO_SIZE = (1.85, 4.084) # width along x and length along y when heading forward, as the ego box of prompt_message
+HORIZONS = {"1s": 2, "2s": 4, "3s": 6} # number of 0.5s timesteps
+
+def load_predictions(filename):
+    traj_dict = pickle.load(open(filename, 'rb'))
+    tokens = list(traj_dict)
+    trajs = np.stack([np.asarray(traj_dict[token], dtype=np.float64).reshape(6, 2) for token in tokens]) if tokens else np.zeros((0, 6, 2))
+    return tokens, trajs
+
+def l2_errors(trajs, gt_trajs, masks):
+    """[N, 6] L2 errors, NaN at the timesteps without ground truth."""
+    errors = np.linalg.norm(trajs - gt_trajs, axis=-1)
+    return np.where(masks > 0, errors, np.nan)
+
+def trajectory_yaws(trajs, min_step=0.1):
+    """[..., T] yaws of the ego box along a trajectory starting at the origin, keeping the previous yaw when (almost) not moving."""
+    steps = np.diff(np.concatenate([np.zeros_like(trajs[..., :1, :]), trajs], axis=-2), axis=-2)
+    moving = np.linalg.norm(steps, axis=-1) > min_step
+    yaws = np.arctan2(steps[..., 1], steps[..., 0]) - np.pi / 2 # 0 when heading forward (+y)
+    last_moving = np.maximum.accumulate(np.where(moving, np.arange(moving.shape[-1]), -1), axis=-1)
+    yaws = np.take_along_axis(yaws, np.maximum(last_moving, 0), axis=-1)
+    return np.where(last_moving >= 0, yaws, 0.0)
+
+def box_overlaps(centers1, yaws1, sizes1, centers2, yaws2, sizes2):
+    """
+    Broadcasting overlap test of rotated boxes by the separating axis theorem.
+    centers: [..., 2], yaws: [...], sizes: [..., 2]
+    """
+    axes1 = np.stack([np.cos(yaws1), np.sin(yaws1)], axis=-1)
+    axes2 = np.stack([np.cos(yaws2), np.sin(yaws2)], axis=-1)
+    normals1 = np.stack([-axes1[..., 1], axes1[..., 0]], axis=-1)
+    normals2 = np.stack([-axes2[..., 1], axes2[..., 0]], axis=-1)
+    half1, half2 = sizes1 * 0.5, sizes2 * 0.5
+    offsets = centers2 - centers1
+    overlaps = True
+    for axis in (axes1, normals1, axes2, normals2):
+        radius1 = half1[..., 0] * np.abs((axes1 * axis).sum(-1)) + half1[..., 1] * np.abs((normals1 * axis).sum(-1))
+        radius2 = half2[..., 0] * np.abs((axes2 * axis).sum(-1)) + half2[..., 1] * np.abs((normals2 * axis).sum(-1))
+        overlaps = overlaps & (np.abs((offsets * axis).sum(-1)) <= radius1 + radius2)
+    return overlaps
+
+def collisions(data, tokens, trajs, batch_size=1024):
+    """
+    [N, 6] True where the ego box at trajs[:, t] overlaps an object box at timestep t.
+    trajs may hold several candidates per token, [N, S, 6, 2] gives [N, S, 6].
+    """
+    results = np.zeros(trajs.shape[:-1], dtype=bool)
+    for start in range(0, len(tokens), batch_size):
+        data_dicts = [data[token] for token in tokens[start:start+batch_size]]
+        ego_trajs = trajs[start:start+batch_size]
+        batch_shape = ego_trajs.shape[:-2]
+        ego_trajs = ego_trajs.reshape(len(data_dicts), -1, 6, 2) # [B, S, 6, 2]
+        object_boxes, object_rel_fut_trajs, object_fut_mask, object_sizes, object_valid = pad_objects(data_dicts)
+        object_yaws = np.zeros(object_valid.shape)
+        object_yaws[object_valid] = np.concatenate([d['gt_boxes'][:, 6] for d in data_dicts])
+        object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None, :] # [B, N, 6, 2]
+        overlaps = box_overlaps(
+            ego_trajs[:, :, None], trajectory_yaws(ego_trajs)[:, :, None], np.array(EGO_SIZE),
+            object_fut_trajs[:, None], object_yaws[:, None, :, None], object_sizes[:, None, :, None],
+        ) # [B, S, N, 6]
+        overlaps &= ((object_fut_mask > 0) & object_valid[..., None])[:, None]
+        results[start:start+batch_size] = overlaps.any(axis=2).reshape(batch_shape + (6,))
+    return results
+
+def evaluate(data, tokens, trajs, metric="stp3"):
+    """Returns the report {"L2": {horizon: m}, "collision": {horizon: %}, "num_samples": N}."""
+    gt_trajs = np.stack([data[token]['gt_ego_fut_trajs'][1:7] for token in tokens]).astype(np.float64) if tokens else np.zeros((0, 6, 2))
+    gt_masks = np.stack([data[token]['gt_ego_fut_masks'] for token in tokens]) if tokens else np.zeros((0, 6))
+    errors = l2_errors(trajs, gt_trajs, gt_masks)
+    collided = np.where(gt_masks > 0, collisions(data, tokens, trajs), np.nan)
+
+    report = {"L2": {}, "collision": {}}
+    for name, num_steps in HORIZONS.items():
+        if metric == "stp3":
+            steps = slice(0, num_steps)
+        else:
+            steps = slice(num_steps - 1, num_steps)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # NaN for a horizon without ground truth
+            report["L2"][name] = float(np.nanmean(np.nanmean(errors[:, steps], axis=0)))
+            report["collision"][name] = float(np.nanmean(np.nanmean(collided[:, steps], axis=0))) * 100
+    report["L2"]["avg"] = float(np.mean([report["L2"][name] for name in HORIZONS]))
+    report["collision"]["avg"] = float(np.mean([report["collision"][name] for name in HORIZONS]))
+    report["num_samples"] = len(tokens)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open-loop evaluation of planned trajectories.")
+    parser.add_argument("-i", "--input", type=str, help="predictions, e.g. outputs/your_output_file_name.pkl")
+    parser.add_argument("-o", "--output", type=str, default=None, help="JSON report, defaults to the input name with _eval.json")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split to evaluate")
+    parser.add_argument("-m", "--metric", type=str, default="stp3", choices=["stp3", "uniad"], help="average up to the horizon or value at the horizon")
+    args = parser.parse_args()
+
+    start = time.time()
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    tokens, trajs = load_predictions(args.input)
+    split_tokens = set(split[args.split])
+    keep = [i for i, token in enumerate(tokens) if token in split_tokens]
+    tokens, trajs = [tokens[i] for i in keep], trajs[keep]
+
+    report = evaluate(data, tokens, trajs, metric=args.metric)
+    report["metric"] = args.metric
+    report["num_missing"] = len(split_tokens) - len(tokens)
+    print("#### Evaluation ####")
+    print(f"Samples: {report['num_samples']} (missing: {report['num_missing']})")
+    for name in list(HORIZONS) + ["avg"]:
+        print(f"{name}: L2 {report['L2'][name]:.2f} m, collision {report['collision'][name]:.2f} %")
+    print(f"Evaluated in {time.time() - start:.2f}s")
+
+    output = args.output if args.output is not None else os.path.splitext(args.input)[0] + "_eval.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
@@ -1,20 +1,282 @@
+import os
+import json
+import asyncio
+import hashlib
+import argparse
+import aiohttp
 import openai
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from token_counter import TokenCounter, TokenUsage
 
-openai.api_key = "" # insert your API key here
+"""
+Fine-tuning orchestrator:
+    1. validate: one streaming pass over the NDJSON checks the chat format of every record, counts its tokens,
+       hashes the file and cuts it into parts of at most max_file_mb (and max_file_tokens)
+    2. upload: every part is uploaded once, a file with the same content hash in its name is reused
+    3. train: one job per part, each one continuing from the model of the previous part
+    4. wait: job status and events are polled asynchronously, the interval grows while nothing happens
+The state of every run is kept in outputs/finetune.json, so an interrupted run resumes its jobs,
+and the resulting model id is recorded there for the inference runners (-i latest).
+Pass --api_base http://localhost:8765/v1 to run against mock_server.py.
+"""
 
-response = openai.File.create(file=open("train.json", "r"), purpose='fine-tune')
-print(response)
-train_file_id = response["id"]
+ROLES = ("system", "user", "assistant")
+FINAL_STATUSES = ("succeeded", "failed", "cancelled")
+STATE_NAME = "outputs/finetune.json"
 
-response = openai.FineTuningJob.create(training_file=train_file_id, model="gpt-3.5-turbo", hyperparameters={"n_epochs":1, })
-print(response)
-finetune_job_id = response["id"]
+def _record_error(record):
+    """Why a parsed line is not a valid chat fine-tuning example, or None."""
+    if not isinstance(record, dict) or not isinstance(record.get("messages"), list) or len(record["messages"]) == 0:
+        return "no messages"
+    for message in record["messages"]:
+        if not isinstance(message, dict) or message.get("role") not in ROLES:
+            return "unknown role"
+        if not isinstance(message.get("content"), str):
+            return "content is not a string"
+    if not any(message["role"] == "assistant" for message in record["messages"]):
+        return "no assistant message"
+    return None
 
-# List 10 fine-tuning jobs
-openai.FineTuningJob.list(limit=10)
+def validate(path, counter, max_file_mb=512, max_file_tokens=None, max_example_tokens=4096, chunk_size=1024):
+    """
+    Check and count the records of an NDJSON file in one streaming pass.
+    Token counts follow the chat format: the contents plus 3 tokens per message and 3 for the reply.
+    Returns a dict with the sha256 of the file, the usage, the parts [{start, end, num_records, num_tokens, sha256}]
+    as byte ranges of whole records, the errors [(line, reason)] and the examples longer than max_example_tokens.
+    """
+    max_bytes = int(max_file_mb * 1024 * 1024)
+    file_hash = hashlib.sha256()
+    usage = TokenUsage()
+    parts, errors, long_examples = [], [], []
+    part = None
+    chunk = [] # (line number, start, end, record)
 
-# Retrieve the state of a fine-tune
-openai.FineTuningJob.retrieve(finetune_job_id)
+    def flush():
+        nonlocal part
+        if len(chunk) == 0:
+            return
+        messages = [message for _, _, _, record in chunk for message in record["messages"]]
+        counts = iter(counter.count_batch([message["content"] for message in messages]))
+        for line_number, start, end, record in chunk:
+            num_tokens = 3
+            for message in record["messages"]:
+                num_message_tokens = next(counts)
+                num_tokens += num_message_tokens + 3
+                usage.add(**{message["role"]: num_message_tokens})
+            if num_tokens > max_example_tokens:
+                long_examples.append((line_number, num_tokens))
+            if part is not None and (end - part["start"] > max_bytes or (max_file_tokens is not None and part["num_tokens"] + num_tokens > max_file_tokens)):
+                parts.append(part)
+                part = None
+            if part is None:
+                part = {"start": start, "end": start, "num_records": 0, "num_tokens": 0, "hash": hashlib.sha256()}
+            part["end"] = end
+            part["num_records"] += 1
+            part["num_tokens"] += num_tokens
+            part["hash"].update(record["line"])
+        chunk.clear()
 
-# List up to 10 events from a fine-tuning job
-openai.FineTuningJob.list_events(id=finetune_job_id, limit=10)
\ No newline at end of file
+    offset = 0
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            start, offset = offset, offset + len(line)
+            file_hash.update(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                errors.append((line_number, "invalid JSON"))
+                continue
+            reason = _record_error(record)
+            if reason is not None:
+                errors.append((line_number, reason))
+                continue
+            chunk.append((line_number, start, offset, {"messages": record["messages"], "line": line}))
+            if len(chunk) >= chunk_size:
+                flush()
+    flush()
+    if part is not None:
+        parts.append(part)
+    for part in parts:
+        part["sha256"] = part.pop("hash").hexdigest()
+    return {"sha256": file_hash.hexdigest(), "usage": usage, "parts": parts, "errors": errors, "long_examples": long_examples}
+
+def _transient(exception):
+    """Rate limits, server errors and connection problems are retried, client errors are not."""
+    if isinstance(exception, aiohttp.ClientResponseError):
+        return exception.status == 429 or exception.status >= 500
+    return isinstance(exception, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class FineTuneClient:
+    """Files and fine-tuning jobs endpoints over aiohttp, against api_base, e.g. http://localhost:8765/v1 for mock_server.py."""
+    def __init__(self, session, api_base=None, api_key=None):
+        self.session = session
+        self.api_base = (api_base or openai.api_base).rstrip("/")
+        self.headers = {"Authorization": "Bearer " + (api_key or openai.api_key or "")}
+
+    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), retry=retry_if_exception(_transient))
+    async def _request(self, method, path, **kwargs):
+        async with self.session.request(method, self.api_base + path, headers=self.headers, **kwargs) as response:
+            if response.status != 200:
+                text = await response.text()
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=text)
+            return await response.json()
+
+    async def list_files(self, purpose="fine-tune"):
+        return [file for file in (await self._request("GET", "/files"))["data"] if file.get("purpose") == purpose]
+
+    async def upload(self, content, filename, purpose="fine-tune"):
+        form = aiohttp.FormData()
+        form.add_field("purpose", purpose)
+        form.add_field("file", content, filename=filename, content_type="application/jsonl")
+        return await self._request("POST", "/files", data=form)
+
+    async def create_job(self, training_file, model, hyperparameters=None, suffix=None):
+        body = {"training_file": training_file, "model": model}
+        if hyperparameters:
+            body["hyperparameters"] = hyperparameters
+        if suffix:
+            body["suffix"] = suffix
+        return await self._request("POST", "/fine_tuning/jobs", json=body)
+
+    async def get_job(self, job_id):
+        return await self._request("GET", "/fine_tuning/jobs/" + job_id)
+
+    async def list_events(self, job_id, limit=20):
+        return (await self._request("GET", f"/fine_tuning/jobs/{job_id}/events", params={"limit": limit}))["data"]
+
+async def upload_part(client, path, part, name):
+    """The id of the uploaded part, uploading it only if no file of the same content was uploaded before."""
+    filename = f"{name}-{part['sha256'][:16]}.jsonl"
+    for file in await client.list_files():
+        if file["filename"] == filename and file["bytes"] == part["end"] - part["start"] and file.get("status") != "error":
+            print(f"Reusing {file['id']} for {filename}")
+            return file["id"]
+    with open(path, "rb") as f:
+        f.seek(part["start"])
+        content = f.read(part["end"] - part["start"])
+    file = await client.upload(content, filename)
+    print(f"Uploaded {filename} as {file['id']} ({len(content) / 1024 / 1024:.1f} MB)")
+    return file["id"]
+
+async def wait_job(client, job_id, poll_interval=10.0, max_poll_interval=300.0):
+    """
+    Poll a job and print its new events until it reaches a final status, returns the job.
+    The interval grows by half every poll without news up to max_poll_interval, and is reset by a status change or an event.
+    """
+    seen_events = set()
+    status = None
+    interval = poll_interval
+    while True:
+        job, events = await asyncio.gather(client.get_job(job_id), client.list_events(job_id))
+        new_events = [event for event in reversed(events) if event["id"] not in seen_events] # the API lists the newest first
+        for event in new_events:
+            seen_events.add(event["id"])
+            print(f"{job_id}: {event['message']}")
+        if job["status"] != status:
+            status = job["status"]
+            print(f"{job_id}: {status}")
+        if status in FINAL_STATUSES:
+            return job
+        interval = poll_interval if len(new_events) > 0 else min(interval * 1.5, max_poll_interval)
+        await asyncio.sleep(interval)
+
+def load_state(state_name=STATE_NAME):
+    if os.path.exists(state_name):
+        return json.load(open(state_name, "r"))
+    return {"runs": {}, "latest": None}
+
+def save_state(state, state_name=STATE_NAME):
+    with open(state_name + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_name + ".tmp", state_name)
+
+def resolve_model_id(model_id, state_name=STATE_NAME):
+    """"latest" is the model of the last successful run of finetune.py, other ids are returned as is."""
+    if model_id != "latest":
+        return model_id
+    latest = load_state(state_name)["latest"]
+    if latest is None:
+        raise ValueError(f"No fine-tuned model recorded in {state_name}")
+    return latest
+
+async def finetune(path, model="gpt-3.5-turbo", n_epochs=1, suffix=None, api_base=None, counter=None, max_file_mb=512, max_file_tokens=None,
+        poll_interval=10.0, max_poll_interval=300.0, state_name=STATE_NAME):
+    """Validate, upload and train on the NDJSON file at `path`, returns the fine-tuned model id."""
+    if counter is None:
+        counter = TokenCounter("gpt-3.5-turbo")
+    report = validate(path, counter, max_file_mb=max_file_mb, max_file_tokens=max_file_tokens)
+    print(f"#### {path} ####")
+    print(f"Records: {sum(part['num_records'] for part in report['parts'])}, invalid: {len(report['errors'])}, "
+        f"longer than the context: {len(report['long_examples'])}, parts: {len(report['parts'])}")
+    report["usage"].summary("fine-tune")
+    if len(report["errors"]) > 0:
+        for line_number, reason in report["errors"][:10]:
+            print(f"line {line_number}: {reason}")
+        raise ValueError(f"{len(report['errors'])} invalid records in {path}")
+    for line_number, num_tokens in report["long_examples"][:10]:
+        print(f"line {line_number}: {num_tokens} tokens, truncated by the API")
+
+    # one run per content of the parts, model and hyperparameters, resumed if it was interrupted
+    state = load_state(state_name)
+    parts_hash = hashlib.sha256("".join(part["sha256"] for part in report["parts"]).encode("utf-8")).hexdigest()
+    run_key = f"{parts_hash}:{model}:{n_epochs}:{suffix}"
+    run = state["runs"].setdefault(run_key, {"path": path, "parts": [{"sha256": part["sha256"]} for part in report["parts"]], "model": None})
+    name = os.path.splitext(os.path.basename(path))[0]
+    async with aiohttp.ClientSession() as session:
+        client = FineTuneClient(session, api_base=api_base)
+        base_model = model
+        for part, part_state in zip(report["parts"], run["parts"]):
+            if part_state.get("model") is None:
+                if part_state.get("job_id") is None:
+                    part_state["file_id"] = await upload_part(client, path, part, name)
+                    job = await client.create_job(part_state["file_id"], base_model, {"n_epochs": n_epochs}, suffix)
+                    part_state["job_id"] = job["id"]
+                    save_state(state, state_name)
+                    print(f"Created {job['id']} on {base_model}")
+                job = await wait_job(client, part_state["job_id"], poll_interval, max_poll_interval)
+                if job["status"] != "succeeded":
+                    part_state["job_id"] = None # a new job is created by the next run
+                    save_state(state, state_name)
+                    raise RuntimeError(f"Fine-tuning job {job['id']} {job['status']}: {job.get('error')}")
+                part_state["model"] = job["fine_tuned_model"]
+                save_state(state, state_name)
+            base_model = part_state["model"]
+    run["model"] = base_model
+    state["latest"] = base_model
+    save_state(state, state_name)
+    print(f"Fine-tuned model: {base_model}")
+    return base_model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fine-tune a GPT model on an NDJSON file of chat records.")
+    parser.add_argument("-i", "--input", type=str, default="data/train.json", help="NDJSON training file, e.g. written by create_data.py")
+    parser.add_argument("-m", "--model", type=str, default="gpt-3.5-turbo", help="base model")
+    parser.add_argument("--n_epochs", type=int, default=1, help="epochs of every job")
+    parser.add_argument("--suffix", type=str, default=None, help="suffix of the fine-tuned model id")
+    parser.add_argument("--max_file_mb", type=float, default=512, help="larger files are split into parts trained one after the other")
+    parser.add_argument("--max_file_tokens", type=int, default=None, help="split the file into parts of at most this many tokens as well")
+    parser.add_argument("--poll_interval", type=float, default=10.0, help="first polling interval in seconds")
+    parser.add_argument("--max_poll_interval", type=float, default=300.0, help="longest polling interval in seconds")
+    parser.add_argument("--validate_only", action="store_true", help="only validate and count the tokens of the file")
+    parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+    args = parser.parse_args()
+
+    openai.api_key = "" # insert your API key here
+
+    if args.validate_only:
+        report = validate(args.input, TokenCounter("gpt-3.5-turbo"), max_file_mb=args.max_file_mb, max_file_tokens=args.max_file_tokens)
+        print(f"Records: {sum(part['num_records'] for part in report['parts'])}, invalid: {len(report['errors'])}, "
+            f"longer than the context: {len(report['long_examples'])}, parts: {len(report['parts'])}, sha256: {report['sha256']}")
+        for line_number, reason in report["errors"][:10]:
+            print(f"line {line_number}: {reason}")
+        report["usage"].summary("fine-tune")
+    else:
+        asyncio.run(finetune(args.input, args.model, args.n_epochs, args.suffix, api_base=args.api_base, max_file_mb=args.max_file_mb,
+            max_file_tokens=args.max_file_tokens, poll_interval=args.poll_interval, max_poll_interval=args.max_poll_interval))
@@ -0,0 +1,138 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+from collections.abc import Mapping
+from prompt_message import generate_incontext_messages
+from dataset_cache import dependencies, code_hash, source_stats
+import dataset_builder
+
+"""
+Packed cache of rendered in-context examples, one directory per prompt variant:
+    meta.json: train tokens, variant and key, the hash of the rendering code, the parameters and the size and time of the info files,
+        see dataset_cache.py
+    text.bin: UTF-8 examples concatenated in token order
+    offsets.npy: [T+1] byte offsets into text.bin
+    num_tokens.npy: [T] tiktoken count of every example
+"""
+
+VARIANTS = {
+    "cot": {"traj_only": False}, # generate_incontext_message
+    "traj_only": {"traj_only": True},
+}
+
+INCONTEXT_CODE = dependencies([generate_incontext_messages])
+
+def incontext_key(variant="cot", perception="gt"):
+    """Key of the examples rendered by the current code from the current info files, a cache with another key is stale."""
+    return code_hash(INCONTEXT_CODE, perception=perception, sources=source_stats(perception), **VARIANTS[variant])
+
+def _render_shard(args):
+    tokens, variant = args
+    messages = generate_incontext_messages(dataset_builder._data, tokens, **VARIANTS[variant])
+    return messages, dataset_builder._counter.count_batch(messages)
+
+def build_incontext_cache(tokens, cache_dir, variant="cot", perception="gt", num_workers=None, shard_size=256):
+    """Render and count the examples of `tokens` on a process pool, in the same way as dataset_builder.build_dataset."""
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if multiprocessing.get_start_method() == "fork" or num_workers <= 1:
+        dataset_builder._data = dataset_builder.load_data(perception)
+    shards = [(tokens[i:i+shard_size], variant) for i in range(0, len(tokens), shard_size)]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    offsets, num_tokens = [0], []
+    with open(os.path.join(cache_dir, "text.bin"), "wb") as f:
+        if num_workers <= 1:
+            dataset_builder._init_worker(perception)
+            results = map(_render_shard, shards)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(num_workers, initializer=dataset_builder._init_worker, initargs=(perception,))
+            results = pool.imap(_render_shard, shards)
+        for messages, counts in results:
+            for message in messages:
+                encoded = message.encode("utf-8")
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            num_tokens.extend(counts)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    np.save(os.path.join(cache_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(cache_dir, "num_tokens.npy"), np.array(num_tokens, dtype=np.int64))
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump({"tokens": list(tokens), "variant": variant, "key": incontext_key(variant, perception)}, f)
+
+class IncontextCache(Mapping):
+    """Memory-mapped in-context examples, cache[token] is the rendered example and cache.num_tokens(token) its token count."""
+    def __init__(self, cache_dir):
+        meta = json.load(open(os.path.join(cache_dir, "meta.json"), "r"))
+        self.tokens = meta["tokens"]
+        self.variant = meta["variant"]
+        self.key = meta.get("key")
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy")).tolist()
+        self.counts = np.load(os.path.join(cache_dir, "num_tokens.npy")).tolist()
+        if self.offsets[-1] > 0:
+            self.text = np.memmap(os.path.join(cache_dir, "text.bin"), dtype=np.uint8, mode="r")
+        else: # np.memmap cannot map an empty file
+            self.text = np.zeros(0, dtype=np.uint8)
+
+    def __getitem__(self, token):
+        i = self.token_index[token]
+        return self.text[self.offsets[i]:self.offsets[i+1]].tobytes().decode("utf-8")
+
+    def num_tokens(self, token):
+        return self.counts[self.token_index[token]]
+
+    def __contains__(self, token):
+        return token in self.token_index
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+def load_incontext_cache(variant="cot", cache_root='data/incontext_cache', perception="gt"):
+    """
+    The packed examples of `variant`, or None if pack_incontext_dict.py --examples has not been run
+    or was run with other rendering code, parameters or info files.
+    """
+    cache_dir = os.path.join(cache_root, variant)
+    if not os.path.exists(os.path.join(cache_dir, "meta.json")):
+        return None
+    cache = IncontextCache(cache_dir)
+    if cache.key != incontext_key(variant, perception):
+        print(f"Ignoring the stale in-context cache {cache_dir}, rerun pack_incontext_dict.py --examples")
+        return None
+    return cache
+
+class IncontextExamples:
+    """In-context examples and their token counts, from the packed cache when possible and rendered on demand otherwise."""
+    def __init__(self, data, counter, variant="cot"):
+        self.data = data
+        self.counter = counter
+        self.variant = variant
+        self.cache = load_incontext_cache(variant)
+
+    def get(self, tokens):
+        """Returns (messages, num_tokens) of the examples of `tokens`."""
+        messages, num_tokens = [], []
+        missing = []
+        for token in tokens:
+            if self.cache is not None and token in self.cache:
+                messages.append(self.cache[token])
+                num_tokens.append(self.cache.num_tokens(token))
+            else:
+                messages.append(None)
+                num_tokens.append(None)
+                missing.append(token)
+        if len(missing) > 0:
+            rendered = dict(zip(missing, generate_incontext_messages(self.data, missing, **VARIANTS[self.variant])))
+            for i, token in enumerate(tokens):
+                if messages[i] is None:
+                    messages[i] = rendered[token]
+                    num_tokens[i] = self.counter.count(messages[i])
+        return messages, num_tokens
@@ -1,86 +1,129 @@
 import openai
-import pickle
 import json
-import ast
-import tiktoken
-import numpy as np
 import time
 import argparse
-from prompt_message import system_message, generate_user_message, generate_assistant_message, generate_incontext_message
+from prompt_message import generate_user_message_parts, generate_assistant_messages
+from nuscenes_cache import load_nuscenes_info
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from completion_backend import get_backend
+from trajectory_parser import parse_trajectory, REASONS
+from token_counter import TokenCounter
+from retrieval import load_or_build_index, sequential_examples
+from incontext_cache import IncontextExamples
+from prompt_packer import PromptPacker
+from metrics import Metrics, count_retry
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )  # for exponential backoff
  
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return openai.ChatCompletion.create(**kwargs)
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=count_retry)
+def completion_with_backoff(backend, metrics, **kwargs):
+    metrics.inc("api_calls")
+    with metrics.timer("api"):
+        return backend.complete(**kwargs)
 
 parser = argparse.ArgumentParser(description="GPT-Driver test.")
 parser.add_argument("-o", "--output", type=str, help="output file name")
+parser.add_argument("--selection", type=str, default="retrieval", choices=["retrieval", "sequential"], help="nearest train scenes or the train tokens token_index * 5 + i as examples")
+parser.add_argument("--budget", type=int, default=4096, help="prompt token budget, 16384 for gpt-3.5-turbo-16k")
+parser.add_argument("--max_cost", type=float, default=None, help="cap on the estimated USD cost of every request")
+parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache shared by the runs")
+parser.add_argument("--cache_size", type=float, default=1024, help="maximum size of the cached responses in MB")
+parser.add_argument("--refresh_cache", action="store_true", help="query the API even for cached prompts, as for the tokens the checkpoint records as invalid")
+parser.add_argument("--backend", type=str, default="openai", choices=["openai", "mock"], help="OpenAI API, or ground truth answers in-process")
+parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+parser.add_argument("--metrics", type=str, default=None, help="export stage timings and counters to this .jsonl or Prometheus .prom file")
+parser.add_argument("--metrics_interval", type=float, default=10.0, help="seconds between metrics exports")
 args = parser.parse_args()
 
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+counter = TokenCounter("gpt-3.5-turbo")
+packer = PromptPacker(counter, budget=args.budget, max_cost=args.max_cost, model="gpt-3.5-turbo", completion_tokens=256)
 
 saved_traj_name = "outputs/" + args.output + ".pkl"
 saved_text_name = "outputs/" + args.output + "_text.pkl"
 temp_text_name = "outputs/" + args.output + "_temp.jsonl"
+checkpoint_name = "outputs/" + args.output + ".db"
 
 openai.api_key = "" # insert your API key here
 
-data = pickle.load(open('data/cached_nuscenes_info.pkl', 'rb'))
+data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
 split = json.load(open('data/split.json', 'r'))
 
 train_tokens = split["train"]
 test_tokens = split["val"]
 
-text_dict, traj_dict = {}, {}
+# tokens with a valid result in the checkpoint are skipped, invalid and failed ones are retried
+checkpoint = InferenceCheckpoint(checkpoint_name)
+# identical prompts to the same model are answered from the cache without calling the API
+cache = ResponseCache(args.cache, max_size_mb=args.cache_size, refresh=args.refresh_cache)
+backend = get_backend(args.backend, api_base=args.api_base, data=data, tokens=test_tokens)
+# disabled without --metrics
+metrics = Metrics(args.metrics, interval=args.metrics_interval)
+completed_tokens = checkpoint.completed_tokens()
+pending_tokens = checkpoint.pending(test_tokens)
+retried_tokens = checkpoint.invalid_tokens()
+with metrics.timer("prompt"):
+    user_message_parts = generate_user_message_parts(data, pending_tokens)
+    assitant_messages = dict(zip(pending_tokens, generate_assistant_messages(data, pending_tokens)))
+with metrics.timer("count"):
+    user_counts = dict(zip(pending_tokens, packer.count_user_parts(user_message_parts)))
+user_message_parts = dict(zip(pending_tokens, user_message_parts))
 
 invalid_tokens = []
 
-untest_tokens = [
-]
-
 num_incontext_prompts = 5
+examples = IncontextExamples(data, counter)
+
+if args.selection == "retrieval":
+    with metrics.timer("retrieval"):
+        example_tokens = load_or_build_index(data, train_tokens).query_tokens(data, pending_tokens, k=num_incontext_prompts)
 
 for token_index, token in enumerate(test_tokens):
-    if len(untest_tokens) > 0 and token not in untest_tokens: 
+    if token in completed_tokens:
         continue
 
     print()
     print(token)
 
-    time.sleep(1)
-    incontext_message = ""
-    for i in range(num_incontext_prompts):
-        train_token_id = token_index * 5 + i
-        if train_token_id >= len(train_tokens):
-            train_token_id = train_token_id % len(train_tokens)
-        train_token = train_tokens[train_token_id]
-        incontext_message += generate_incontext_message(data, train_token)
-    system_incontext_message = system_message + incontext_message
-    user_message = generate_user_message(data, token)
-
-    num_system_tokens = len(encoding.encode(system_incontext_message))
-    num_user_tokens = len(encoding.encode(user_message))
-    if num_system_tokens + num_user_tokens > 4096: # overflow
-        system_incontext_message = system_message
-        num_system_tokens = len(encoding.encode(system_incontext_message))
-        if num_system_tokens + num_user_tokens > 4096: # overflow again
-            system_incontext_message = ""
-
-    assitant_message = generate_assistant_message(data, token)
+    if args.selection == "retrieval":
+        train_example_tokens = example_tokens[token]
+    else:
+        train_example_tokens = sequential_examples(token_index, train_tokens, num_incontext_prompts)
+    with metrics.timer("examples"):
+        incontext_messages, incontext_counts = examples.get(train_example_tokens)
+    # the most relevant examples and the nearest objects that fit in the budget
+    with metrics.timer("pack"):
+        system_incontext_message, user_message, _, _ = packer.pack(
+            user_message_parts[token], user_counts[token], incontext_messages, incontext_counts)
+
+    assitant_message = assitant_messages[token]
     # print(f"System:\n {system_incontext_message}")
-    completion = completion_with_backoff(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_incontext_message},
-            {"role": "user", "content": user_message},
-        ]
-    )
-    # import pdb; pdb.set_trace()
-    result = completion.choices[0].message["content"]
+    messages = [
+        {"role": "system", "content": system_incontext_message},
+        {"role": "user", "content": user_message},
+    ]
+    result = None
+    if token not in retried_tokens: # the cached answer of an invalid token is the invalid one
+        with metrics.timer("cache"):
+            result = cache.get("gpt-3.5-turbo", messages, **backend.cache_params)
+    if result is not None:
+        metrics.inc("cache_hits")
+    else:
+        time.sleep(1)
+        completion = completion_with_backoff(
+            backend,
+            metrics=metrics,
+            model="gpt-3.5-turbo",
+            messages=messages
+        )
+        # import pdb; pdb.set_trace()
+        result = completion.text
+        metrics.inc("prompt_tokens", completion.prompt_tokens)
+        metrics.inc("completion_tokens", completion.completion_tokens)
+        cache.put("gpt-3.5-turbo", messages, result, **backend.cache_params)
     print("#### Result ####")
     print(f"GPT  Planner:\n {result}")
     print(f"Ground Truth:\n {assitant_message}")
@@ -90,38 +133,29 @@ for token_index, token in enumerate(test_tokens):
         "GT": assitant_message, 
     }
 
-    text_dict[token] = result
-
-    traj = result.split("\n")[-1]
-    try:
-        traj = ast.literal_eval(traj)
-        traj = np.array(traj)
-    except:
-        print(f"Invalid token: {token}")
+    with metrics.timer("parse"):
+        traj, reason = parse_trajectory(result)
+    if traj is None:
+        print(f"Invalid token: {token} ({REASONS[reason]})")
         invalid_tokens.append(token)
+        metrics.inc("invalid")
+        checkpoint.record(token, "invalid", text=result)
         continue
-    traj_dict[token] = traj
+    checkpoint.record(token, "done", text=result, traj=traj)
 
     with open(temp_text_name, "a+") as file:
         file.write(json.dumps(output_dict) + '\n')
 
-    # output_dicts = []
-    # with open(temp_text_name, "r") as file:
-    #     for line in file:
-    #         output_dicts.append(json.loads(line))
-
-    if len(untest_tokens) > 0:
-        exist_dict = pickle.load(open(saved_traj_name, 'rb'))
-        exist_dict.update(traj_dict)
-        fd = open(saved_traj_name, "wb")
-        pickle.dump(exist_dict, fd)
-
 print("#### Invalid Tokens ####")
 for token in invalid_tokens:
     print(token)
 
-if len(untest_tokens) == 0:
-    with open(saved_text_name, "wb") as f:
-        pickle.dump(text_dict, f)
-    with open(saved_traj_name, "wb") as f:
-        pickle.dump(traj_dict, f)
\ No newline at end of file
+packer.summary()
+cache.summary()
+cache.close()
+
+with metrics.timer("merge"):
+    checkpoint.merge(saved_traj_name, saved_text_name, tokens=test_tokens)
+checkpoint.close()
+metrics.summary()
+metrics.close()
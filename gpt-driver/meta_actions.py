@@ -0,0 +1,120 @@
+import json
+import time
+import argparse
+import numpy as np
+
+"""
+Batched meta-action labels of prompt_message.generate_meta_action, as codes into META_ACTIONS:
+    0: stop
+    1 + 6 * behavior + (speed - 1): "<behavior> with <speed>" for the other speeds and behaviors
+The rules and their order are the ones of generate_meta_action, evaluated with masks on [B, ...] arrays.
+"""
+
+CONSTANT_EPS = 0.5
+FORWARD_TH = 2.0
+LANE_CHANGING_TH = 4.0
+
+SPEED_ACTIONS = (
+    "stop",
+    "a deceleration to zero",
+    "a constant speed",
+    "a quick deceleration",
+    "a deceleration",
+    "a quick acceleration",
+    "an acceleration",
+)
+BEHAVIOR_ACTIONS = (
+    "move forward",
+    "turn left",
+    "chane lane to left",
+    "turn right",
+    "change lane to right",
+)
+META_ACTIONS = ("stop",) + tuple(f"{behavior} with {speed}" for behavior in BEHAVIOR_ACTIONS for speed in SPEED_ACTIONS[1:])
+
+def meta_action_codes(ego_fut_diff, ego_fut_trajs, ego_his_diff):
+    """
+    Meta-action codes of stacked gt_ego_fut_diff [B, 6, 2], gt_ego_fut_trajs [B, 7, 2] and gt_ego_his_diff [B, 4, 2].
+    Raises ValueError like generate_meta_action for a sample that is neither stopped, forward, left nor right.
+    """
+    ego_fut_diff, ego_fut_trajs, ego_his_diff = np.asarray(ego_fut_diff), np.asarray(ego_fut_trajs), np.asarray(ego_his_diff)
+    cur_velo = np.linalg.norm(ego_his_diff, axis=-1)[:, -1]
+    end_velo = np.linalg.norm(ego_fut_diff, axis=-1)[:, -1]
+    speed = np.select(
+        [
+            (cur_velo < CONSTANT_EPS) & (end_velo < CONSTANT_EPS),
+            end_velo < CONSTANT_EPS,
+            np.abs(end_velo - cur_velo) < CONSTANT_EPS,
+            (cur_velo > end_velo) & (cur_velo > 2 * end_velo),
+            cur_velo > end_velo,
+            end_velo > 2 * cur_velo,
+        ],
+        np.arange(6),
+        default=6,
+    )
+
+    end_x = ego_fut_trajs[:, -1, 0]
+    forward = (np.abs(ego_fut_trajs[:, :, 0]) < FORWARD_TH).all(axis=-1)
+    turn = np.abs(end_x) > LANE_CHANGING_TH
+    behavior = np.select(
+        [forward, (end_x < 0) & turn, end_x < 0, (end_x > 0) & turn, end_x > 0],
+        np.arange(5),
+        default=-1,
+    )
+    undefined = (speed != 0) & (behavior < 0)
+    if undefined.any():
+        raise ValueError(f"Undefined behaviors: {ego_fut_trajs[np.argmax(undefined)]}")
+    return np.where(speed == 0, 0, 1 + 6 * behavior + (speed - 1))
+
+def render_meta_actions(codes):
+    """The strings of generate_meta_action for meta-action codes."""
+    rendered = [meta_action.upper() + "\n" for meta_action in META_ACTIONS]
+    return [rendered[code] for code in np.asarray(codes).tolist()]
+
+def stack_meta_action_inputs(data_dicts):
+    """(gt_ego_fut_diff, gt_ego_fut_trajs, gt_ego_his_diff) stacked over a list of info dicts."""
+    return (
+        np.stack([d['gt_ego_fut_diff'] for d in data_dicts]),
+        np.stack([d['gt_ego_fut_trajs'] for d in data_dicts]),
+        np.stack([d['gt_ego_his_diff'] for d in data_dicts]),
+    )
+
+def meta_action_histogram(codes):
+    """{meta action: count} of the codes, most frequent first, without the meta actions that do not occur."""
+    counts = np.bincount(np.asarray(codes, dtype=np.int64), minlength=len(META_ACTIONS))
+    return {META_ACTIONS[code]: int(counts[code]) for code in np.argsort(-counts, kind="stable") if counts[code] > 0}
+
+if __name__ == "__main__":
+    from prompt_message import generate_meta_action
+    from nuscenes_cache import load_nuscenes_info
+
+    parser = argparse.ArgumentParser(description="Meta-action distribution of a split.")
+    parser.add_argument("-s", "--split", type=str, default="train", help="split to label")
+    parser.add_argument("--check", action="store_true", help="compare every label with generate_meta_action")
+    args = parser.parse_args()
+
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    tokens = json.load(open('data/split.json', 'r'))[args.split]
+
+    start = time.perf_counter()
+    data_dicts = [data[token] for token in tokens]
+    inputs = stack_meta_action_inputs(data_dicts)
+    load_time = time.perf_counter() - start
+    start = time.perf_counter()
+    codes = meta_action_codes(*inputs)
+    label_time = time.perf_counter() - start
+
+    print(f"#### {len(tokens)} {args.split} samples ####")
+    for meta_action, count in meta_action_histogram(codes).items():
+        print(f"{meta_action}: {count} ({100 * count / len(tokens):.1f} %)")
+    print(f"Stacked in {load_time:.2f}s, labeled in {label_time * 1000:.1f}ms")
+    if args.check:
+        start = time.perf_counter()
+        meta_actions = [
+            generate_meta_action(ego_fut_diff=d['gt_ego_fut_diff'], ego_fut_trajs=d['gt_ego_fut_trajs'],
+                ego_his_diff=d['gt_ego_his_diff'], ego_his_trajs=d['gt_ego_his_trajs'])
+            for d in data_dicts
+        ]
+        scalar_time = time.perf_counter() - start
+        num_mismatches = sum(a != b for a, b in zip(meta_actions, render_meta_actions(codes)))
+        print(f"generate_meta_action: {scalar_time:.2f}s, mismatches: {num_mismatches}")
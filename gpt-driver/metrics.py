@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import bisect
+import contextlib
+
+"""
+Per-stage timers and counters of the inference runners.
+    with metrics.timer("api"): ...      latency histogram of a stage
+    metrics.inc("retries")              counter
+The histograms and counters are exported every `interval` seconds to a JSONL file (one snapshot per line, appended)
+or a Prometheus text file (.prom, rewritten in place for the node exporter textfile collector).
+Metrics(None) is disabled: timer returns a shared no-op context and inc returns at once.
+"""
+
+# upper bounds in seconds of the histogram buckets, from 0.1 ms to 5 min
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_NULL_TIMER = contextlib.nullcontext()
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, inf for the overflow bucket."""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative > 0:
+                return bound
+        return float("nan")
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Metrics:
+    def __init__(self, path=None, interval=10.0):
+        self.path = path
+        self.enabled = path is not None
+        self.interval = interval
+        self.prometheus = path is not None and path.endswith(".prom")
+        self.histograms = {}
+        self.counters = {}
+        self.start = time.time()
+        self.last_export = time.monotonic()
+
+    def timer(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        if time.monotonic() - self.last_export >= self.interval:
+            self.export()
+        if stage not in self.histograms:
+            self.histograms[stage] = Histogram()
+        return _Timer(self.histograms[stage])
+
+    def inc(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "elapsed": time.time() - self.start,
+            "counters": dict(self.counters),
+            "stages": {
+                stage: {"count": h.count, "sum": h.sum, "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], h.counts))}
+                for stage, h in self.histograms.items()
+            },
+        }
+
+    def _prometheus_text(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE gpt_driver_{name}_total counter")
+            lines.append(f"gpt_driver_{name}_total {value}")
+        lines.append("# TYPE gpt_driver_stage_seconds histogram")
+        for stage, h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip([str(b) for b in BUCKETS] + ["+Inf"], h.counts):
+                cumulative += count
+                lines.append(f'gpt_driver_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'gpt_driver_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+            lines.append(f'gpt_driver_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        self.last_export = time.monotonic()
+        if not self.enabled:
+            return
+        if self.prometheus:
+            with open(self.path + ".tmp", "w") as f: # scrapers never see a partial file
+                f.write(self._prometheus_text())
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+    def summary(self):
+        if not self.enabled:
+            return
+        print("#### Pipeline Stages ####")
+        for stage, h in self.histograms.items():
+            print(f"{stage}: {h.count} calls, total {h.sum:.2f}s, mean {h.sum / max(h.count, 1) * 1000:.1f} ms, "
+                f"p50 <= {h.quantile(0.5) * 1000:.1f} ms, p99 <= {h.quantile(0.99) * 1000:.1f} ms")
+        print(", ".join(f"{name}: {value}" for name, value in self.counters.items()))
+
+    def close(self):
+        self.export()
+
+def count_retry(retry_state):
+    """tenacity before_sleep hook, counts the retries of a call made with a metrics= keyword argument."""
+    metrics = retry_state.kwargs.get("metrics")
+    if metrics is None:
+        return
+    metrics.inc("retries")
+    error = retry_state.outcome.exception()
+    if getattr(error, "http_status", None) == 429: # openai.error.RateLimitError
+        metrics.inc("rate_limited")
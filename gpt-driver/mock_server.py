@@ -0,0 +1,311 @@
+import re
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import numpy as np
+from aiohttp import web
+from prompt_message import generate_user_message_parts, generate_assistant_messages
+from nuscenes_cache import load_nuscenes_info
+from token_counter import TokenCounter
+import compact_encoding
+
+"""
+Local stand-in for the OpenAI chat completion endpoint, for tests and benchmarks without an account.
+Answers are derived from the ground truth, latencies are log-normal, and rate limits (429) and transient
+server errors (500 / 503) are returned like the API does, so that the retry and rate limiting paths are exercised.
+The files and batches endpoints of the Batch API are served as well, a batch completes batch_latency seconds after its creation,
+and so are the fine-tuning jobs endpoints, a job runs for finetune_latency seconds and reports its steps as events.
+"""
+
+VELOCITY_RES = {
+    "text": re.compile(r"Velocity \(vx,vy\): \(([-+\d.]+),([-+\d.]+)\)"),
+    "compact": re.compile(r"^ v (-?\d+) (-?\d+)$", re.M),
+}
+
+def format_trajectory(traj, encoding="text"):
+    if encoding == "compact":
+        return compact_encoding.format_trajectory(traj)
+    return "[" + ", ".join(f"({x:.2f},{y:.2f})" for x, y in traj) + "]"
+
+class MockResponder:
+    """
+    Answers a prompt with the assistant message of the sample whose ego-states, historical trajectory and mission goal
+    end the user message, which also matches prompts with trimmed objects. Unknown prompts get a constant velocity trajectory.
+    Prompts and answers are in the `encoding` of compact_encoding.py.
+    """
+    def __init__(self, data, tokens, noise=0.0, seed=0, encoding="text"):
+        user_message_parts = generate_user_message_parts(data, tokens, encoding=encoding)
+        self.answers = dict(zip([parts["tail"] for parts in user_message_parts], generate_assistant_messages(data, tokens, encoding=encoding)))
+        self.encoding = encoding
+        self.tail_start = compact_encoding.TAIL_STARTS[encoding]
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def respond(self, messages):
+        user_message = messages[-1]["content"]
+        answer = self.answers.get(user_message[user_message.find(self.tail_start):])
+        if answer is None:
+            match = VELOCITY_RES[self.encoding].search(user_message)
+            velocity = np.array([float(match.group(1)), float(match.group(2))]) if match else np.zeros(2)
+            velocity *= compact_encoding.TRAJECTORY_SCALES[self.encoding]
+            answer = "Trajectory:\n" + format_trajectory(np.arange(1, 7)[:, None] * velocity[None], self.encoding)
+        if self.noise > 0: # planning errors, applied to the trajectory on the last line
+            head, _, last_line = answer.rpartition("\n")
+            traj, _ = compact_encoding.decode_trajectory(last_line, self.encoding)
+            traj += self.rng.normal(scale=self.noise, size=traj.shape)
+            answer = head + "\n" + format_trajectory(traj, self.encoding)
+        return answer
+
+class MockServer:
+    """
+    /v1/chat/completions with a latency of lognormal(latency, latency_sigma) seconds plus token_latency per completion token,
+    a random error_rate of 500 / 503 responses, and 429 responses when the rpm or tpm budget is exhausted (<= 0 disables it).
+    """
+    def __init__(self, responder, counter, latency=0.5, latency_sigma=0.5, token_latency=0.0, error_rate=0.0, rpm=0, tpm=0, batch_latency=1.0, finetune_latency=2.0, seed=0):
+        self.responder = responder
+        self.counter = counter
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_budget = float(rpm)
+        self.token_budget = float(tpm)
+        self.last_refill = time.monotonic()
+        self.rng = np.random.default_rng(seed)
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_errors = 0
+        self.batch_latency = batch_latency
+        self.files = {}
+        self.batches = {}
+        self.tasks = set() # background batches and jobs
+        self.finetune_latency = finetune_latency
+        self.jobs = {}
+        self.job_events = {}
+
+    def _admit(self, num_tokens):
+        """Token buckets of the rate limits, without waiting."""
+        now = time.monotonic()
+        elapsed, self.last_refill = now - self.last_refill, now
+        if self.rpm > 0:
+            self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60.0)
+            if self.request_budget < 1:
+                return False
+        if self.tpm > 0:
+            self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60.0)
+            if self.token_budget < num_tokens:
+                return False
+        if self.rpm > 0:
+            self.request_budget -= 1
+        if self.tpm > 0:
+            self.token_budget -= num_tokens
+        return True
+
+    @staticmethod
+    def error(status, message, error_type, code=None):
+        return web.json_response({"error": {"message": message, "type": error_type, "param": None, "code": code}}, status=status)
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.num_requests += 1
+        messages = body["messages"]
+        prompt_tokens = sum(self.counter.count_batch([message["content"] for message in messages]))
+        if not self._admit(prompt_tokens):
+            self.num_rate_limited += 1
+            return self.error(429, "Rate limit reached, please try again later.", "requests", "rate_limit_exceeded")
+        if self.rng.random() < self.error_rate:
+            self.num_errors += 1
+            if self.rng.random() < 0.5:
+                return self.error(500, "The server had an error while processing your request.", "server_error")
+            return self.error(503, "The server is overloaded or not ready yet.", "server_error")
+
+        contents = [self.responder.respond(messages) for _ in range(body.get("n", 1))]
+        completion_tokens = sum(self.counter.count_batch(contents))
+        latency = 0.0
+        if self.latency > 0:
+            latency = self.rng.lognormal(np.log(self.latency), self.latency_sigma)
+        await asyncio.sleep(latency + completion_tokens * self.token_latency)
+        return web.json_response({
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for i, content in enumerate(contents)],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _add_file(self, content, filename, purpose):
+        file_id = "file-" + uuid.uuid4().hex
+        self.files[file_id] = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed", "content": content}
+        return file_id
+
+    def _file_object(self, file_id):
+        return {key: value for key, value in self.files[file_id].items() if key != "content"}
+
+    async def upload_file(self, request):
+        form = await request.post()
+        upload = form["file"]
+        file_id = self._add_file(upload.file.read(), upload.filename, form.get("purpose", "batch"))
+        return web.json_response(self._file_object(file_id))
+
+    async def list_files(self, request):
+        return web.json_response({"object": "list", "data": [self._file_object(file_id) for file_id in self.files]})
+
+    async def file_content(self, request):
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return self.error(404, f"No such File object: {file_id}", "invalid_request_error")
+        return web.Response(body=self.files[file_id]["content"], content_type="application/octet-stream")
+
+    async def create_batch(self, request):
+        body = await request.json()
+        if body.get("input_file_id") not in self.files:
+            return self.error(400, "Invalid input_file_id.", "invalid_request_error")
+        batch_id = "batch_" + uuid.uuid4().hex
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"), "status": "validating", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        task = asyncio.create_task(self._run_batch(batch_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.json_response(self.batches[batch_id])
+
+    async def get_batch(self, request):
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self.batches:
+            return self.error(404, f"No such Batch object: {batch_id}", "invalid_request_error")
+        return web.json_response(self.batches[batch_id])
+
+    async def _run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch["status"] = "in_progress"
+        batch["request_counts"]["total"] = len(lines)
+        await asyncio.sleep(self.batch_latency)
+        outputs, errors = [], []
+        for line in lines:
+            request = json.loads(line)
+            if self.rng.random() < self.error_rate:
+                errors.append(json.dumps({"id": "batch_req_" + uuid.uuid4().hex, "custom_id": request["custom_id"], "response": None,
+                    "error": {"code": "server_error", "message": "The server had an error while processing your request."}}))
+                continue
+            messages = request["body"]["messages"]
+            content = self.responder.respond(messages)
+            prompt_tokens = sum(self.counter.count_batch([message["content"] for message in messages]))
+            completion_tokens = self.counter.count(content)
+            outputs.append(json.dumps({"id": "batch_req_" + uuid.uuid4().hex, "custom_id": request["custom_id"], "response": {
+                "status_code": 200, "request_id": uuid.uuid4().hex, "body": {
+                    "id": "chatcmpl-" + uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()), "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                }}, "error": None}))
+        batch["output_file_id"] = self._add_file(("\n".join(outputs) + "\n").encode("utf-8"), "batch_output.jsonl", "batch_output")
+        if len(errors) > 0:
+            batch["error_file_id"] = self._add_file(("\n".join(errors) + "\n").encode("utf-8"), "batch_errors.jsonl", "batch_output")
+        batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+    async def create_job(self, request):
+        body = await request.json()
+        training_file = self.files.get(body.get("training_file"))
+        if training_file is None or training_file["purpose"] != "fine-tune":
+            return self.error(400, "Invalid training_file.", "invalid_request_error")
+        job_id = "ftjob-" + uuid.uuid4().hex
+        self.jobs[job_id] = {
+            "id": job_id, "object": "fine_tuning.job", "model": body["model"], "created_at": int(time.time()), "finished_at": None,
+            "fine_tuned_model": None, "status": "validating_files", "training_file": body["training_file"],
+            "hyperparameters": body.get("hyperparameters", {"n_epochs": "auto"}), "trained_tokens": None, "error": None,
+        }
+        self.job_events[job_id] = []
+        self._add_event(job_id, "Validating training file: " + body["training_file"])
+        task = asyncio.create_task(self._run_job(job_id, training_file["content"].count(b"\n") + 1, body.get("suffix")))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.json_response(self.jobs[job_id])
+
+    def _add_event(self, job_id, message):
+        self.job_events[job_id].append({"id": "ftevent-" + uuid.uuid4().hex, "object": "fine_tuning.job.event",
+            "created_at": int(time.time()), "level": "info", "message": message})
+
+    async def _run_job(self, job_id, num_steps, suffix):
+        job = self.jobs[job_id]
+        await asyncio.sleep(self.finetune_latency / 4)
+        job["status"] = "running"
+        self._add_event(job_id, "Fine-tuning job started")
+        for step in range(1, 4):
+            await asyncio.sleep(self.finetune_latency / 4)
+            self._add_event(job_id, f"Step {step * num_steps // 3}/{num_steps}: training loss={self.rng.uniform(0.1, 1.0):.4f}")
+        base_model = job["model"].split(":")[1] if job["model"].startswith("ft:") else job["model"] + "-0613"
+        job["fine_tuned_model"] = f"ft:{base_model}:mock:{suffix or ''}:{job_id[-8:]}"
+        job["status"] = "succeeded"
+        job["finished_at"] = int(time.time())
+        self._add_event(job_id, "The job has successfully completed")
+
+    async def get_job(self, request):
+        job_id = request.match_info["job_id"]
+        if job_id not in self.jobs:
+            return self.error(404, f"No such fine-tuning job: {job_id}", "invalid_request_error")
+        return web.json_response(self.jobs[job_id])
+
+    async def list_job_events(self, request):
+        job_id = request.match_info["job_id"]
+        if job_id not in self.jobs:
+            return self.error(404, f"No such fine-tuning job: {job_id}", "invalid_request_error")
+        limit = int(request.query.get("limit", 20))
+        return web.json_response({"object": "list", "data": self.job_events[job_id][::-1][:limit]}) # newest first
+
+    def app(self):
+        app = web.Application(client_max_size=1024 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/files", self.upload_file)
+        app.router.add_get("/v1/files", self.list_files)
+        app.router.add_get("/v1/files/{file_id}/content", self.file_content)
+        app.router.add_post("/v1/batches", self.create_batch)
+        app.router.add_get("/v1/batches/{batch_id}", self.get_batch)
+        app.router.add_post("/v1/fine_tuning/jobs", self.create_job)
+        app.router.add_get("/v1/fine_tuning/jobs/{job_id}", self.get_job)
+        app.router.add_get("/v1/fine_tuning/jobs/{job_id}/events", self.list_job_events)
+        return app
+
+    def summary(self):
+        print("#### Mock Server ####")
+        print(f"Requests: {self.num_requests}, rate limited: {self.num_rate_limited}, errors: {self.num_errors}")
+
+async def start_server(server, host="localhost", port=8765):
+    """Serve in the running event loop, returns the runner to clean up. The API base is http://host:port/v1."""
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completion API.")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split whose ground truth answers the prompts")
+    parser.add_argument("--port", type=int, default=8765, help="port, the API base is http://localhost:port/v1")
+    parser.add_argument("--latency", type=float, default=0.5, help="median latency in seconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="log-normal sigma of the latency")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="additional seconds per completion token")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="ratio of 500 / 503 responses")
+    parser.add_argument("--rpm", type=int, default=0, help="requests-per-minute limit, <= 0 disables it")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens-per-minute limit, <= 0 disables it")
+    parser.add_argument("--batch_latency", type=float, default=1.0, help="seconds before a batch completes")
+    parser.add_argument("--finetune_latency", type=float, default=2.0, help="seconds before a fine-tuning job succeeds")
+    parser.add_argument("--noise", type=float, default=0.0, help="std of the noise added to the ground truth trajectories")
+    parser.add_argument("--encoding", type=str, default="text", choices=compact_encoding.ENCODINGS, help="prompt encoding of the clients")
+    args = parser.parse_args()
+
+    data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
+    split = json.load(open('data/split.json', 'r'))
+    responder = MockResponder(data, split[args.split], noise=args.noise, encoding=args.encoding)
+    server = MockServer(responder, TokenCounter("gpt-3.5-turbo"), latency=args.latency, latency_sigma=args.latency_sigma,
+        token_latency=args.token_latency, error_rate=args.error_rate, rpm=args.rpm, tpm=args.tpm, batch_latency=args.batch_latency,
+        finetune_latency=args.finetune_latency)
+    web.run_app(server.app(), host="localhost", port=args.port)
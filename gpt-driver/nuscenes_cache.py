@@ -0,0 +1,129 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+from collections.abc import Mapping
+
+"""
+Columnar layout of cached_nuscenes_info.pkl:
+    meta.json: tokens, the kind of every column and the size / mtime of the source pickle
+    <key>.npy: values of all tokens concatenated along the first axis ("ragged", e.g. gt_boxes [sum(N), 9])
+               or stacked along a new first axis ("fixed", e.g. gt_ego_lcf_feat [T, 9])
+    <key>.offsets.npy: [T+1] row offsets of a ragged column
+    extras.pkl: {token: {key: value}} for values that do not fit a column
+"""
+
+def _is_columnar(value):
+    return isinstance(value, (np.ndarray, np.generic, int, float, bool, str))
+
+def convert(data, cache_dir, source=None):
+    """Write the columns of `data`, converted from the pickle `source`, which load_nuscenes_info checks the cache against."""
+    tokens = list(data.keys())
+    keys = set()
+    for token in tokens:
+        keys.update(data[token].keys())
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = {}
+    extras = {}
+    for key in sorted(keys):
+        values = [data[token].get(key) for token in tokens]
+        if not all(value is not None and _is_columnar(value) for value in values):
+            for token, value in zip(tokens, values):
+                if value is not None:
+                    extras.setdefault(token, {})[key] = value
+            continue
+        values = [np.asarray(value) for value in values]
+        shapes = set(value.shape for value in values)
+        if len(shapes) == 1: # same shape for every token
+            np.save(os.path.join(cache_dir, key + ".npy"), np.stack(values))
+            columns[key] = "fixed"
+            continue
+        # empty arrays carry no information (and often a placeholder dtype or shape), only their count matters
+        nonempty = [value for value in values if value.size > 0]
+        if any(value.ndim == 0 for value in values) or len(set(value.shape[1:] for value in nonempty)) > 1:
+            for token, value in zip(tokens, values):
+                extras.setdefault(token, {})[key] = data[token][key]
+            continue
+        dtype = np.result_type(*nonempty) if len(nonempty) > 0 else values[0].dtype
+        trailing_shape = nonempty[0].shape[1:] if len(nonempty) > 0 else values[0].shape[1:]
+        counts = np.array([value.shape[0] if value.size > 0 else 0 for value in values], dtype=np.int64)
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(counts)])
+        flat = np.concatenate([value.reshape((-1,) + trailing_shape).astype(dtype, copy=False) for value in values if value.size > 0]) \
+            if len(nonempty) > 0 else np.zeros((0,) + trailing_shape, dtype=dtype)
+        np.save(os.path.join(cache_dir, key + ".npy"), flat)
+        np.save(os.path.join(cache_dir, key + ".offsets.npy"), offsets)
+        columns[key] = "ragged"
+
+    if len(extras) > 0:
+        with open(os.path.join(cache_dir, "extras.pkl"), "wb") as f:
+            pickle.dump(extras, f)
+    meta = {"tokens": tokens, "columns": columns}
+    if source is not None:
+        stat = os.stat(source)
+        meta.update(source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns)
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+class NuScenesInfo(Mapping):
+    """
+    Read-only, memory-mapped view of a converted info cache.
+    data[token] returns a dict of zero-copy array views, so prompt builders work unchanged.
+    """
+    def __init__(self, cache_dir):
+        meta = json.load(open(os.path.join(cache_dir, "meta.json"), "r"))
+        self.tokens = meta["tokens"]
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+        self.columns, self.offsets = {}, {}
+        for key, kind in meta["columns"].items():
+            self.columns[key] = np.load(os.path.join(cache_dir, key + ".npy"), mmap_mode="r")
+            if kind == "ragged":
+                self.offsets[key] = np.load(os.path.join(cache_dir, key + ".offsets.npy")).tolist()
+        extras_name = os.path.join(cache_dir, "extras.pkl")
+        self.extras = pickle.load(open(extras_name, "rb")) if os.path.exists(extras_name) else {}
+
+    def __getitem__(self, token):
+        i = self.token_index[token]
+        data_dict = {}
+        for key, column in self.columns.items():
+            if key in self.offsets:
+                offsets = self.offsets[key]
+                data_dict[key] = np.asarray(column[offsets[i]:offsets[i+1]])
+            else:
+                value = column[i]
+                data_dict[key] = np.asarray(value) if isinstance(value, np.ndarray) else value
+        data_dict.update(self.extras.get(token, {}))
+        return data_dict
+
+    def __contains__(self, token):
+        return token in self.token_index
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+def load_nuscenes_info(filename='data/cached_nuscenes_info.pkl'):
+    """Open the columnar cache next to `filename` if it has been converted from the current pickle, otherwise unpickle it."""
+    cache_dir = os.path.splitext(filename)[0]
+    meta_name = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_name):
+        meta = json.load(open(meta_name, "r"))
+        stat = os.stat(filename) if os.path.exists(filename) else None
+        if stat is None or (meta.get("source_size") == stat.st_size and meta.get("source_mtime_ns") == stat.st_mtime_ns):
+            return NuScenesInfo(cache_dir)
+        print(f"Ignoring {cache_dir}, converted from another {filename}, rerun nuscenes_cache.py")
+    return pickle.load(open(filename, 'rb'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert cached_nuscenes_info.pkl into memory-mapped columns.")
+    parser.add_argument("-i", "--input", type=str, default="data/cached_nuscenes_info.pkl", help="info pickle")
+    parser.add_argument("-o", "--output", type=str, default=None, help="output directory, defaults to the pickle name without extension")
+    args = parser.parse_args()
+
+    cache_dir = args.output if args.output is not None else os.path.splitext(args.input)[0]
+    data = pickle.load(open(args.input, 'rb'))
+    convert(data, cache_dir, source=args.input)
+    print(f"Converted {len(data)} tokens to {cache_dir}")
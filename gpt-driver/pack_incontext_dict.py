@@ -1,26 +1,28 @@
 import pickle
 import json
-import ast
-import numpy as np
+import argparse
+from incontext_cache import VARIANTS, build_incontext_cache
+from trajectory_parser import parse_responses, to_traj_dict, OK, REASONS
 
-filename = "outputs/gpt_incontext_temp.jsonl"
-data_dict = {}
-with open(filename, 'r') as file:
-    for line in file:
-        json_obj = json.loads(line.strip())
-        token = json_obj['token']
-        try:
-            gpt_text = json_obj['GPT']
-            traj = gpt_text.split("\n")[-1]
-            traj = ast.literal_eval(traj)
-            traj = np.array(traj)
-            if traj.shape[0] != 6 or traj.shape[1] != 2:
-                print(f"Invalid token: {token}")
-                continue
-            data_dict[token] = traj
-        except:
-            print(f"Invalid token: {token}")
-            continue
+parser = argparse.ArgumentParser(description="Pack in-context results, or the in-context example cache with --examples.")
+parser.add_argument("--examples", action="store_true", help="render the in-context examples of the train split into data/incontext_cache")
+parser.add_argument("--variants", type=str, nargs="+", default=["cot"], choices=list(VARIANTS), help="example variants to pack")
+parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes, defaults to all cores")
+args = parser.parse_args()
 
-with open("outputs/gpt_incontext.pkl", "wb") as f:
-    pickle.dump(data_dict, f)
+if args.examples:
+    split = json.load(open('data/split.json', 'r'))
+    train_tokens = split["train"]
+    for variant in args.variants:
+        build_incontext_cache(train_tokens, "data/incontext_cache/" + variant, variant=variant, num_workers=args.workers)
+        print(f"Packed {len(train_tokens)} {variant} examples")
+else:
+    filename = "outputs/gpt_incontext_temp.jsonl"
+    tokens, trajs, reasons = parse_responses(filename)
+    for token, reason in zip(tokens, reasons.tolist()):
+        if reason != OK:
+            print(f"Invalid token: {token} ({REASONS[reason]})")
+    data_dict = to_traj_dict(tokens, trajs, reasons)
+
+    with open("outputs/gpt_incontext.pkl", "wb") as f:
+        pickle.dump(data_dict, f)
@@ -1,4 +1,6 @@
 import numpy as np
+import compact_encoding
+from meta_actions import meta_action_codes, render_meta_actions, stack_meta_action_inputs
 
 system_message = """
 **Autonomous Driving Planner**
@@ -48,6 +50,18 @@ Output
   - [(x1,y1), (x2,y2), ... , (x6,y6)]
 """
 
+system_message_compact = """
+**Autonomous Driving Planner**
+Plan a safe 3-second trajectory of 6 waypoints, one every 0.5 seconds, avoiding collisions. You are at (0,0), Y points forward.
+Integers: positions and velocities (per 0.5 second) in decimeters, a, w and st in hundredths.
+Objects: class x y>x y now and in 3 seconds, ? if unknown. c car, t truck, b bus, tr trailer, cv construction vehicle, p pedestrian, m motorcycle, bc bicycle, tc traffic cone, br barrier.
+Ego: v velocity, w heading angular velocity, a acceleration, cb can bus, hs heading speed, st steering. History: last 2 seconds. Goal: F forward, L left, R right.
+Output: Thoughts (notable objects), Meta Action, Trajectory [(x1,y1),...,(x6,y6)] in decimeters.
+"""
+
+# system message of the fine-tuning data and the test prompts of each encoding
+SYSTEM_MESSAGES = {"text": system_message, "compact": system_message_compact}
+
 def generate_user_message(data, token, perception_range=20.0, short=True):
 
     # user_message  = f"You have received new input data to help you plan your route.\n"
@@ -158,6 +172,185 @@ def generate_user_message(data, token, perception_range=20.0, short=True):
     
     return user_message
 
+def pad_objects(data_dicts):
+    """
+    Stack the perception outputs of a batch of samples into padded arrays:
+        object_boxes: [B, N, 2] box centers
+        object_rel_fut_trajs: [B, N, 6, 2] diff movements
+        object_fut_mask: [B, N, 6]
+        object_sizes: [B, N, 2] box sizes (dx, dy)
+        object_valid: [B, N] False for padding
+    """
+    num_objects = np.array([d['gt_boxes'].shape[0] for d in data_dicts], dtype=np.int64)
+    batch_size = len(data_dicts)
+    max_objects = int(num_objects.max(initial=0))
+    object_valid = np.arange(max_objects)[None, :] < num_objects[:, None]
+
+    flat_boxes = np.concatenate([d['gt_boxes'][:, :5] for d in data_dicts], axis=0)
+    flat_trajs = np.concatenate([d['gt_agent_fut_trajs'].reshape(-1, 6, 2) for d in data_dicts], axis=0)
+    flat_masks = np.concatenate([d['gt_agent_fut_masks'].reshape(-1, 6) for d in data_dicts], axis=0)
+
+    # keep the input dtypes so that the padded arithmetic matches the per-sample one bit for bit
+    object_boxes = np.zeros((batch_size, max_objects, 2), dtype=flat_boxes.dtype)
+    object_sizes = np.zeros((batch_size, max_objects, 2), dtype=flat_boxes.dtype)
+    object_rel_fut_trajs = np.zeros((batch_size, max_objects, 6, 2), dtype=flat_trajs.dtype)
+    object_fut_mask = np.zeros((batch_size, max_objects, 6), dtype=flat_masks.dtype)
+    object_boxes[object_valid] = flat_boxes[:, :2]
+    object_sizes[object_valid] = flat_boxes[:, 3:5]
+    object_rel_fut_trajs[object_valid] = flat_trajs
+    object_fut_mask[object_valid] = flat_masks
+    return object_boxes, object_rel_fut_trajs, object_fut_mask, object_sizes, object_valid
+
+def generate_user_messages(data, tokens, perception_range=20.0, short=True, batch_size=1024, encoding="text", index=None, max_objects=None):
+    """
+    Batched generate_user_message, returns exactly the same strings for a list of tokens.
+    Objects are padded to [B, N, 6, 2] and the behind-ego and perception-range filters are applied as masks.
+    encoding="compact" renders the integer format of compact_encoding.py instead.
+    With a spatial_index.SpatialIndex, the objects are listed nearest first, at most max_objects of them.
+    """
+    return [
+        user_message_parts["head"] + "".join(user_message_parts["objects"]) + user_message_parts["tail"]
+        for user_message_parts in generate_user_message_parts(data, tokens, perception_range, short, batch_size, encoding, index, max_objects)
+    ]
+
+def generate_user_message_parts(data, tokens, perception_range=20.0, short=True, batch_size=1024, encoding="text", index=None, max_objects=None):
+    """
+    The components of every user message, so that their token costs can be known separately:
+        head: perception header
+        objects: one line per object, in the order of generate_user_message (nearest first with an index)
+        distances: distance of each object to ego
+        tail: ego-states, historical trajectory and mission goal
+    head + "".join(objects) + tail is the user message.
+    """
+    if index is None and max_objects is not None:
+        raise ValueError("max_objects needs a spatial index to order the objects")
+    user_message_parts = []
+    for start in range(0, len(tokens), batch_size):
+        batch_tokens = tokens[start:start+batch_size]
+        data_dicts = [data[token] for token in batch_tokens]
+        selected = index.select_batch(batch_tokens, perception_range, max_objects) if index is not None else None
+        user_message_parts.extend(_generate_user_message_parts_batch(data_dicts, perception_range, short, encoding, selected))
+    return user_message_parts
+
+def select_objects(data_dicts, selected):
+    """Data dicts with only the perception outputs of the `selected` object indices, in their order."""
+    return [
+        {
+            **d,
+            'gt_boxes': d['gt_boxes'][object_ids],
+            'gt_names': np.asarray(d['gt_names'])[object_ids],
+            'gt_agent_fut_trajs': d['gt_agent_fut_trajs'].reshape(-1, 6, 2)[object_ids],
+            'gt_agent_fut_masks': d['gt_agent_fut_masks'].reshape(-1, 6)[object_ids],
+        }
+        for d, object_ids in zip(data_dicts, selected)
+    ]
+
+def _generate_user_message_parts_batch(data_dicts, perception_range, short, encoding="text", selected=None):
+    num_samples = len(data_dicts)
+
+    """
+    Perception and Prediction Outputs
+    """
+    if selected is not None: # filtered and ordered by the spatial index, only the kept objects are padded
+        object_dicts = select_objects(data_dicts, selected)
+        object_boxes, object_rel_fut_trajs, object_fut_mask, _, keep = pad_objects(object_dicts)
+        object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None, :]
+    else:
+        object_dicts = data_dicts
+        object_boxes, object_rel_fut_trajs, object_fut_mask, _, object_valid = pad_objects(data_dicts)
+        object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None, :]
+        behind = (object_fut_trajs[..., 1] <= 0).all(axis=-1) & (object_boxes[..., 1] <= 0)
+        faraway = (np.abs(object_fut_trajs) > perception_range).any(axis=(-2, -1)) | (np.abs(object_boxes) > perception_range).any(axis=-1)
+        keep = object_valid & ~behind & ~faraway
+
+    sample_ids, object_ids = np.nonzero(keep) # sorted by sample, then by object index (or by distance with an index)
+    boxes = object_boxes[sample_ids, object_ids].tolist()
+    masks = (object_fut_mask[sample_ids, object_ids] > 0).tolist()
+    object_lines = [[] for _ in range(num_samples)]
+    object_distances = [[] for _ in range(num_samples)]
+    for b, distance in zip(sample_ids.tolist(), np.linalg.norm(object_boxes[sample_ids, object_ids], axis=-1).tolist()):
+        object_distances[b].append(distance)
+    if encoding == "compact":
+        names = [object_dicts[b]['gt_names'][i] for b, i in zip(sample_ids.tolist(), object_ids.tolist())]
+        lines = compact_encoding.format_objects(
+            names, object_boxes[sample_ids, object_ids], object_fut_trajs[sample_ids, object_ids], masks, short=short)
+        for b, line in zip(sample_ids.tolist(), lines):
+            object_lines[b].append(line)
+    elif short:
+        ends = object_fut_trajs[sample_ids, object_ids, -1].tolist()
+        for k, (b, i) in enumerate(zip(sample_ids.tolist(), object_ids.tolist())):
+            object_name = object_dicts[b]['gt_names'][i].split(".")[-1]
+            ox, oy = boxes[k]
+            if masks[k][-1]:
+                ex, ey = ends[k]
+                object_lines[b].append(f" - {object_name} at ({ox:.2f},{oy:.2f}), moving to ({ex:.2f},{ey:.2f}).\n")
+            else:
+                object_lines[b].append(f" - {object_name} at ({ox:.2f},{oy:.2f}), moving to unknown location.\n")
+    else:
+        trajs = object_fut_trajs[sample_ids, object_ids].tolist()
+        for k, (b, i) in enumerate(zip(sample_ids.tolist(), object_ids.tolist())):
+            object_name = object_dicts[b]['gt_names'][i]
+            ox, oy = boxes[k]
+            waypoints = ", ".join(
+                f"({x:.2f},{y:.2f})" if valid else "(UN,UN)" for (x, y), valid in zip(trajs[k], masks[k])
+            )
+            object_lines[b].append(f" - {object_name} at ({ox:.2f},{oy:.2f}). Future trajectory: [{waypoints}]\n")
+
+    """
+    Ego-States, Historical Trajectory and Mission Goal
+    """
+    # same promotion as the scalar expressions: ego_lcf_feat in float64, the accelerations in the dtype of gt_ego_his_diff
+    ego_lcf_feat = np.stack([d['gt_ego_lcf_feat'] for d in data_dicts]).astype(np.float64)
+    ego_his_diff = np.stack([d['gt_ego_his_diff'] for d in data_dicts])
+    ego_his_trajs = np.stack([d['gt_ego_his_trajs'][:4] for d in data_dicts])
+    cmd_vec = np.stack([d['gt_ego_fut_cmd'] for d in data_dicts])
+    ego_states = np.stack([
+        ego_lcf_feat[:, 0]*0.5,
+        ego_lcf_feat[:, 1]*0.5,
+        ego_lcf_feat[:, 4],
+        ego_his_diff[:, -1, 0] - ego_his_diff[:, -2, 0],
+        ego_his_diff[:, -1, 1] - ego_his_diff[:, -2, 1],
+        ego_lcf_feat[:, 2],
+        ego_lcf_feat[:, 3],
+        ego_lcf_feat[:, 7]*0.5,
+        ego_lcf_feat[:, 8],
+    ], axis=1).tolist()
+    ego_his_trajs = ego_his_trajs.reshape(num_samples, 8).tolist()
+    right, left, forward = cmd_vec[:, 0] > 0, cmd_vec[:, 1] > 0, cmd_vec[:, 2] > 0
+    assert (forward | right | left).all()
+    mission_goals = np.where(right, "RIGHT", np.where(left, "LEFT", "FORWARD")).tolist()
+
+    if encoding == "compact":
+        tails = compact_encoding.format_tails(ego_states, np.reshape(ego_his_trajs, (num_samples, 4, 2)), mission_goals)
+        return [
+            {"head": "\nObjects:\n", "objects": object_lines[b], "distances": object_distances[b], "tail": tails[b]}
+            for b in range(num_samples)
+        ]
+
+    user_message_parts = []
+    for b in range(num_samples):
+        vx, vy, v_yaw, ax, ay, cx, cy, vhead, steeling = ego_states[b]
+        xh1, yh1, xh2, yh2, xh3, yh3, xh4, yh4 = ego_his_trajs[b]
+        tail = "".join([
+            "Ego-States:\n",
+            f" - Velocity (vx,vy): ({vx:.2f},{vy:.2f})\n",
+            f" - Heading Angular Velocity (v_yaw): ({v_yaw:.2f})\n",
+            f" - Acceleration (ax,ay): ({ax:.2f},{ay:.2f})\n",
+            f" - Can Bus: ({cx:.2f},{cy:.2f})\n",
+            f" - Heading Speed: ({vhead:.2f})\n",
+            f" - Steering: ({steeling:.2f})\n",
+            "Historical Trajectory (last 2 seconds):",
+            f" [({xh1:.2f},{yh1:.2f}), ({xh2:.2f},{yh2:.2f}), ({xh3:.2f},{yh3:.2f}), ({xh4:.2f},{yh4:.2f})]\n",
+            f"Mission Goal: {mission_goals[b]}\n",
+        ])
+        user_message_parts.append({
+            "head": "\nPerception and Prediction:\n",
+            "objects": object_lines[b],
+            "distances": object_distances[b],
+            "tail": tail,
+        })
+    return user_message_parts
+
 def generate_assistant_message(data, token, traj_only = False):
 
     data_dict = data[token]
@@ -184,82 +377,118 @@ def generate_assistant_message(data, token, traj_only = False):
     # assitant_message += f"[ {x1:.2f},{x2:.2f},{x3:.2f},{x4:.2f},{x5:.2f},{x6:.2f},{y1:.2f},{y2:.2f},{y3:.2f},{y4:.2f},{y5:.2f},{y6:.2f} ]"
     return assitant_message
 
+def generate_assistant_messages(data, tokens, traj_only=False, batch_size=1024, encoding="text", index=None, max_objects=None):
+    """
+    Batched generate_assistant_message, returns exactly the same strings for a list of tokens.
+    encoding="compact" renders the notable objects and the trajectory in the integer format of compact_encoding.py.
+    With a spatial_index.SpatialIndex, only the objects it selects are screened, the same ones as generate_user_messages.
+    """
+    if index is None and max_objects is not None:
+        raise ValueError("max_objects needs a spatial index to order the objects")
+    assitant_messages = []
+    for start in range(0, len(tokens), batch_size):
+        batch_tokens = tokens[start:start+batch_size]
+        data_dicts = [data[token] for token in batch_tokens]
+        if traj_only:
+            thoughts = [""] * len(data_dicts)
+        else:
+            selected = index.select_batch(batch_tokens, max_objects=max_objects) if index is not None else None
+            thoughts = [thought + "Trajectory:\n" for thought in generate_chain_of_thoughts_batch(data_dicts, encoding=encoding, selected=selected)]
+        if encoding == "compact":
+            trajs = compact_encoding.format_trajectories(np.stack([d['gt_ego_fut_trajs'][1:7] for d in data_dicts]))
+            assitant_messages.extend(thought + traj for thought, traj in zip(thoughts, trajs))
+            continue
+        ego_fut_trajs = np.stack([d['gt_ego_fut_trajs'][1:7] for d in data_dicts]).reshape(len(data_dicts), 12).tolist()
+        for thought, (x1, y1, x2, y2, x3, y3, x4, y4, x5, y5, x6, y6) in zip(thoughts, ego_fut_trajs):
+            assitant_messages.append(
+                thought + f"[({x1:.2f},{y1:.2f}), ({x2:.2f},{y2:.2f}), ({x3:.2f},{y3:.2f}), ({x4:.2f},{y4:.2f}), ({x5:.2f},{y5:.2f}), ({x6:.2f},{y6:.2f})]"
+            )
+    return assitant_messages
+
 def generate_chain_of_thoughts(data_dict, perception_range=20.0, short=True):
     """
     Generate chain of thoughts reasoning and prompting by simple rules
     """
-    ego_fut_trajs = data_dict['gt_ego_fut_trajs']
-    ego_his_trajs = data_dict['gt_ego_his_trajs']
-    ego_fut_diff = data_dict['gt_ego_fut_diff']
-    ego_his_diff = data_dict['gt_ego_his_diff']
-    vx = data_dict['gt_ego_lcf_feat'][0]*0.5
-    vy = data_dict['gt_ego_lcf_feat'][1]*0.5
-    ax = data_dict['gt_ego_his_diff'][-1, 0] - data_dict['gt_ego_his_diff'][-2, 0]
-    ay = data_dict['gt_ego_his_diff'][-1, 1] - data_dict['gt_ego_his_diff'][-2, 1]
-    ego_estimate_velos = [
-        [0, 0],
-        [vx, vy],
-        [vx+ax, vy+ay],
-        [vx+2*ax, vy+2*ay],
-        [vx+3*ax, vy+3*ay],
-        [vx+4*ax, vy+4*ay],
-        [vx+5*ax, vy+5*ay],
-    ]
-    ego_estimate_trajs = np.cumsum(ego_estimate_velos, axis=0) # [7, 2]
-    # print(ego_estimate_trajs)
-    object_boxes = data_dict['gt_boxes']
-    object_names = data_dict['gt_names']
-    
-    object_rel_fut_trajs = data_dict['gt_agent_fut_trajs'].reshape(-1, 6, 2)
-    object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=1) + object_boxes[:, None, :2]
-    object_fut_trajs = np.concatenate([object_boxes[:, None, :2], object_fut_trajs], axis=1)
-    object_fut_mask = data_dict['gt_agent_fut_masks']
-    num_objects = object_boxes.shape[0]
+    return generate_chain_of_thoughts_batch([data_dict], perception_range=perception_range, short=short)[0]
 
-    num_future_horizon = 7 # include current
-    object_collisons = np.zeros((num_objects, num_future_horizon))
-    for i in range(num_objects):
-        if (object_fut_trajs[i, :, 1] <= 0).all(): # negative Y, meaning the object is always behind us, we don't care
-            continue
-        if (np.abs(object_fut_trajs[i, :, :]) > perception_range).any(): # filter faraway (> 20m) objects in case there are too many outputs
+def generate_chain_of_thoughts_batch(data_dicts, perception_range=20.0, short=True, encoding="text", selected=None):
+    """
+    Batched generate_chain_of_thoughts, one string per sample
+    """
+    object_collisons = detect_object_collisions(data_dicts, perception_range=perception_range, selected=selected) # [B, N, 7]
+    sample_ids, object_ids, timesteps = np.nonzero(object_collisons) # at most one timestep per object
+    notable_objects = [[] for _ in data_dicts]
+    for b, i, t in zip(sample_ids.tolist(), object_ids.tolist(), timesteps.tolist()):
+        object_name = data_dicts[b]['gt_names'][i]
+        time = t*0.5
+        if encoding == "compact":
+            notable_objects[b].append(compact_encoding.format_notable_object(object_name, data_dicts[b]['gt_boxes'][i, :2], time))
             continue
-        for t in range(num_future_horizon):
-            mask = object_fut_mask[i, t-1] > 0 if t > 0 else True
-            if not mask: continue
-            ego_x, ego_y = ego_estimate_trajs[t]
-            object_x, object_y = object_fut_trajs[i, t]
-            size_x, size_y = object_boxes[i, 3:5] * 0.5 # half size
-            collision = collision_detection(ego_x, ego_y, 0.925, 2.04, object_x, object_y, size_x, size_y)
-            if collision:
-                object_collisons[i, t] = 1
-                # import pdb; pdb.set_trace()    
-                break
-
-    assitant_message = f"Thoughts:\n"
-    if (object_collisons==0).all(): # nothing to care about
-        assitant_message += f" - Notable Objects from Perception: None\n"
-        assitant_message += f"   Potential Effects from Prediction: None\n"
-        # assitant_message += f"   Nothing to care.\n"
-    else:
-        for i in range(num_objects):
-            for t in range(num_future_horizon):
-                if object_collisons[i, t] > 0:
-                    object_name = object_names[i]
-                    if short:
-                        object_name = object_name.split(".")[-1]
-                    ox, oy = object_boxes[i, :2]
-                    time = t*0.5
-                    # assitant_message += f" ################################################################################\n"
-                    assitant_message += f" - Notable Objects from Perception: {object_name} at ({ox:.2f},{oy:.2f})\n"
-                    assitant_message += f"   Potential Effects from Prediction: within the safe zone of the ego-vehicle at the {time}-second timestep\n"
-    meta_action = generate_meta_action(
-        ego_fut_diff=ego_fut_diff, 
-        ego_fut_trajs=ego_fut_trajs, 
-        ego_his_diff=ego_his_diff, 
-        ego_his_trajs=ego_his_trajs
+        if short:
+            object_name = object_name.split(".")[-1]
+        ox, oy = data_dicts[b]['gt_boxes'][i, :2]
+        notable_objects[b].append(
+            f" - Notable Objects from Perception: {object_name} at ({ox:.2f},{oy:.2f})\n"
+            f"   Potential Effects from Prediction: within the safe zone of the ego-vehicle at the {time}-second timestep\n"
+        )
+
+    meta_actions = render_meta_actions(meta_action_codes(*stack_meta_action_inputs(data_dicts))) # generate_meta_action of every sample
+    assitant_messages = []
+    for b in range(len(data_dicts)):
+        assitant_message = f"Thoughts:\n"
+        if len(notable_objects[b]) == 0: # nothing to care about
+            if encoding == "compact":
+                assitant_message += f" - None\n"
+            else:
+                assitant_message += f" - Notable Objects from Perception: None\n"
+                assitant_message += f"   Potential Effects from Prediction: None\n"
+        else:
+            assitant_message += "".join(notable_objects[b])
+        assitant_message += ("Meta Action: " + meta_actions[b])
+        assitant_messages.append(assitant_message)
+    return assitant_messages
+
+def detect_object_collisions(data_dicts, perception_range=20.0, selected=None):
+    """
+    Screen the constant-acceleration ego trajectory against every object and timestep of a batch in one pass.
+    Returns object_collisons: [B, N, 7] with a 1 at the first timestep (current one included) an object enters the safe zone.
+    selected: object indices of every sample already filtered by a spatial index, only those are screened.
+    """
+    if selected is not None:
+        selected_collisons = detect_object_collisions(select_objects(data_dicts, selected), perception_range=np.inf)
+        max_objects = max([d['gt_boxes'].shape[0] for d in data_dicts], default=0)
+        object_collisons = np.zeros((len(data_dicts), max_objects, 7))
+        for b, object_ids in enumerate(selected):
+            object_collisons[b, object_ids] = selected_collisons[b, :len(object_ids)]
+        return object_collisons
+
+    object_boxes, object_rel_fut_trajs, object_fut_mask, object_sizes, object_valid = pad_objects(data_dicts)
+    batch_size, max_objects = object_valid.shape
+    object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None, :]
+    object_fut_trajs = np.concatenate([object_boxes[:, :, None, :], object_fut_trajs], axis=2) # [B, N, 7, 2]
+    object_fut_mask = np.concatenate([np.ones((batch_size, max_objects, 1), dtype=bool), object_fut_mask > 0], axis=2)
+
+    # same promotion as the scalar expressions: v in float64, a in the dtype of gt_ego_his_diff
+    ego_lcf_feat = np.stack([d['gt_ego_lcf_feat'] for d in data_dicts]).astype(np.float64)
+    ego_his_diff = np.stack([d['gt_ego_his_diff'] for d in data_dicts])
+    v = ego_lcf_feat[:, :2]*0.5
+    a = ego_his_diff[:, -1] - ego_his_diff[:, -2]
+    ego_estimate_velos = np.stack([np.zeros_like(v), v, v+a, v+2*a, v+3*a, v+4*a, v+5*a], axis=1)
+    ego_estimate_trajs = np.cumsum(ego_estimate_velos, axis=1) # [B, 7, 2]
+
+    behind = (object_fut_trajs[..., 1] <= 0).all(axis=-1) # negative Y, meaning the object is always behind us, we don't care
+    faraway = (np.abs(object_fut_trajs) > perception_range).any(axis=(-2, -1)) # filter faraway (> 20m) objects in case there are too many outputs
+    half_sizes = object_sizes * 0.5
+    collisions = batch_collision_detection(
+        ego_estimate_trajs[:, None, :, 0], ego_estimate_trajs[:, None, :, 1], 0.925, 2.04,
+        object_fut_trajs[..., 0], object_fut_trajs[..., 1], half_sizes[..., 0, None], half_sizes[..., 1, None],
     )
-    assitant_message += ("Meta Action: " + meta_action)
-    return assitant_message
+    collisions &= object_fut_mask & (object_valid & ~behind & ~faraway)[..., None]
+
+    object_collisons = np.zeros(collisions.shape)
+    sample_ids, object_ids = np.nonzero(collisions.any(axis=-1))
+    object_collisons[sample_ids, object_ids, collisions[sample_ids, object_ids].argmax(axis=-1)] = 1 # only the first collision counts
+    return object_collisons
 
 def collision_detection(x1, y1, sx1, sy1, x2, y2, sx2, sy2, x_space=1.0, y_space=3.0): # safe distance
     if (np.abs(x1-x2) < sx1+sx2+x_space) and (y2 > y1) and (y2 - y1 < sy1+sy2+y_space): # in front of you
@@ -267,6 +496,9 @@ def collision_detection(x1, y1, sx1, sy1, x2, y2, sx2, sy2, x_space=1.0, y_space
     else:
         return False
 
+def batch_collision_detection(x1, y1, sx1, sy1, x2, y2, sx2, sy2, x_space=1.0, y_space=3.0): # broadcasting version of collision_detection
+    return (np.abs(x1-x2) < sx1+sx2+x_space) & (y2 > y1) & (y2 - y1 < sy1+sy2+y_space)
+
 def generate_meta_action( 
     ego_fut_diff,
     ego_fut_trajs,
@@ -408,4 +640,15 @@ def generate_incontext_message(data, token):
     incontext_message += "You should generate the following content:\n"
     assistant_message = generate_assistant_message(data, token)
     incontext_message += assistant_message
-    return incontext_message
\ No newline at end of file
+    return incontext_message
+
+def generate_incontext_messages(data, tokens, traj_only=False):
+    """
+    Batched generate_incontext_message, traj_only renders examples without chain of thoughts
+    """
+    user_messages = generate_user_messages(data, tokens)
+    assistant_messages = generate_assistant_messages(data, tokens, traj_only=traj_only)
+    return [
+        "\nFor example:\nInput:\n" + user_message + "You should generate the following content:\n" + assistant_message
+        for user_message, assistant_message in zip(user_messages, assistant_messages)
+    ]
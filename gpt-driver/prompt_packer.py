@@ -0,0 +1,95 @@
+from prompt_message import system_message
+from token_counter import model_prices
+
+"""
+Budget-aware packing of the in-context prompts.
+Every component is counted once up front (the system message, each in-context example, each object line of the user message),
+and a prompt is then packed in a single pass by priority:
+    1. ego-states, historical trajectory and mission goal of the user message, always kept
+    2. perceived objects, nearest first
+    3. the system message
+    4. in-context examples in retrieval order, an example that does not fit is skipped for the next ones
+When everything fits, the prompt is the one of incontext_learning.py.
+The parts are joined at line breaks, where BPE does not merge across boundaries except "\n" + "\n",
+so the sum of the part counts is exact or over by a token and never underestimates the prompt.
+"""
+
+def budget_for_cost(max_cost, model="gpt-3.5-turbo", completion_tokens=0):
+    """The largest prompt in tokens with prompt + completion cost under max_cost USD, 0 when the completion alone exceeds it."""
+    prompt_price, completion_price = model_prices(model)
+    return max(0, int((max_cost * 1000 - completion_tokens * completion_price) / prompt_price))
+
+class PromptPacker:
+    """Packs (system, user) messages under `budget` prompt tokens, 4096 for gpt-3.5-turbo and 16384 for gpt-3.5-turbo-16k."""
+    def __init__(self, counter, budget=4096, max_cost=None, model="gpt-3.5-turbo", completion_tokens=0):
+        self.counter = counter
+        self.budget = budget
+        if max_cost is not None:
+            self.budget = min(self.budget, budget_for_cost(max_cost, model, completion_tokens))
+        self.num_system_message_tokens = counter.count(system_message)
+        self.num_packed = 0
+        self.num_dropped_examples = 0
+        self.num_dropped_objects = 0
+        self.num_dropped_system = 0
+
+    def count_user_parts(self, user_message_parts):
+        """[(object_counts, num_fixed_tokens)] for the output of generate_user_message_parts, encoded in one batch."""
+        texts = []
+        for parts in user_message_parts:
+            texts.extend(parts["objects"])
+            texts.append(parts["tail"])
+        counts = self.counter.count_batch(texts)
+        user_counts, start = [], 0
+        for parts in user_message_parts:
+            num_objects = len(parts["objects"])
+            num_fixed_tokens = self.counter.count(parts["head"]) + counts[start+num_objects]
+            user_counts.append((counts[start:start+num_objects], num_fixed_tokens))
+            start += num_objects + 1
+        return user_counts
+
+    def pack(self, user_parts, user_counts, incontext_messages=(), incontext_counts=()):
+        """
+        Returns (system_incontext_message, user_message, num_system_tokens, num_user_tokens).
+        user_parts and user_counts are one item of generate_user_message_parts and count_user_parts,
+        incontext_messages and incontext_counts the examples from the most to the least relevant.
+        """
+        object_counts, num_fixed_tokens = user_counts
+        remaining = self.budget - num_fixed_tokens
+
+        keep_objects = [False] * len(object_counts)
+        num_user_tokens = num_fixed_tokens
+        for i in sorted(range(len(object_counts)), key=lambda i: user_parts["distances"][i]):
+            if object_counts[i] <= remaining:
+                keep_objects[i] = True
+                remaining -= object_counts[i]
+                num_user_tokens += object_counts[i]
+        objects = [line for line, keep in zip(user_parts["objects"], keep_objects) if keep]
+        user_message = user_parts["head"] + "".join(objects) + user_parts["tail"]
+
+        system_parts = []
+        num_system_tokens = 0
+        if self.num_system_message_tokens <= remaining:
+            system_parts.append(system_message)
+            remaining -= self.num_system_message_tokens
+            num_system_tokens += self.num_system_message_tokens
+            for message, num_tokens in zip(incontext_messages, incontext_counts):
+                if num_tokens <= remaining:
+                    system_parts.append(message)
+                    remaining -= num_tokens
+                    num_system_tokens += num_tokens
+            self.num_dropped_examples += len(incontext_messages) - (len(system_parts) - 1)
+        else: # the examples are of no use without the instructions of the system message
+            self.num_dropped_system += 1
+            self.num_dropped_examples += len(incontext_messages)
+
+        self.num_packed += 1
+        self.num_dropped_objects += len(object_counts) - len(objects)
+        return "".join(system_parts), user_message, num_system_tokens, num_user_tokens
+
+    def summary(self):
+        print("#### Prompt Packing ####")
+        print(f"Budget: {self.budget} tokens")
+        print(f"Number of prompts: {self.num_packed}")
+        print(f"Number of dropped in-context examples: {self.num_dropped_examples}")
+        print(f"Number of dropped objects: {self.num_dropped_objects}")
+        print(f"Number of prompts without system message: {self.num_dropped_system}")
@@ -0,0 +1,80 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+class ResponseCache:
+    """
+    Persistent completion cache backed by SQLite, keyed by a hash of the model id, the messages and the sampling parameters.
+    The total size of the cached responses is bounded by max_size_mb, least recently used responses are evicted first.
+    With refresh=True, every request misses and the new responses replace the cached ones.
+    """
+    def __init__(self, path='outputs/response_cache.db', max_size_mb=1024, refresh=False):
+        self.path = path
+        self.refresh = refresh
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @staticmethod
+    def key(model, messages, **params):
+        request = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, model, messages, **params):
+        """The cached response text of the request, or None."""
+        key = self.key(model, messages, **params)
+        row = None if self.refresh else self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, model, messages, response, **params):
+        key = self.key(model, messages, **params)
+        size = len(response.encode("utf-8"))
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self.size -= row[0]
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, model, response, size, time.time()),
+        )
+        self.size += size
+        self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 256").fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def summary(self):
+        print("#### Response Cache ####")
+        print(f"Hits: {self.num_hits}, misses: {self.num_misses}")
+        print(f"Cached responses: {len(self)} ({self.size / 1024 / 1024:.1f} MB)")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,139 @@
+import os
+import numpy as np
+from prompt_message import pad_objects
+from dataset_cache import dependencies, code_hash, source_stats
+
+"""
+Scene features for in-context example retrieval, one fixed-length vector per token:
+    ego states [7]: vx, vy, v_yaw, ax, ay, heading speed, steering
+    historical trajectory [8]: 4 waypoints
+    mission goal [3]: one-hot (right, left, forward)
+    nearby objects [num_sectors]: closeness of the nearest object in each angular sector around ego
+"""
+
+def scene_features(data, tokens, perception_range=20.0, num_sectors=8, batch_size=1024):
+    features = []
+    for start in range(0, len(tokens), batch_size):
+        data_dicts = [data[token] for token in tokens[start:start+batch_size]]
+        features.append(_scene_features_batch(data_dicts, perception_range, num_sectors))
+    if len(features) == 0:
+        return np.zeros((0, 18 + num_sectors), dtype=np.float32)
+    return np.concatenate(features, axis=0)
+
+def _scene_features_batch(data_dicts, perception_range, num_sectors):
+    num_samples = len(data_dicts)
+    ego_lcf_feat = np.stack([d['gt_ego_lcf_feat'] for d in data_dicts]).astype(np.float64)
+    ego_his_diff = np.stack([d['gt_ego_his_diff'] for d in data_dicts]).astype(np.float64)
+    ego_his_trajs = np.stack([d['gt_ego_his_trajs'][:4] for d in data_dicts]).astype(np.float64).reshape(num_samples, 8)
+    cmd_vec = np.stack([d['gt_ego_fut_cmd'] for d in data_dicts]).astype(np.float64)
+    ego_states = np.concatenate([
+        ego_lcf_feat[:, 0:2]*0.5,
+        ego_lcf_feat[:, 4:5],
+        ego_his_diff[:, -1] - ego_his_diff[:, -2],
+        ego_lcf_feat[:, 7:8]*0.5,
+        ego_lcf_feat[:, 8:9],
+    ], axis=1)
+
+    object_boxes, _, _, _, object_valid = pad_objects(data_dicts)
+    object_dists = np.linalg.norm(object_boxes, axis=-1)
+    object_angles = np.arctan2(object_boxes[..., 1], object_boxes[..., 0])
+    object_sectors = np.floor((object_angles + np.pi) / (2*np.pi) * num_sectors).astype(np.int64) % num_sectors
+    nearby = object_valid & (object_dists < perception_range)
+    sample_ids = np.broadcast_to(np.arange(num_samples)[:, None], object_dists.shape)
+    nearest = np.full((num_samples, num_sectors), perception_range)
+    np.minimum.at(nearest, (sample_ids[nearby], object_sectors[nearby]), object_dists[nearby])
+    object_closeness = 1.0 - nearest / perception_range # 0 for an empty sector
+
+    features = np.concatenate([ego_states, ego_his_trajs, (cmd_vec > 0).astype(np.float64), object_closeness], axis=1)
+    return features.astype(np.float32)
+
+class RetrievalIndex:
+    """
+    Exact nearest-neighbor index over standardized scene features of the train split.
+    Queries are answered in batches with one matrix product, well below a millisecond per token.
+    """
+    # relative importance of the feature groups after standardization
+    group_weights = {"ego": 1.0, "history": 1.0, "mission": 3.0, "objects": 1.0}
+
+    def __init__(self, tokens, features, mean, std, num_sectors=8, key=None):
+        self.tokens = list(tokens)
+        self.key = key
+        self.features = features
+        self.mean = mean
+        self.std = std
+        self.num_sectors = num_sectors
+        self.weights = np.concatenate([
+            np.full(7, self.group_weights["ego"]),
+            np.full(8, self.group_weights["history"]),
+            np.full(3, self.group_weights["mission"]),
+            np.full(num_sectors, self.group_weights["objects"]),
+        ]).astype(np.float32)
+        self.vectors = self._normalize(features)
+        self.norms = (self.vectors ** 2).sum(axis=1)
+
+    def _normalize(self, features):
+        return ((features - self.mean) / self.std * self.weights).astype(np.float32)
+
+    @classmethod
+    def build(cls, data, tokens, num_sectors=8):
+        features = scene_features(data, tokens, num_sectors=num_sectors)
+        mean = features.mean(axis=0)
+        std = features.std(axis=0)
+        std[std < 1e-6] = 1.0
+        return cls(tokens, features, mean, std, num_sectors=num_sectors, key=index_key(num_sectors))
+
+    def save(self, filename):
+        np.savez(filename, tokens=np.array(self.tokens), features=self.features, mean=self.mean, std=self.std, num_sectors=self.num_sectors,
+            key=np.array(self.key or ""))
+
+    @classmethod
+    def load(cls, filename):
+        index = np.load(filename)
+        key = str(index["key"]) if "key" in index.files else None
+        return cls(index["tokens"].tolist(), index["features"], index["mean"], index["std"], num_sectors=int(index["num_sectors"]), key=key or None)
+
+    def query(self, features, k=5, batch_size=256):
+        """Indices [Q, k] of the k nearest train tokens for every query, nearest first."""
+        vectors = self._normalize(features)
+        k = min(k, len(self.tokens))
+        neighbors = np.zeros((len(vectors), k), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start:start+batch_size]
+            dists = self.norms[None, :] - 2 * batch @ self.vectors.T # the query norm does not change the ranking
+            top_k = np.argpartition(dists, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(dists, top_k, axis=1), axis=1, kind="stable")
+            neighbors[start:start+batch_size] = np.take_along_axis(top_k, order, axis=1)
+        return neighbors
+
+    def query_tokens(self, data, tokens, k=5):
+        neighbors = self.query(scene_features(data, tokens, num_sectors=self.num_sectors), k=k)
+        return {token: [self.tokens[i] for i in row] for token, row in zip(tokens, neighbors.tolist())}
+
+INDEX_CODE = dependencies([scene_features, RetrievalIndex])
+
+def index_key(num_sectors=8):
+    """Key of an index built by the current feature code from the current info files, see dataset_cache.py."""
+    return code_hash(INDEX_CODE, num_sectors=num_sectors, sources=source_stats())
+
+def load_or_build_index(data, train_tokens, filename='data/incontext_index.npz'):
+    """
+    Load the persisted index, building and saving it first if it does not exist, covers other tokens,
+    or was built by other feature code or from other info files.
+    """
+    if os.path.exists(filename):
+        index = RetrievalIndex.load(filename)
+        if index.tokens == list(train_tokens) and index.key == index_key(index.num_sectors):
+            return index
+    index = RetrievalIndex.build(data, train_tokens)
+    index.save(filename)
+    return index
+
+def sequential_examples(token_index, train_tokens, num_examples=5):
+    """The original selection of incontext_learning.py: train tokens token_index * 5 + i."""
+    example_tokens = []
+    for i in range(num_examples):
+        train_token_id = token_index * 5 + i
+        if train_token_id >= len(train_tokens):
+            train_token_id = train_token_id % len(train_tokens)
+        example_tokens.append(train_tokens[train_token_id])
+    return example_tokens
@@ -1,23 +1,22 @@
-import pickle
 import json
-import ast
-import numpy as np
+import argparse
+from checkpoint import InferenceCheckpoint
 
-filename = "outputs/gpt_uniad.pkl"
-data_dict = pickle.load(open("outputs/gpt_uniad.pkl", "rb"))
+parser = argparse.ArgumentParser(description="List val tokens without a valid result.")
+parser.add_argument("-o", "--output", type=str, help="output file name")
+args = parser.parse_args()
+
+checkpoint = InferenceCheckpoint("outputs/" + args.output + ".db")
+status = checkpoint.status()
 
 split = json.load(open('data/split.json', 'r'))
 
 train_tokens = split["train"]
 test_tokens = split["val"]
 
-untest_tokens = [
-]
-
-for token in test_tokens:
-    if token not in data_dict:
-        untest_tokens.append(token)
+# re-running test.py / incontext_learning.py with the same output name retries exactly these tokens
+untest_tokens = checkpoint.pending(test_tokens)
 
 print("#### Invalid Tokens ####")
 for token in untest_tokens:
-    print(token)
+    print(token, status.get(token, "untested"))
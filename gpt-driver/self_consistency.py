@@ -0,0 +1,107 @@
+import json
+import warnings
+import numpy as np
+from trajectory_parser import OK
+from compact_encoding import decode_trajectories
+from evaluation import collisions
+
+"""
+Self-consistency planning: n sampled completions per prompt are parsed in bulk and aggregated into one trajectory.
+    median: waypoint-wise median of the valid samples
+    medoid: the valid sample with the smallest total L2 distance to the other valid samples
+    collision: the medoid of the valid samples that do not collide with the objects in gt_boxes, of all valid ones if they all collide
+Aggregation runs on [T, S, 6, 2] arrays, T tokens with S samples each.
+"""
+
+METHODS = ("median", "medoid", "collision")
+
+def medoid(trajs, mask):
+    """Index [T] of the sample with the smallest summed mean L2 distance to the other samples in mask [T, S]."""
+    dists = np.linalg.norm(trajs[:, :, None] - trajs[:, None, :], axis=-1).mean(axis=-1) # [T, S, S]
+    costs = np.where(mask[:, None, :], dists, 0.0).sum(axis=-1)
+    costs = np.where(mask, costs, np.inf)
+    return costs.argmin(axis=1)
+
+def aggregate(trajs, valid, method="median", data=None, tokens=None):
+    """
+    Returns (plans [T, 6, 2], selected [T]) from trajs [T, S, 6, 2] and valid [T, S].
+    selected is the sample reported with the plan, the one closest to the median for the median.
+    Tokens without a valid sample get NaN plans. collision needs data and tokens.
+    """
+    trajs = np.where(valid[..., None, None], trajs, 0.0) # keep NaN of invalid samples out of the distances
+    rows = np.arange(len(trajs))
+    if method == "median":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # all-NaN slices of tokens without a valid sample
+            plans = np.nanmedian(np.where(valid[..., None, None], trajs, np.nan), axis=1)
+        dists = np.linalg.norm(trajs - plans[:, None], axis=-1).mean(axis=-1)
+        selected = np.where(valid, np.nan_to_num(dists, nan=np.inf), np.inf).argmin(axis=1)
+    elif method in ("medoid", "collision"):
+        candidates = valid
+        if method == "collision":
+            safe = valid & ~collisions(data, tokens, trajs).any(axis=-1)
+            candidates = np.where(safe.any(axis=1, keepdims=True), safe, valid)
+        selected = medoid(trajs, candidates)
+        plans = trajs[rows, selected]
+    else:
+        raise ValueError(f"Unknown aggregation: {method}")
+    plans = np.where(valid.any(axis=1)[:, None, None], plans, np.nan)
+    return plans, selected
+
+class SelfConsistency:
+    """
+    Sampling parameters of the requests and aggregation of their completions.
+    With num_samples = 1 it reduces to parse_trajectory of the single completion.
+    Trajectories are decoded to meters from the prompt `encoding` of compact_encoding.py.
+    """
+    def __init__(self, num_samples=1, method="median", data=None, temperature=None, encoding="text"):
+        self.num_samples = num_samples
+        self.encoding = encoding
+        self.method = method
+        self.data = data
+        self.params = {}
+        if num_samples > 1:
+            self.params["n"] = num_samples
+        if temperature is not None:
+            self.params["temperature"] = temperature
+
+    def encode(self, completion):
+        """The response text to cache, the JSON list of the samples when there are several."""
+        if self.num_samples == 1:
+            return completion.text
+        return json.dumps(completion.choices)
+
+    def decode(self, result):
+        if self.num_samples == 1:
+            return [result]
+        return json.loads(result)
+
+    def select(self, tokens, results):
+        """Returns (texts, trajs, reasons) of the encoded results of `tokens`, traj is None when no sample is valid."""
+        samples = [self.decode(result) for result in results]
+        num_samples = max([len(texts) for texts in samples], default=1)
+        flat_texts = [texts[i] if i < len(texts) else None for texts in samples for i in range(num_samples)]
+        flat_trajs, flat_reasons = decode_trajectories(flat_texts, self.encoding)
+        trajs = flat_trajs.reshape(len(tokens), num_samples, 6, 2)
+        reasons = flat_reasons.reshape(len(tokens), num_samples)
+        valid = reasons == OK
+        if num_samples == 1:
+            plans, selected = trajs[:, 0], np.zeros(len(tokens), dtype=np.int64)
+        else:
+            plans, selected = aggregate(trajs, valid, self.method, data=self.data, tokens=tokens)
+
+        texts, plan_list, reason_list = [], [], []
+        for i, (sample_texts, j) in enumerate(zip(samples, selected.tolist())):
+            if valid[i].any():
+                texts.append(sample_texts[j])
+                plan_list.append(plans[i])
+                reason_list.append(OK)
+            else:
+                texts.append(sample_texts[0] if sample_texts else "")
+                plan_list.append(None)
+                reason_list.append(int(reasons[i, 0]))
+        return texts, plan_list, reason_list
+
+    def select_one(self, token, result):
+        texts, trajs, reasons = self.select([token], [result])
+        return texts[0], trajs[0], reasons[0]
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import dataset_cache # as a module, dataset_cache imports this one
+from prompt_message import pad_objects
+from nuscenes_cache import load_nuscenes_info
+from uniad_cache import load_uniad_perceptions, PerceptionOverride
+
+"""
+Per-token spatial index of the perceived objects, computed once in batch:
+    distance: [M] distance of the box center to ego
+    extent: [M] largest |x| or |y| of the box center and the future positions,
+            the object is within a perception range r of the prompts iff extent <= r
+    behind: [M] box center and future positions all behind ego (y <= 0)
+    order: [M] object indices of every token, nearest first
+    offsets: [T+1] row offsets of every token
+The behind and range filters of the prompt builders become comparisons on the candidates of a token,
+and the candidates are the nearest-first prefix within sqrt(2) r, since extent <= r implies distance <= sqrt(2) r.
+load_spatial_index keeps the index of all tokens next to the cached info, in the layout of nuscenes_cache.py:
+    meta.json: tokens, perception range and key, the hash of the index code and of the size and time of the info files, see dataset_cache.py
+    <column>.npy: the columns above
+"""
+
+INFO_NAME = 'data/cached_nuscenes_info.pkl'
+UNIAD_NAME = 'data/detection_motion_result_trainval.jsonl'
+COLUMNS = ("distance", "extent", "behind", "order", "offsets")
+
+class SpatialIndex:
+    def __init__(self, data, tokens=None, perception_range=20.0, batch_size=1024):
+        self.tokens = list(data) if tokens is None else list(tokens)
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+        self.perception_range = perception_range
+        self.key = None # see index_key
+        columns = {"distance": [], "extent": [], "behind": [], "order": []}
+        counts = []
+        for start in range(0, len(self.tokens), batch_size):
+            data_dicts = [data[token] for token in self.tokens[start:start+batch_size]]
+            object_boxes, object_rel_fut_trajs, _, _, object_valid = pad_objects(data_dicts)
+            # same arithmetic as the prompt builders, so that the filters match them exactly
+            object_fut_trajs = np.cumsum(object_rel_fut_trajs, axis=2) + object_boxes[:, :, None, :]
+            positions = np.concatenate([object_boxes[:, :, None, :], object_fut_trajs], axis=2) # [B, N, 7, 2]
+            extents = np.abs(positions).max(axis=-1) # [B, N, 7]
+            distance = np.linalg.norm(object_boxes, axis=-1)
+            behind = (positions[..., 1] <= 0).all(axis=-1)
+            order = np.argsort(np.where(object_valid, distance, np.inf), axis=1, kind="stable")
+            num_objects = object_valid.sum(axis=1)
+            for b in range(len(data_dicts)):
+                n = num_objects[b]
+                columns["distance"].append(distance[b, :n])
+                columns["extent"].append(extents[b, :n].max(axis=-1, initial=0.0))
+                columns["behind"].append(behind[b, :n])
+                columns["order"].append(order[b, :n])
+                counts.append(n)
+        for key, values in columns.items():
+            setattr(self, key, np.concatenate(values) if len(values) > 0 else np.zeros(0))
+        self.offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(np.array(counts, dtype=np.int64))])
+
+    def __contains__(self, token):
+        return token in self.token_index
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def select(self, token, perception_range=None, max_objects=None):
+        """Indices of the objects of `token` that the prompts keep, nearest first, at most max_objects of them."""
+        if perception_range is None:
+            perception_range = self.perception_range
+        i = self.token_index[token]
+        start, end = self.offsets[i], self.offsets[i+1]
+        order = self.order[start:end]
+        distances = self.distance[start:end][order]
+        num_candidates = np.searchsorted(distances, np.sqrt(2.0) * perception_range * (1 + 1e-9), side="right")
+        candidates = order[:num_candidates]
+        keep = (self.extent[start:end][candidates] <= perception_range) & ~self.behind[start:end][candidates]
+        selected = candidates[keep]
+        return selected if max_objects is None else selected[:max_objects]
+
+    def select_batch(self, tokens, perception_range=None, max_objects=None):
+        """select of every token, a list of index arrays."""
+        return [self.select(token, perception_range, max_objects) for token in tokens]
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_name = os.path.join(cache_dir, "meta.json")
+        if os.path.exists(meta_name): # written last, a partially saved index has none
+            os.remove(meta_name)
+        for column in COLUMNS: # renamed into place, concurrent workers may save the same index
+            with open(os.path.join(cache_dir, column + ".npy.tmp"), "wb") as f:
+                np.save(f, getattr(self, column))
+            os.replace(os.path.join(cache_dir, column + ".npy.tmp"), os.path.join(cache_dir, column + ".npy"))
+        with open(meta_name + ".tmp", "w") as f:
+            json.dump({"tokens": self.tokens, "perception_range": self.perception_range, "key": self.key}, f)
+        os.replace(meta_name + ".tmp", meta_name)
+
+    @classmethod
+    def load(cls, cache_dir):
+        """Memory-mapped index saved by save."""
+        meta = json.load(open(os.path.join(cache_dir, "meta.json"), "r"))
+        index = cls.__new__(cls)
+        index.tokens = meta["tokens"]
+        index.token_index = {token: i for i, token in enumerate(index.tokens)}
+        index.perception_range = meta["perception_range"]
+        index.key = meta["key"]
+        for column in COLUMNS:
+            setattr(index, column, np.load(os.path.join(cache_dir, column + ".npy"), mmap_mode="r"))
+        return index
+
+def index_key(perception="gt", perception_range=20.0):
+    """Hash of the code of the index and of the size and modification time of the info files it is built from."""
+    return dataset_cache.code_hash(dataset_cache.dependencies([SpatialIndex]), perception=perception, perception_range=perception_range,
+        sources=dataset_cache.source_stats(perception, INFO_NAME, UNIAD_NAME))
+
+def load_spatial_index(data, perception="gt", perception_range=20.0):
+    """
+    The index of all tokens of `data`, the info loaded from INFO_NAME (with the UniAD perceptions of UNIAD_NAME for "uniad").
+    It is loaded from next to the info when it was built from the same files by the same code, built and saved there otherwise.
+    """
+    cache_dir = os.path.splitext(INFO_NAME)[0] + f"_index_{perception}"
+    key = index_key(perception, perception_range)
+    if os.path.exists(os.path.join(cache_dir, "meta.json")):
+        index = SpatialIndex.load(cache_dir)
+        if index.key == key and len(index) == len(data):
+            return index
+    index = SpatialIndex(data, perception_range=perception_range)
+    index.key = key
+    index.save(cache_dir)
+    return index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or load the spatial index and report the objects kept by the prompts.")
+    parser.add_argument("-s", "--split", type=str, default="val", help="split to index")
+    parser.add_argument("-p", "--perception", type=str, default="gt", choices=["gt", "uniad"], help="perception source")
+    parser.add_argument("-r", "--perception_range", type=float, default=20.0, help="perception range of the prompts in meters")
+    parser.add_argument("--max_objects", type=int, default=None, help="keep only the nearest objects of every prompt")
+    args = parser.parse_args()
+
+    data = load_nuscenes_info(INFO_NAME)
+    if args.perception == "uniad":
+        data = PerceptionOverride(data, load_uniad_perceptions(UNIAD_NAME))
+    tokens = json.load(open('data/split.json', 'r'))[args.split]
+
+    start = time.perf_counter()
+    index = load_spatial_index(data, args.perception, args.perception_range)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    selected = index.select_batch(tokens, max_objects=args.max_objects)
+    select_time = time.perf_counter() - start
+    num_objects = len(index.distance)
+    num_selected = sum(len(object_ids) for object_ids in selected)
+    print(f"#### {len(index)} samples indexed ####")
+    print(f"Objects: {num_objects}, {num_objects / max(len(index), 1):.1f} per sample")
+    print(f"Within range: {int((index.extent <= args.perception_range).sum())}, behind ego: {int(index.behind.sum())}")
+    print(f"#### {len(tokens)} {args.split} samples ####")
+    print(f"Kept by the prompts: {num_selected}, {num_selected / max(len(tokens), 1):.1f} per sample")
+    print(f"Loaded or built in {build_time:.2f}s, selected in {select_time:.2f}s")
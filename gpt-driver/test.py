@@ -1,65 +1,112 @@
 import openai
-import pickle
 import json
-import ast
-import numpy as np
 import time
 import argparse
-from prompt_message import system_message, generate_user_message, generate_assistant_message
+from prompt_message import SYSTEM_MESSAGES, generate_user_messages, generate_assistant_messages
+from compact_encoding import ENCODINGS
+from spatial_index import load_spatial_index
+from nuscenes_cache import load_nuscenes_info
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from completion_backend import get_backend
+from trajectory_parser import REASONS
+from self_consistency import SelfConsistency, METHODS
+from metrics import Metrics, count_retry
+from finetune import resolve_model_id
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )  # for exponential backoff
  
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def completion_with_backoff(**kwargs):
-    return openai.ChatCompletion.create(**kwargs)
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6), before_sleep=count_retry)
+def completion_with_backoff(backend, metrics, **kwargs):
+    metrics.inc("api_calls")
+    with metrics.timer("api"):
+        return backend.complete(**kwargs)
 
 parser = argparse.ArgumentParser(description="GPT-Driver test.")
-parser.add_argument("-i", "--id", type=str, help="GPT model id")
+parser.add_argument("-i", "--id", type=str, help="GPT model id, latest for the last model of finetune.py")
 parser.add_argument("-o", "--output", type=str, help="output file name")
+parser.add_argument("--cache", type=str, default="outputs/response_cache.db", help="response cache shared by the runs")
+parser.add_argument("--cache_size", type=float, default=1024, help="maximum size of the cached responses in MB")
+parser.add_argument("--refresh_cache", action="store_true", help="query the API even for cached prompts, as for the tokens the checkpoint records as invalid")
+parser.add_argument("--backend", type=str, default="openai", choices=["openai", "mock"], help="OpenAI API, or ground truth answers in-process")
+parser.add_argument("--api_base", type=str, default=None, help="alternative API endpoint, e.g. http://localhost:8765/v1 for mock_server.py")
+parser.add_argument("-n", "--num_samples", type=int, default=1, help="completions sampled per prompt and aggregated into one plan")
+parser.add_argument("--aggregation", type=str, default="median", choices=METHODS, help="aggregation of the sampled trajectories")
+parser.add_argument("--temperature", type=float, default=None, help="sampling temperature, the API default if not given")
+parser.add_argument("--metrics", type=str, default=None, help="export stage timings and counters to this .jsonl or Prometheus .prom file")
+parser.add_argument("--metrics_interval", type=float, default=10.0, help="seconds between metrics exports")
+parser.add_argument("--encoding", type=str, default="text", choices=ENCODINGS, help="prompt encoding the model was fine-tuned on")
+parser.add_argument("--max_objects", type=int, default=None, help="list at most this many objects per prompt, nearest first, as the fine-tuning data")
+parser.add_argument("--mock_noise", type=float, default=0.0, help="noise in meters on the waypoints of the mock backend")
 args = parser.parse_args()
+args.id = resolve_model_id(args.id)
 
 saved_traj_name = "outputs/" + args.output + ".pkl"
 saved_text_name = "outputs/" + args.output + "_text.pkl"
 temp_text_name = "outputs/" + args.output + "_temp.jsonl"
+checkpoint_name = "outputs/" + args.output + ".db"
 
 openai.api_key = "" # insert your API key here
 
-data = pickle.load(open('data/cached_nuscenes_info.pkl', 'rb'))
+data = load_nuscenes_info('data/cached_nuscenes_info.pkl')
 split = json.load(open('data/split.json', 'r'))
 
 train_tokens = split["train"]
 test_tokens = split["val"]
 
-text_dict, traj_dict = {}, {}
+# tokens with a valid result in the checkpoint are skipped, invalid and failed ones are retried
+checkpoint = InferenceCheckpoint(checkpoint_name)
+# identical prompts to the same model are answered from the cache without calling the API
+cache = ResponseCache(args.cache, max_size_mb=args.cache_size, refresh=args.refresh_cache)
+backend = get_backend(args.backend, api_base=args.api_base, data=data, tokens=test_tokens, noise=args.mock_noise, encoding=args.encoding)
+sampler = SelfConsistency(args.num_samples, args.aggregation, data=data, temperature=args.temperature, encoding=args.encoding)
+# disabled without --metrics
+metrics = Metrics(args.metrics, interval=args.metrics_interval)
 
 invalid_tokens = []
 
-untest_tokens = [
-]
-
-for token in test_tokens:
-    if len(untest_tokens) > 0 and token not in untest_tokens: 
-        continue
+pending_tokens = checkpoint.pending(test_tokens)
+retried_tokens = checkpoint.invalid_tokens()
+with metrics.timer("prompt"):
+    index = load_spatial_index(data) if args.max_objects is not None else None
+    user_messages = generate_user_messages(data, pending_tokens, encoding=args.encoding, index=index, max_objects=args.max_objects)
+    assitant_messages = generate_assistant_messages(data, pending_tokens, encoding=args.encoding, index=index, max_objects=args.max_objects)
 
+for token, user_message, assitant_message in zip(pending_tokens, user_messages, assitant_messages):
     print()
     print(token)
 
-    time.sleep(1)    
-    user_message = generate_user_message(data, token)
-    assitant_message = generate_assistant_message(data, token)
     model_id = args.id
-    completion = completion_with_backoff(
-        model=model_id,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": user_message},
-        ]
-    )
-    # import pdb; pdb.set_trace()
-    result = completion.choices[0].message["content"]
+    messages = [
+        {"role": "system", "content": SYSTEM_MESSAGES[args.encoding]},
+        {"role": "user", "content": user_message},
+    ]
+    result = None
+    if token not in retried_tokens: # the cached answer of an invalid token is the invalid one
+        with metrics.timer("cache"):
+            result = cache.get(model_id, messages, **backend.cache_params, **sampler.params)
+    if result is not None:
+        metrics.inc("cache_hits")
+    else:
+        time.sleep(1)
+        completion = completion_with_backoff(
+            backend,
+            metrics=metrics,
+            model=model_id,
+            messages=messages,
+            **sampler.params
+        )
+        # import pdb; pdb.set_trace()
+        result = sampler.encode(completion)
+        metrics.inc("prompt_tokens", completion.prompt_tokens)
+        metrics.inc("completion_tokens", completion.completion_tokens)
+        cache.put(model_id, messages, result, **backend.cache_params, **sampler.params)
+    # the plan aggregated from the samples, and the text of the sample closest to it
+    with metrics.timer("parse"):
+        result, traj, reason = sampler.select_one(token, result)
     print(f"GPT  Planner:\n {result}")
     print(f"Ground Truth:\n {assitant_message}")
     output_dict = {
@@ -68,38 +115,26 @@ for token in test_tokens:
         "GT": assitant_message, 
     }
 
-    text_dict[token] = result
-
-    traj = result.split("\n")[-1]
-    try:
-        traj = ast.literal_eval(traj)
-        traj = np.array(traj)
-    except:
-        print(f"Invalid token: {token}")
+    if traj is None:
+        print(f"Invalid token: {token} ({REASONS[reason]})")
         invalid_tokens.append(token)
+        metrics.inc("invalid")
+        checkpoint.record(token, "invalid", text=result)
         continue
-    traj_dict[token] = traj
+    checkpoint.record(token, "done", text=result, traj=traj)
 
     with open(temp_text_name, "a+") as file:
         file.write(json.dumps(output_dict) + '\n')
 
-    # output_dicts = []
-    # with open(temp_text_name, "r") as file:
-    #     for line in file:
-    #         output_dicts.append(json.loads(line))
-
-    if len(untest_tokens) > 0:
-        exist_dict = pickle.load(open(saved_traj_name, 'rb'))
-        exist_dict.update(traj_dict)
-        fd = open(saved_traj_name, "wb")
-        pickle.dump(exist_dict, fd)
-
 print("#### Invalid Tokens ####")
 for token in invalid_tokens:
     print(token)
 
-if len(untest_tokens) == 0:
-    with open(saved_text_name, "wb") as f:
-        pickle.dump(text_dict, f)
-    with open(saved_traj_name, "wb") as f:
-        pickle.dump(traj_dict, f)
\ No newline at end of file
+cache.summary()
+cache.close()
+
+with metrics.timer("merge"):
+    checkpoint.merge(saved_traj_name, saved_text_name, tokens=test_tokens)
+checkpoint.close()
+metrics.summary()
+metrics.close()
@@ -0,0 +1,77 @@
+"""
+Shared fixtures: synthetic info dicts in the format of cached_nuscenes_info.pkl, and an offline stand-in
+for the tiktoken encodings (4 characters per token), so that the tests need neither the nuScenes data nor network access.
+"""
+import os
+import sys
+import json
+import pickle
+import numpy as np
+import pytest
+import tiktoken
+
+# the modules of gpt-driver import each other by their flat names, as when run from the command line
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NAMES = ["car", "truck", "pedestrian", "bicycle", "barrier", "traffic_cone", "vehicle.bus"]
+
+def make_data(num_samples=60, seed=0, max_objects=40):
+    """{token: info dict} with random perception, ego-states and trajectories."""
+    rng = np.random.default_rng(seed)
+    data = {}
+    for k in range(num_samples):
+        num_objects = int(rng.integers(0, max_objects))
+        boxes = rng.normal(0, 15, size=(num_objects, 9))
+        boxes[:, 3:6] = np.abs(boxes[:, 3:6]) / 3 + 0.5
+        fut_diff = rng.normal([0, 2], [1, 2], size=(6, 2)) * (k % 7 != 0) # every 7th sample stops
+        data[f"tok{k:05d}"] = {
+            'gt_boxes': boxes,
+            'gt_names': np.array([NAMES[i] for i in rng.integers(0, len(NAMES), num_objects)]) if num_objects > 0 else np.array([]),
+            'gt_agent_fut_trajs': rng.normal(0, 1, size=(num_objects, 12)),
+            'gt_agent_fut_masks': (rng.random((num_objects, 6)) > 0.2).astype(np.float64),
+            'gt_ego_lcf_feat': rng.normal(0, 3, size=9),
+            'gt_ego_his_trajs': np.cumsum(rng.normal(0, 2, size=(5, 2)), axis=0),
+            'gt_ego_his_diff': rng.normal(0, 2, size=(4, 2)) * (k % 5 != 0),
+            'gt_ego_fut_cmd': np.eye(3)[k % 3],
+            'gt_ego_fut_diff': fut_diff,
+            'gt_ego_fut_trajs': np.concatenate([np.zeros((1, 2)), np.cumsum(fut_diff, axis=0)], axis=0),
+            'gt_ego_fut_masks': np.ones(6),
+        }
+    return data
+
+class FakeEncoding:
+    name = "fake"
+
+    def encode(self, text, **kwargs):
+        return list(range(len(text) // 4))
+
+    def encode_ordinary(self, text):
+        return self.encode(text)
+
+    def encode_batch(self, texts, **kwargs):
+        return [self.encode(text) for text in texts]
+
+    def encode_ordinary_batch(self, texts, **kwargs):
+        return self.encode_batch(texts)
+
+@pytest.fixture(autouse=True)
+def offline_tiktoken(monkeypatch):
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: FakeEncoding())
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: FakeEncoding())
+
+@pytest.fixture
+def data():
+    return make_data()
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch, data):
+    """A working directory with data/cached_nuscenes_info.pkl, data/split.json and outputs/, as the scripts expect."""
+    os.makedirs(tmp_path / "data")
+    os.makedirs(tmp_path / "outputs")
+    with open(tmp_path / "data" / "cached_nuscenes_info.pkl", "wb") as f:
+        pickle.dump(data, f)
+    tokens = list(data)
+    with open(tmp_path / "data" / "split.json", "w") as f:
+        json.dump({"train": tokens[:len(tokens) * 2 // 3], "val": tokens[len(tokens) * 2 // 3:]}, f)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,154 @@
+import json
+import time
+import asyncio
+import contextlib
+from tenacity import stop_after_attempt, wait_none
+import async_inference
+from token_counter import TokenCounter
+from checkpoint import InferenceCheckpoint
+from response_cache import ResponseCache
+from completion_backend import Completion, get_backend
+from self_consistency import SelfConsistency
+from async_inference import RateLimiter, build_requests, run_inference
+
+TRAJECTORY = "Trajectory:\n[(0.00,2.00), (0.00,4.00), (0.00,6.00), (0.00,8.00), (0.00,10.00), (0.00,12.00)]"
+
+class GatedBackend:
+    """Answers every request with TRAJECTORY, the ones of `gated` tokens only once `gate` is set."""
+    def __init__(self, gated):
+        self.gated = gated
+        self.gate = asyncio.Event()
+        self.cache_params = {"backend": "gated"}
+
+    async def acomplete(self, model, messages, n=1, **params):
+        if any(token in messages[-1]["content"] for token in self.gated):
+            await self.gate.wait()
+        text = "garbage" if "invalid" in messages[-1]["content"] else TRAJECTORY
+        return Completion(text, 10, 5, [text] * n)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        yield
+
+class CountingBackend(GatedBackend):
+    """Tracks the calls in flight and fails every call of a `failing` token."""
+    def __init__(self, failing=()):
+        super().__init__(gated=())
+        self.failing = set(failing)
+        self.in_flight = self.max_in_flight = self.calls = 0
+
+    async def acomplete(self, model, messages, n=1, **params):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if messages[-1]["content"] in self.failing:
+                raise RuntimeError("server error")
+            return await super().acomplete(model, messages, n, **params)
+        finally:
+            self.in_flight -= 1
+
+def make_request(token):
+    return {"token": token, "messages": [{"role": "user", "content": token}], "num_tokens": 1,
+        "num_system_tokens": 0, "num_user_tokens": 1, "GT": ""}
+
+def test_rate_limiter_waits_for_budget():
+    limiter = RateLimiter(rpm=600, tpm=0)
+    limiter.request_budget = 0
+    start = time.monotonic()
+    asyncio.run(limiter.acquire())
+    assert time.monotonic() - start >= 0.09 # one request per 0.1 second
+
+def test_rate_limiter_disabled_and_across_loops():
+    async def acquire_all(limiter, num_requests, num_tokens=0):
+        await asyncio.gather(*[limiter.acquire(num_tokens) for _ in range(num_requests)])
+
+    asyncio.run(asyncio.wait_for(acquire_all(RateLimiter(rpm=0, tpm=0), 100, 10 ** 9), 1.0))
+    limiter = RateLimiter(rpm=60000, tpm=0)
+    for _ in range(2):
+        limiter.request_budget = 0 # the acquires queue on the lock in both loops
+        asyncio.run(acquire_all(limiter, 5))
+
+def test_concurrency_is_capped():
+    backend = CountingBackend()
+    requests = [make_request(f"t{i}") for i in range(20)] + [make_request("invalid")]
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(
+        run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), concurrency=3, backend=backend))
+    assert backend.max_in_flight == 3 and backend.calls == 21
+    assert list(traj_dict) == [request["token"] for request in requests[:-1]] and list(text_dict) == [request["token"] for request in requests]
+    assert invalid_tokens == ["invalid"] and failed_tokens == []
+
+def test_failed_tokens_are_recorded(tmp_path, monkeypatch):
+    monkeypatch.setattr(async_inference.acompletion_with_backoff.retry, "wait", wait_none())
+    monkeypatch.setattr(async_inference.acompletion_with_backoff.retry, "stop", stop_after_attempt(2))
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    backend = CountingBackend(failing={"b"})
+    requests = [make_request(token) for token in ["a", "b", "c"]]
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(
+        run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), checkpoint=checkpoint, backend=backend))
+    assert failed_tokens == ["b"] and list(traj_dict) == ["a", "c"]
+    assert backend.calls == 4 # "b" was retried once
+    assert checkpoint.status() == {"a": "done", "b": "failed", "c": "done"}
+
+def test_build_requests(data):
+    counter = TokenCounter("gpt-3.5-turbo")
+    tokens = list(data)
+    requests = build_requests(data, tokens[40:], tokens[:40], counter, completed_tokens={tokens[41]})
+    assert [request["token"] for request in requests] == tokens[40:41] + tokens[42:]
+    request = requests[0]
+    assert [message["role"] for message in request["messages"]] == ["system", "user"]
+    assert request["num_tokens"] == request["num_system_tokens"] + request["num_user_tokens"] + 256
+    assert "Trajectory" in request["GT"]
+    incontext = build_requests(data, tokens[40:], tokens[:40], counter, incontext=True)
+    assert len(incontext[0]["messages"][0]["content"]) > len(request["messages"][0]["content"])
+
+def test_run_inference_with_mock_backend(data, tmp_path):
+    counter = TokenCounter("gpt-3.5-turbo")
+    tokens = list(data)
+    requests = build_requests(data, tokens[40:], tokens[:40], counter)
+    backend = get_backend("mock", data=data, tokens=tokens[40:], counter=counter)
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(
+        run_inference(requests, "gpt-3.5-turbo", RateLimiter(rpm=0, tpm=0), checkpoint=checkpoint, backend=backend))
+    assert list(traj_dict) == tokens[40:] and invalid_tokens == [] and failed_tokens == []
+    assert checkpoint.completed_tokens() == set(tokens[40:])
+
+def test_records_every_token_as_it_completes(tmp_path):
+    temp_text_name = str(tmp_path / "temp.jsonl")
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    backend = GatedBackend(gated={"slow"})
+    requests = [make_request(token) for token in ["a", "slow", "b", "invalid"]]
+
+    async def main():
+        task = asyncio.create_task(run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), concurrency=3, temp_text_name=temp_text_name,
+            checkpoint=checkpoint, backend=backend, sampler=SelfConsistency(num_samples=3)))
+        for _ in range(100):
+            if len(checkpoint.status()) == 3:
+                break
+            await asyncio.sleep(0.01)
+        # the other three are recorded in one batch while "slow" is still in flight
+        assert checkpoint.status() == {"a": "done", "b": "done", "invalid": "invalid"}
+        with open(temp_text_name) as f:
+            assert sorted(json.loads(line)["token"] for line in f) == ["a", "b"]
+        backend.gate.set()
+        return await task
+
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(main())
+    assert list(text_dict) == ["a", "slow", "b", "invalid"] # ordered like the requests
+    assert list(traj_dict) == ["a", "slow", "b"] and invalid_tokens == ["invalid"]
+    assert checkpoint.status()["slow"] == "done"
+
+def test_invalid_tokens_are_queried_again(tmp_path):
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    requests = [make_request(token) for token in ["a", "b"]]
+    for request in requests:
+        cache.put("m", request["messages"], "garbage", **CountingBackend().cache_params)
+    checkpoint.record("a", "invalid", text="garbage") # "b" was never tried by this run
+    backend = CountingBackend()
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(
+        run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), checkpoint=checkpoint, cache=cache, backend=backend))
+    assert backend.calls == 1 and list(traj_dict) == ["a"] and invalid_tokens == ["b"]
+    assert checkpoint.status() == {"a": "done", "b": "invalid"}
+    assert cache.get("m", requests[0]["messages"], **backend.cache_params) == TRAJECTORY # the valid answer replaced the cached one
@@ -0,0 +1,74 @@
+import json
+import asyncio
+import threading
+import contextlib
+import pytest
+from token_counter import TokenCounter
+from checkpoint import InferenceCheckpoint
+from prompt_message import generate_assistant_messages
+from mock_server import MockResponder, MockServer, start_server
+from async_inference import build_requests
+from batch_inference import BatchClient, render_batches, submit, wait, collect
+
+@contextlib.contextmanager
+def serve(server):
+    """Run the mock server on a free port in a background event loop, yields its API base."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    runner = asyncio.run_coroutine_threadsafe(start_server(server, port=0), loop).result()
+    try:
+        yield f"http://localhost:{runner.addresses[0][1]}/v1"
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+@pytest.fixture
+def requests(data):
+    tokens = list(data)
+    return build_requests(data, tokens[40:], tokens[:40], TokenCounter("gpt-3.5-turbo"))
+
+def test_render_batches(requests):
+    batches = render_batches(requests, "m", max_requests=8)
+    assert [len(batch.splitlines()) for batch in batches] == [8, 8, 4]
+    line = json.loads(batches[0].splitlines()[0])
+    assert line["custom_id"] == requests[0]["token"] and line["body"] == {"model": "m", "messages": requests[0]["messages"]}
+    max_bytes = max(len(batch.splitlines()[0]) for batch in batches) + 1
+    assert all(len(batch) <= max_bytes for batch in render_batches(requests, "m", max_bytes=max_bytes))
+    assert render_batches([], "m") == []
+
+def test_submit_wait_and_collect(data, requests, tmp_path):
+    tokens = [request["token"] for request in requests]
+    server = MockServer(MockResponder(data, tokens), TokenCounter("gpt-3.5-turbo"), batch_latency=0.05)
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    with serve(server) as api_base:
+        client = BatchClient(api_base=api_base, api_key="mock")
+        batches = submit(client, requests, "m")
+        assert [token for batch_tokens in batches.values() for token in batch_tokens] == tokens
+        batch_ids = list(batches)
+        batches = wait(client, batch_ids, poll_interval=0.05)
+        assert [batch["status"] for batch in batches] == ["completed"]
+        invalid_tokens, failed_tokens = collect(client, batches[0], requests, "m", checkpoint)
+    assert invalid_tokens == [] and failed_tokens == []
+    text_dict, traj_dict = checkpoint.load()
+    assert [text_dict[token] for token in tokens] == generate_assistant_messages(data, tokens)
+    assert set(traj_dict) == set(tokens)
+
+def test_failed_requests_are_recorded(data, requests, tmp_path):
+    tokens = [request["token"] for request in requests]
+    server = MockServer(MockResponder(data, tokens), TokenCounter("gpt-3.5-turbo"), batch_latency=0.0, error_rate=1.0)
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    with serve(server) as api_base:
+        client = BatchClient(api_base=api_base, api_key="mock")
+        batches = wait(client, submit(client, requests[:3], "m"), poll_interval=0.05)
+        invalid_tokens, failed_tokens = collect(client, batches[0], requests, "m", checkpoint)
+    assert failed_tokens == tokens[:3] and checkpoint.pending(tokens[:3]) == tokens[:3]
+
+def test_unanswered_tokens_of_an_expired_batch_are_failed(requests, tmp_path):
+    tokens = [request["token"] for request in requests[:3]]
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    batch = {"id": "batch_0", "status": "expired", "output_file_id": None, "error_file_id": None}
+    invalid_tokens, failed_tokens = collect(BatchClient(api_base="http://localhost:1/v1"), batch, requests, "m", checkpoint, tokens=tokens)
+    assert invalid_tokens == [] and failed_tokens == tokens
+    assert checkpoint.status() == {token: "failed" for token in tokens}
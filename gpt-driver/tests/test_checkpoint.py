@@ -0,0 +1,36 @@
+import pickle
+import numpy as np
+from checkpoint import InferenceCheckpoint
+
+def test_later_attempt_supersedes(tmp_path):
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    checkpoint.record("a", "failed")
+    checkpoint.record("b", "invalid", text="garbage")
+    assert checkpoint.status() == {"a": "failed", "b": "invalid"}
+    assert checkpoint.completed_tokens() == set()
+    checkpoint.record("b", "done", text="Trajectory: ...", traj=np.ones((6, 2)))
+    assert checkpoint.status() == {"a": "failed", "b": "done"}
+    assert checkpoint.pending(["c", "b", "a"]) == ["c", "a"] # original order, invalid and failed are retried
+
+def test_results_survive_a_restart(tmp_path):
+    path = str(tmp_path / "checkpoint.db")
+    checkpoint = InferenceCheckpoint(path)
+    checkpoint.record("a", "done", text="text a", traj=np.arange(12.0).reshape(6, 2))
+    checkpoint.record("b", "invalid", text="text b")
+    checkpoint.conn.close() # no close() call, like a killed run
+    text_dict, traj_dict = InferenceCheckpoint(path).load()
+    assert text_dict == {"a": "text a", "b": "text b"}
+    assert list(traj_dict) == ["a"]
+    np.testing.assert_array_equal(traj_dict["a"], np.arange(12.0).reshape(6, 2))
+
+def test_merge_orders_like_the_tokens(tmp_path):
+    checkpoint = InferenceCheckpoint(str(tmp_path / "checkpoint.db"))
+    for token in ["c", "a", "b"]:
+        checkpoint.record(token, "done", text=token, traj=np.zeros((6, 2)))
+    traj_name, text_name = str(tmp_path / "traj.pkl"), str(tmp_path / "text.pkl")
+    checkpoint.merge(traj_name, text_name, tokens=["a", "b", "c", "d"])
+    checkpoint.close()
+    with open(text_name, "rb") as f:
+        assert pickle.load(f) == {"a": "a", "b": "b", "c": "c"}
+    with open(traj_name, "rb") as f:
+        assert list(pickle.load(f)) == ["a", "b", "c"]
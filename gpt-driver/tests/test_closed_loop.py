@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from token_counter import TokenCounter
+from completion_backend import get_backend
+from async_inference import RateLimiter
+from closed_loop import NUM_STEPS, LLMPlanner, ReplayPlanner, ConstantVelocityPlanner, rotate, to_ego, to_world, simulate, report
+
+def test_frames_round_trip():
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(5, 3, 2))
+    poses = rng.normal(size=(5, 3))
+    np.testing.assert_allclose(to_world(to_ego(points, poses), poses), points)
+    np.testing.assert_allclose(rotate(np.array([[[0.0, 1.0]]]), np.array([np.pi / 2])), [[[-1.0, 0.0]]], atol=1e-12)
+
+def test_replay_follows_the_log(data):
+    tokens = list(data)[:20]
+    executed, collided = simulate(data, tokens, ReplayPlanner())
+    logged = np.stack([data[token]['gt_ego_fut_trajs'][1:] for token in tokens])
+    np.testing.assert_allclose(executed, logged, atol=1e-9)
+    result = report(data, tokens, executed, collided)
+    assert result["num_rollouts"] == 20
+    assert all(value < 1e-9 for value in result["L2"].values())
+
+def test_boxes_without_velocities(data):
+    tokens = list(data)[:10]
+    boxes_7 = {token: {**data[token], 'gt_boxes': data[token]['gt_boxes'][:, :7]} for token in tokens}
+    executed, collided = simulate(boxes_7, tokens, ReplayPlanner())
+    np.testing.assert_array_equal(collided, simulate(data, tokens, ReplayPlanner())[1])
+    narrow = {token: {**data[token], 'gt_boxes': data[token]['gt_boxes'][:, :5]} for token in tokens}
+    with pytest.raises(ValueError, match="7 columns"):
+        simulate(narrow, tokens, ReplayPlanner())
+
+def test_constant_velocity_replans(data):
+    tokens = list(data)[:10]
+    executed, collided = simulate(data, tokens, ConstantVelocityPlanner(), replan_every=2)
+    assert executed.shape == (10, NUM_STEPS, 2) and collided.shape == (10, NUM_STEPS)
+    assert np.isfinite(executed).all()
+
+class RecordingLimiter(RateLimiter):
+    """Keeps the errors of acquire, which the retries of acompletion_with_backoff would hide."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = []
+
+    async def acquire(self, num_tokens=0):
+        try:
+            await super().acquire(num_tokens)
+        except RuntimeError as e:
+            self.errors.append(e)
+            raise
+
+def test_llm_planner_shares_a_limiter_over_steps(data):
+    tokens = list(data)[:12]
+    counter = TokenCounter("gpt-3.5-turbo")
+    backend = get_backend("mock", data=data, tokens=tokens, counter=counter)
+    limiter = RecordingLimiter(rpm=0, tpm=600000)
+    limiter.token_budget = 0 # every step spends more than the refill, so that requests queue on the limiter's lock at every step
+    planner = LLMPlanner(backend, "gpt-3.5-turbo", counter, limiter=limiter, concurrency=4)
+    executed, collided = simulate(data, tokens, planner, replan_every=2)
+    assert np.isfinite(executed).all()
+    assert planner.num_invalid == 0
+    assert limiter.errors == []
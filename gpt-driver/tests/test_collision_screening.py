@@ -0,0 +1,61 @@
+import numpy as np
+from conftest import make_data
+from prompt_message import (generate_chain_of_thoughts, generate_chain_of_thoughts_batch, detect_object_collisions,
+    collision_detection, batch_collision_detection)
+
+def loop_collisions(data_dict, perception_range=20.0):
+    """The per-object, per-timestep screening that generate_chain_of_thoughts used to run."""
+    vx, vy = data_dict['gt_ego_lcf_feat'][:2] * 0.5
+    ax, ay = data_dict['gt_ego_his_diff'][-1] - data_dict['gt_ego_his_diff'][-2]
+    ego_estimate_trajs = np.cumsum([[0, 0]] + [[vx + k * ax, vy + k * ay] for k in range(6)], axis=0)
+    object_boxes = data_dict['gt_boxes']
+    object_fut_trajs = np.cumsum(data_dict['gt_agent_fut_trajs'].reshape(-1, 6, 2), axis=1) + object_boxes[:, None, :2]
+    object_fut_trajs = np.concatenate([object_boxes[:, None, :2], object_fut_trajs], axis=1)
+    object_collisons = np.zeros((object_boxes.shape[0], 7))
+    for i in range(object_boxes.shape[0]):
+        if (object_fut_trajs[i, :, 1] <= 0).all() or (np.abs(object_fut_trajs[i]) > perception_range).any():
+            continue
+        for t in range(7):
+            if t > 0 and not data_dict['gt_agent_fut_masks'][i, t-1] > 0:
+                continue
+            size_x, size_y = object_boxes[i, 3:5] * 0.5
+            if collision_detection(*ego_estimate_trajs[t], 0.925, 2.04, *object_fut_trajs[i, t], size_x, size_y):
+                object_collisons[i, t] = 1
+                break
+    return object_collisons
+
+def close_objects(seed):
+    """Objects right in front of ego, so that many of them enter the safe zone."""
+    data = make_data(num_samples=30, seed=seed)
+    rng = np.random.default_rng(seed)
+    for data_dict in data.values():
+        num_objects = data_dict['gt_boxes'].shape[0]
+        data_dict['gt_boxes'][:, :2] = rng.normal([0, 6], [2, 4], size=(num_objects, 2))
+    return data
+
+def test_screening_matches_the_loop():
+    for seed in range(3):
+        data_dicts = list(close_objects(seed).values())
+        object_collisons = detect_object_collisions(data_dicts)
+        num_collisions = 0
+        for b, data_dict in enumerate(data_dicts):
+            expected = loop_collisions(data_dict)
+            num_objects = expected.shape[0]
+            np.testing.assert_array_equal(object_collisons[b, :num_objects], expected)
+            assert not object_collisons[b, num_objects:].any() # padding never collides
+            num_collisions += int(expected.sum())
+        assert num_collisions > 0
+
+def test_batch_matches_single_samples():
+    data_dicts = list(close_objects(0).values())
+    thoughts = generate_chain_of_thoughts_batch(data_dicts)
+    assert thoughts == [generate_chain_of_thoughts(data_dict) for data_dict in data_dicts]
+    assert any("within the safe zone" in thought for thought in thoughts)
+    assert any("Notable Objects from Perception: None" in thought for thought in thoughts)
+
+def test_batch_collision_detection():
+    rng = np.random.default_rng(0)
+    x1, y1, x2, y2 = rng.normal(0, 4, size=(4, 200))
+    sx2, sy2 = np.abs(rng.normal(1, 1, size=(2, 200)))
+    expected = [collision_detection(a, b, 0.925, 2.04, c, d, e, f) for a, b, c, d, e, f in zip(x1, y1, x2, y2, sx2, sy2)]
+    np.testing.assert_array_equal(batch_collision_detection(x1, y1, 0.925, 2.04, x2, y2, sx2, sy2), expected)
@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+import numpy as np
+from prompt_message import generate_user_messages
+from trajectory_parser import OK, EMPTY, NO_TRAJECTORY, WRONG_SHAPE, TRUNCATED
+from compact_encoding import (
+    format_trajectory, format_trajectories, decode_trajectory, decode_trajectories, decode_user_message, quantize,
+)
+
+GPT_DRIVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_trajectory_round_trip(data):
+    trajs = np.stack([d['gt_ego_fut_trajs'][1:] for d in data.values()])
+    decoded, reasons = decode_trajectories(format_trajectories(trajs))
+    assert (reasons == OK).all()
+    np.testing.assert_allclose(decoded, np.rint(trajs * 10) / 10, atol=1e-9)
+    traj, reason = decode_trajectory("Trajectory:\n" + format_trajectory(trajs[0]))
+    assert reason == OK
+    np.testing.assert_allclose(traj, decoded[0])
+
+def test_text_encoding_is_in_meters():
+    traj, reason = decode_trajectory("[(0.1,2.5),(0.2,5.0),(0.3,7.5),(0.4,10.0),(0.5,12.5),(0.6,15.0)]", encoding="text")
+    assert reason == OK
+    np.testing.assert_allclose(traj[-1], [0.6, 15.0])
+
+def test_malformed_trajectories():
+    texts = ["", "Meta Action: STOP", "[(12,250),(25,500)]", "[(12,250),(25,500),(37,"]
+    trajs, reasons = decode_trajectories(texts)
+    assert reasons.tolist() == [EMPTY, NO_TRAJECTORY, WRONG_SHAPE, TRUNCATED]
+    assert np.isnan(trajs).all()
+    assert decode_trajectory(texts[3]) == (None, TRUNCATED)
+
+def test_malformed_long_integers_decode_in_time():
+    script = (
+        "from compact_encoding import decode_trajectory, decode_trajectories\n"
+        "points = ['(' + '9' * 12 + ',' + '8' * 12 + ')'] * 6\n"
+        "texts = ['[' + ','.join(points[:n]) for n in range(1, 7)] + ['[' + ','.join(points + points[:1]) + ']']\n"
+        "for text in texts:\n"
+        "    decode_trajectory(text)\n"
+        "decode_trajectories(texts * 100)\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=GPT_DRIVER_DIR, check=True, timeout=20)
+
+def test_user_message_round_trip(data):
+    tokens = list(data)
+    for token, user_message in zip(tokens, generate_user_messages(data, tokens, encoding="compact")):
+        d = data[token]
+        decoded = decode_user_message(user_message)
+        np.testing.assert_allclose(decoded["velocity"], np.asarray(quantize(d['gt_ego_lcf_feat'][:2] * 0.5)) / 10)
+        np.testing.assert_allclose(decoded["history"], np.asarray(quantize(d['gt_ego_his_trajs'][:4])) / 10)
+        assert decoded["mission_goal"] == ("RIGHT", "LEFT", "FORWARD")[int(np.argmax(d['gt_ego_fut_cmd']))]
+        for name, (ox, oy), future in decoded["objects"]:
+            assert abs(ox) <= 20.05 and abs(oy) <= 20.05
+            assert len(future) == 1
@@ -0,0 +1,29 @@
+import json
+import dataset_builder
+from prompt_message import system_message, generate_user_message, generate_assistant_message
+
+def serial_records(data, tokens, traj_only=False):
+    """The records as create_data.py built them, one token at a time."""
+    return "\n".join(json.dumps({"messages": [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": generate_user_message(data, token)},
+        {"role": "assistant", "content": generate_assistant_message(data, token, traj_only=traj_only)},
+    ]}) for token in tokens)
+
+def test_matches_the_serial_build(workdir, data, capsys):
+    tokens = list(data)[:45]
+    dataset_builder.build_dataset(tokens, "train.json", num_workers=1, shard_size=8)
+    assert open("train.json").read() == serial_records(data, tokens)
+    assert "Number of total tokens" in capsys.readouterr().out
+    dataset_builder.build_dataset(tokens, "traj_only.json", traj_only=True, num_workers=1)
+    assert open("traj_only.json").read() == serial_records(data, tokens, traj_only=True)
+
+def test_workers_write_the_same_file(workdir, data):
+    tokens = list(data)
+    dataset_builder.build_dataset(tokens, "serial.json", num_workers=1, shard_size=7)
+    dataset_builder.build_dataset(tokens, "parallel.json", num_workers=2, shard_size=7)
+    assert open("parallel.json").read() == open("serial.json").read()
+
+def test_empty_split(workdir):
+    dataset_builder.build_dataset([], "empty.json", num_workers=1)
+    assert open("empty.json").read() == ""
@@ -0,0 +1,68 @@
+import numpy as np
+import prompt_message
+import meta_actions
+import compact_encoding
+import spatial_index
+import dataset_builder
+from dataset_cache import USER_MESSAGE_CODE, ASSISTANT_MESSAGE_CODE, DatasetCache, dependencies, code_hash, input_hash
+
+def test_user_message_code_covers_the_builder_calls():
+    for obj in [prompt_message.generate_user_messages, prompt_message.generate_user_message_parts,
+            prompt_message._generate_user_message_parts_batch, prompt_message.select_objects, prompt_message.pad_objects,
+            compact_encoding, spatial_index]:
+        assert any(obj is code for code in USER_MESSAGE_CODE)
+    assert not any(obj is prompt_message.generate_assistant_messages for obj in USER_MESSAGE_CODE)
+
+def test_assistant_message_code_covers_the_builder_calls():
+    for obj in [prompt_message.generate_assistant_messages, prompt_message.generate_chain_of_thoughts_batch,
+            prompt_message.detect_object_collisions, prompt_message.batch_collision_detection,
+            meta_actions.meta_action_codes, meta_actions.render_meta_actions, meta_actions.META_ACTIONS, compact_encoding]:
+        assert any(obj is code for code in ASSISTANT_MESSAGE_CODE)
+
+def test_dependencies_skip_third_party_code():
+    found = dependencies([prompt_message.generate_user_messages])
+    assert not any(obj is np for obj in found)
+    assert len(found) == len({id(obj) for obj in found})
+
+def test_code_hash_depends_on_code_and_params():
+    key = code_hash(USER_MESSAGE_CODE, encoding="text", max_objects=None)
+    assert key == code_hash(USER_MESSAGE_CODE, max_objects=None, encoding="text")
+    assert key != code_hash(USER_MESSAGE_CODE, encoding="compact", max_objects=None)
+    assert key != code_hash(ASSISTANT_MESSAGE_CODE, encoding="text", max_objects=None)
+
+def test_input_hash(data):
+    d = data["tok00001"]
+    assert input_hash(d) == input_hash(dict(reversed(list(d.items()))))
+    changed = {**d, 'gt_boxes': d['gt_boxes'].copy()}
+    changed['gt_boxes'][0, 0] += 1e-6
+    assert input_hash(changed) != input_hash(d)
+    assert input_hash({**d, 'gt_ego_fut_cmd': d['gt_ego_fut_cmd'].astype(np.float32)}) != input_hash(d)
+
+def test_dataset_cache_store_and_load(tmp_path):
+    cache = DatasetCache(str(tmp_path / "dataset_cache.db"))
+    cache.store([("a", "h", "uk", "user", 3, "ak", "assistant", 4)])
+    cache.store([("a", "h2", "uk", "user 2", 5, "ak", "assistant", 4), ("b", "h", "uk", "user", 3, "ak", "assistant", 4)])
+    assert len(cache) == 2
+    assert cache.load()["a"] == ("h2", "uk", "user 2", 5, "ak", "assistant", 4)
+    assert cache.get_meta("system_message") is None
+    cache.set_meta("system_message", "system")
+    assert cache.get_meta("system_message") == "system"
+    cache.close()
+
+def test_incremental_build_matches_full_build(workdir, data, capsys):
+    tokens = list(data)[:30]
+    dataset_builder.build_dataset(tokens, "full.json", num_workers=1)
+    dataset_builder.build_dataset(tokens[:20], "incremental.json", num_workers=1, cache="cache.db")
+    dataset_builder.build_dataset(tokens, "incremental.json", num_workers=1, cache="cache.db")
+    assert "new 10, changed inputs 0" in capsys.readouterr().out
+    with open("full.json") as full, open("incremental.json") as incremental:
+        assert full.read() == incremental.read()
+
+    cache = DatasetCache("cache.db") # as if the user message code had changed since the last build
+    cache.conn.execute("UPDATE records SET user_key = 'old'")
+    cache.conn.commit()
+    cache.close()
+    dataset_builder.build_dataset(tokens, "incremental.json", num_workers=1, cache="cache.db")
+    assert "Re-rendered: user 30, assistant 0 messages" in capsys.readouterr().out
+    with open("full.json") as full, open("incremental.json") as incremental:
+        assert full.read() == incremental.read()
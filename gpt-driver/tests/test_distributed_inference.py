@@ -0,0 +1,58 @@
+import asyncio
+import argparse
+import distributed_inference
+from async_inference import RateLimiter
+from distributed_inference import ShardDirectory, partition, plan, work, merge, worker_limit
+
+def make_args(**kwargs):
+    args = dict(id="gpt-3.5-turbo", rpm=3500, tpm=90000, cache="", backend="mock", api_base=None, encoding="text",
+        max_objects=None, concurrency=4, steal_after=600.0, poll_interval=0.01)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def test_partition_is_stable_and_complete():
+    tokens = [f"t{i}" for i in range(100)]
+    shards = partition(tokens, 4)
+    assert shards == partition(list(reversed(tokens)), 4)[::-1]
+    assert set(shards) == {0, 1, 2, 3}
+    contiguous = partition(tokens, 4, "contiguous")
+    assert contiguous == sorted(contiguous) and contiguous.count(0) == 25
+    scenes = {token: f"scene{i // 10}" for i, token in enumerate(tokens)}
+    by_scene = partition(tokens, 4, "scene", scenes)
+    assert all(len({s for t, s in zip(tokens, by_scene) if scenes[t] == scene}) == 1 for scene in set(scenes.values()))
+
+def test_worker_limit_never_disables():
+    assert worker_limit(3500, 4) == 875
+    assert worker_limit(3, 4) == 1
+    assert worker_limit(0, 4) == 0
+
+def test_claims_are_exclusive(tmp_path):
+    shards = ShardDirectory(str(tmp_path / "shards"))
+    assert shards.claim("c0", "a")
+    assert not shards.claim("c0", "b")
+    assert not shards.claim("c0", "b", steal_after=600.0)
+    assert shards.claim("c0", "b", steal_after=0.0) # a straggler's claim is taken over
+    shards.mark_done("c0", "b")
+    assert not shards.claim("c0", "c", steal_after=0.0)
+
+def test_work_runs_all_chunks_in_one_loop(workdir, data, monkeypatch):
+    loops = set()
+
+    class RecordingLimiter(RateLimiter):
+        async def acquire(self, num_tokens=0):
+            loops.add(asyncio.get_running_loop())
+            await super().acquire(num_tokens)
+
+    monkeypatch.setattr(distributed_inference, "RateLimiter", RecordingLimiter)
+    tokens = list(data)[-20:]
+    shards = ShardDirectory("outputs/val_shards")
+    current_plan = plan(shards, tokens, 1, chunk_size=8)
+    assert len(current_plan["rounds"][-1]) == 3
+    asyncio.run(work(shards, make_args(), 0, "w0"))
+    assert len(loops) == 1
+    assert all(shards.is_done(chunk["id"]) for chunk in current_plan["rounds"][-1])
+
+    text_dict, traj_dict = merge(shards, "outputs/val.pkl", "outputs/val_text.pkl")
+    assert list(text_dict) == tokens and list(traj_dict) == tokens
+    plan(shards, tokens, 1, chunk_size=8) # nothing left to plan
+    assert len(shards.load_plan()["rounds"]) == 1
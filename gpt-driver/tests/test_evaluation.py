@@ -0,0 +1,66 @@
+import pickle
+import numpy as np
+import pytest
+from evaluation import load_predictions, trajectory_yaws, box_overlaps, collisions, evaluate
+
+def scene(object_box, object_steps):
+    """One sample whose ego drives 2m forward per step, with a single object moving by `object_steps`."""
+    fut_trajs = np.concatenate([np.zeros((1, 2)), np.stack([np.zeros(6), 2.0 * np.arange(1, 7)], axis=1)])
+    return {
+        'gt_boxes': np.array([object_box], dtype=np.float64),
+        'gt_agent_fut_trajs': np.asarray(object_steps, dtype=np.float64).reshape(1, 12),
+        'gt_agent_fut_masks': np.ones((1, 6)),
+        'gt_ego_fut_trajs': fut_trajs,
+        'gt_ego_fut_masks': np.ones(6),
+    }
+
+def test_l2_and_collisions():
+    data = {
+        "ahead": scene([0, 7, 0, 2, 4, 1.5, 0, 0, 0], np.zeros((6, 2))), # parked 7m ahead, within reach from 1s to 2.5s
+        "aside": scene([5, 7, 0, 2, 4, 1.5, 0, 0, 0], np.zeros((6, 2))),
+    }
+    tokens = list(data)
+    gt_trajs = np.stack([data[token]['gt_ego_fut_trajs'][1:] for token in tokens])
+    np.testing.assert_array_equal(collisions(data, tokens, gt_trajs), [[False, True, True, True, True, False], [False] * 6])
+    report = evaluate(data, tokens, gt_trajs + [1.0, 0.0])
+    assert report["L2"] == pytest.approx({"1s": 1.0, "2s": 1.0, "3s": 1.0, "avg": 1.0})
+    assert report["num_samples"] == 2
+    # stp3 averages the timesteps up to the horizon, uniad takes the one at the horizon
+    assert evaluate(data, tokens, gt_trajs)["collision"]["1s"] == pytest.approx(25.0)
+    assert evaluate(data, tokens, gt_trajs, metric="uniad")["collision"]["1s"] == pytest.approx(50.0)
+
+def test_missing_ground_truth_is_skipped():
+    data = {"a": scene([50, 50, 0, 1, 1, 1, 0, 0, 0], np.zeros((6, 2)))}
+    data["a"]['gt_ego_fut_masks'] = np.array([1, 1, 0, 0, 0, 0])
+    trajs = data["a"]['gt_ego_fut_trajs'][None, 1:] + [0.0, 3.0]
+    assert evaluate(data, ["a"], trajs)["L2"]["3s"] == pytest.approx(3.0)
+    report = evaluate(data, ["a"], trajs, metric="uniad")
+    assert report["L2"]["1s"] == pytest.approx(3.0) and np.isnan(report["L2"]["3s"])
+
+def test_box_overlaps():
+    size = np.array([2.0, 4.0])
+    assert box_overlaps(np.zeros(2), 0.0, size, np.array([1.9, 0.0]), 0.0, size)
+    assert not box_overlaps(np.zeros(2), 0.0, size, np.array([2.1, 0.0]), 0.0, size)
+    # a box turned by 90 degrees is 4m wide along x
+    assert box_overlaps(np.zeros(2), 0.0, size, np.array([2.9, 0.0]), np.pi / 2, size)
+    assert not box_overlaps(np.zeros(2), 0.0, size, np.array([3.1, 0.0]), np.pi / 2, size)
+
+def test_trajectory_yaws():
+    trajs = np.array([[0, 1], [0, 2], [1, 2], [1, 2.01], [1, 2.01], [0, 2.01]], dtype=np.float64)
+    np.testing.assert_allclose(trajectory_yaws(trajs), [0, 0, -np.pi / 2, -np.pi / 2, -np.pi / 2, np.pi / 2])
+    np.testing.assert_array_equal(trajectory_yaws(np.zeros((6, 2))), np.zeros(6))
+
+def test_candidates_match_single_trajectories(data):
+    tokens = list(data)
+    rng = np.random.default_rng(0)
+    trajs = np.cumsum(rng.normal([0, 2], 1, size=(len(tokens), 3, 6, 2)), axis=2)
+    batched = collisions(data, tokens, trajs, batch_size=16)
+    for s in range(3):
+        np.testing.assert_array_equal(batched[:, s], collisions(data, tokens, trajs[:, s]))
+
+def test_load_predictions(tmp_path):
+    filename = str(tmp_path / "traj.pkl")
+    with open(filename, "wb") as f:
+        pickle.dump({"a": np.ones((6, 2)), "b": np.zeros(12).tolist()}, f)
+    tokens, trajs = load_predictions(filename)
+    assert tokens == ["a", "b"] and trajs.shape == (2, 6, 2)
@@ -0,0 +1,57 @@
+import json
+import asyncio
+import pytest
+from token_counter import TokenCounter
+from mock_server import MockResponder, MockServer, start_server
+from finetune import validate, finetune, resolve_model_id
+
+def record(i):
+    return {"messages": [{"role": "system", "content": "s" * 40}, {"role": "user", "content": f"scene {i} " * 10},
+        {"role": "assistant", "content": "a" * 80}]}
+
+def write_records(path, records):
+    with open(path, "w") as f:
+        f.write("\n".join(json.dumps(record) if isinstance(record, dict) else record for record in records))
+
+def test_validate(tmp_path):
+    path = str(tmp_path / "train.json")
+    write_records(path, [record(0), "not json", {"messages": [{"role": "user", "content": "no answer"}]}, record(3), ""])
+    report = validate(path, TokenCounter("gpt-3.5-turbo"), chunk_size=1)
+    assert report["errors"] == [(2, "invalid JSON"), (3, "no assistant message")]
+    num_tokens = 3 + (10 + 3) + (len("scene 0 " * 10) // 4 + 3) + (20 + 3)
+    assert report["parts"][0]["num_records"] == 2 and report["parts"][0]["num_tokens"] == 2 * num_tokens
+    assert report["usage"].num_assistant_tokens == 40
+    assert validate(path, TokenCounter("gpt-3.5-turbo"), max_example_tokens=10)["long_examples"] == [(1, num_tokens), (4, num_tokens)]
+
+def test_parts_are_whole_records(tmp_path):
+    path = str(tmp_path / "train.json")
+    write_records(path, [record(i) for i in range(10)])
+    report = validate(path, TokenCounter("gpt-3.5-turbo"), max_file_tokens=250)
+    assert [part["num_records"] for part in report["parts"]] == [4, 4, 2]
+    content = open(path, "rb").read()
+    assert b"".join(content[part["start"]:part["end"]] for part in report["parts"]) == content
+    assert len(set(part["sha256"] for part in report["parts"])) == 3
+
+def test_finetune_against_the_mock_server(tmp_path, data):
+    path = str(tmp_path / "train.json")
+    state_name = str(tmp_path / "finetune.json")
+    write_records(path, [record(i) for i in range(6)])
+    server = MockServer(MockResponder(data, []), TokenCounter("gpt-3.5-turbo"), finetune_latency=0.04)
+
+    async def main():
+        runner = await start_server(server, port=0)
+        api_base = f"http://localhost:{runner.addresses[0][1]}/v1"
+        try:
+            model = await finetune(path, max_file_tokens=250, api_base=api_base, poll_interval=0.01, state_name=state_name)
+            again = await finetune(path, max_file_tokens=250, api_base=api_base, poll_interval=0.01, state_name=state_name)
+            return model, again
+        finally:
+            await runner.cleanup()
+
+    with pytest.raises(ValueError):
+        resolve_model_id("latest", state_name)
+    model, again = asyncio.run(main())
+    assert model == again and model.startswith("ft:gpt-3.5-turbo-0613:mock")
+    assert len(server.jobs) == 2 and len(server.files) == 2 # the second part continues from the first, nothing is redone
+    assert [job["model"] for job in server.jobs.values()][0] == "gpt-3.5-turbo"
+    assert resolve_model_id("latest", state_name) == model and resolve_model_id("gpt-4", state_name) == "gpt-4"
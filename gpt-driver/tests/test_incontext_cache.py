@@ -0,0 +1,43 @@
+import os
+import json
+from token_counter import TokenCounter
+from prompt_message import generate_incontext_messages
+from incontext_cache import IncontextExamples, build_incontext_cache, load_incontext_cache, incontext_key
+
+def test_cache_returns_the_rendered_examples(workdir, data):
+    tokens = list(data)[:25]
+    build_incontext_cache(tokens, "data/incontext_cache/cot", num_workers=1, shard_size=10)
+    cache = load_incontext_cache("cot")
+    assert list(cache) == tokens and len(cache) == 25
+    assert [cache[token] for token in tokens] == generate_incontext_messages(data, tokens)
+
+    counter = TokenCounter("gpt-3.5-turbo")
+    examples = IncontextExamples(data, counter)
+    other = list(data)[30:32] # not packed, rendered on demand
+    messages, num_tokens = examples.get(tokens[:3] + other)
+    assert messages == generate_incontext_messages(data, tokens[:3] + other)
+    assert num_tokens == [counter.count(message) for message in messages]
+
+def test_stale_cache_is_ignored(workdir, data):
+    tokens = list(data)[:5]
+    build_incontext_cache(tokens, "data/incontext_cache/traj_only", variant="traj_only", num_workers=1)
+    assert load_incontext_cache("traj_only") is not None
+    assert load_incontext_cache("traj_only", perception="uniad") is None
+
+    with open("data/incontext_cache/traj_only/meta.json") as f:
+        meta = json.load(f)
+    assert meta["key"] == incontext_key("traj_only")
+    meta["key"] = "rendered by older code"
+    with open("data/incontext_cache/traj_only/meta.json", "w") as f:
+        json.dump(meta, f)
+    assert load_incontext_cache("traj_only") is None
+    messages, _ = IncontextExamples(data, TokenCounter("gpt-3.5-turbo"), variant="traj_only").get(tokens)
+    assert messages == generate_incontext_messages(data, tokens, traj_only=True)
+
+def test_cache_of_other_info_is_ignored(workdir, data):
+    tokens = list(data)[:5]
+    build_incontext_cache(tokens, "data/incontext_cache/cot", num_workers=1)
+    assert load_incontext_cache("cot") is not None
+    stat = os.stat("data/cached_nuscenes_info.pkl") # e.g. a rebuilt cached_nuscenes_info.pkl
+    os.utime("data/cached_nuscenes_info.pkl", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load_incontext_cache("cot") is None
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from prompt_message import generate_meta_action
+from meta_actions import META_ACTIONS, meta_action_codes, render_meta_actions, stack_meta_action_inputs, meta_action_histogram
+
+def fuzzed_inputs(num_samples=2000, seed=0):
+    """Speeds and lateral offsets spread around the thresholds of the rules, on a 0.25 grid to hit them exactly."""
+    rng = np.random.default_rng(seed)
+    ego_his_diff = np.round(rng.normal(0, 1.5, size=(num_samples, 4, 2)) * 4) / 4
+    ego_fut_diff = np.round(rng.normal(0, 1.5, size=(num_samples, 6, 2)) * 4) / 4
+    ego_fut_diff[rng.random(num_samples) < 0.1] = 0.0
+    ego_fut_trajs = np.concatenate([np.zeros((num_samples, 1, 2)), np.cumsum(ego_fut_diff, axis=1)], axis=1)
+    ego_fut_trajs[:, -1, 0] += (ego_fut_trajs[:, -1, 0] == 0) * 0.25 # no undefined behavior
+    return ego_fut_diff, ego_fut_trajs, ego_his_diff
+
+def test_matches_generate_meta_action():
+    ego_fut_diff, ego_fut_trajs, ego_his_diff = fuzzed_inputs()
+    codes = meta_action_codes(ego_fut_diff, ego_fut_trajs, ego_his_diff)
+    expected = [
+        generate_meta_action(ego_fut_diff=fut_diff, ego_fut_trajs=fut_trajs, ego_his_diff=his_diff, ego_his_trajs=None)
+        for fut_diff, fut_trajs, his_diff in zip(ego_fut_diff, ego_fut_trajs, ego_his_diff)
+    ]
+    assert render_meta_actions(codes) == expected
+    assert len(set(codes.tolist())) > 20 # most of the labels are exercised
+
+def test_info_dicts(data):
+    data_dicts = list(data.values())
+    codes = meta_action_codes(*stack_meta_action_inputs(data_dicts))
+    expected = [generate_meta_action(ego_fut_diff=d['gt_ego_fut_diff'], ego_fut_trajs=d['gt_ego_fut_trajs'],
+        ego_his_diff=d['gt_ego_his_diff'], ego_his_trajs=d['gt_ego_his_trajs']) for d in data_dicts]
+    assert render_meta_actions(codes) == expected
+
+def test_undefined_behavior_raises():
+    ego_fut_diff = np.array([[[3.0, 1.0], [-3.0, 1.0], [0.0, 1.0], [0.0, 1.0], [0.0, 1.0], [0.0, 1.0]]])
+    ego_fut_trajs = np.concatenate([np.zeros((1, 1, 2)), np.cumsum(ego_fut_diff, axis=1)], axis=1) # ends at x = 0 after a swerve
+    ego_his_diff = np.ones((1, 4, 2))
+    with pytest.raises(ValueError):
+        generate_meta_action(ego_fut_diff[0], ego_fut_trajs[0], ego_his_diff[0], None)
+    with pytest.raises(ValueError):
+        meta_action_codes(ego_fut_diff, ego_fut_trajs, ego_his_diff)
+    assert meta_action_codes(np.zeros_like(ego_fut_diff), ego_fut_trajs, np.zeros_like(ego_his_diff)).tolist() == [0] # stopped
+
+def test_histogram():
+    histogram = meta_action_histogram([0, 3, 3, 1, 3, 1])
+    assert histogram == {META_ACTIONS[3]: 3, META_ACTIONS[1]: 2, "stop": 1}
+    assert list(histogram)[0] == "move forward with a quick deceleration"
+    assert meta_action_histogram([]) == {}
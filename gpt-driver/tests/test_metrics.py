@@ -0,0 +1,59 @@
+import json
+import types
+import time
+from metrics import BUCKETS, Histogram, Metrics, count_retry
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    for seconds in [0.00005, 0.003, 0.003, 0.2, 400.0]:
+        histogram.observe(seconds)
+    assert histogram.count == 5 and abs(histogram.sum - 400.20605) < 1e-9
+    assert histogram.quantile(0.2) == BUCKETS[0]
+    assert histogram.quantile(0.5) == 0.005
+    assert histogram.quantile(1.0) == float("inf")
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.timer("api"):
+        pass
+    metrics.inc("api_calls")
+    metrics.close()
+    assert metrics.histograms == {} and metrics.counters == {}
+
+def test_jsonl_snapshots(tmp_path, capsys):
+    path = str(tmp_path / "metrics.jsonl")
+    metrics = Metrics(path, interval=0.0)
+    with metrics.timer("api"): # every timer exports first when the interval is over
+        time.sleep(0.001)
+    with metrics.timer("parse"):
+        pass
+    metrics.inc("invalid")
+    metrics.inc("prompt_tokens", 120)
+    metrics.close()
+    with open(path) as f:
+        snapshots = [json.loads(line) for line in f]
+    assert len(snapshots) == 3
+    assert snapshots[0]["stages"] == {} and snapshots[1]["stages"]["api"]["count"] == 1
+    assert snapshots[-1]["counters"] == {"invalid": 1, "prompt_tokens": 120}
+    metrics.summary()
+    assert "api: 1 calls" in capsys.readouterr().out
+
+def test_prometheus_text(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    metrics = Metrics(path)
+    with metrics.timer("api"):
+        pass
+    metrics.inc("retries", 2)
+    metrics.close()
+    text = open(path).read()
+    assert "gpt_driver_retries_total 2" in text
+    assert 'gpt_driver_stage_seconds_count{stage="api"} 1' in text
+    assert 'gpt_driver_stage_seconds_bucket{stage="api",le="+Inf"} 1' in text
+
+def test_count_retry():
+    metrics = Metrics("unused.jsonl")
+    for error in [RuntimeError("boom"), types.SimpleNamespace(http_status=429)]:
+        outcome = types.SimpleNamespace(exception=lambda error=error: error)
+        count_retry(types.SimpleNamespace(kwargs={"metrics": metrics}, outcome=outcome))
+    count_retry(types.SimpleNamespace(kwargs={}, outcome=None)) # calls without metrics are ignored
+    assert metrics.counters == {"retries": 2, "rate_limited": 1}
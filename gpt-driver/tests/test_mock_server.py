@@ -0,0 +1,68 @@
+import asyncio
+import numpy as np
+from token_counter import TokenCounter
+from prompt_message import system_message, generate_user_messages, generate_assistant_messages
+from compact_encoding import decode_trajectory
+from completion_backend import OpenAIBackend, MockBackend, get_backend
+from mock_server import MockResponder, MockServer, start_server
+from async_inference import RateLimiter, build_requests, run_inference
+
+def prompt(user_message):
+    return [{"role": "system", "content": system_message}, {"role": "user", "content": user_message}]
+
+def test_responder_answers_the_ground_truth(data):
+    tokens = list(data)
+    responder = MockResponder(data, tokens)
+    for user_message, assistant_message in zip(generate_user_messages(data, tokens), generate_assistant_messages(data, tokens)):
+        assert responder.respond(prompt(user_message)) == assistant_message
+        objects_trimmed = "\n" + user_message[user_message.find("Ego-States:\n"):]
+        assert responder.respond(prompt(objects_trimmed)) == assistant_message
+
+def test_unknown_prompts_and_noise(data):
+    tokens = list(data)
+    responder = MockResponder(data, tokens[:1])
+    user_message = generate_user_messages(data, tokens[1:2])[0]
+    answer = responder.respond(prompt(user_message))
+    traj, _ = decode_trajectory(answer.split("\n")[-1], "text")
+    velocity = traj[0]
+    np.testing.assert_allclose(traj, np.arange(1, 7)[:, None] * velocity[None], atol=0.011) # constant velocity
+    noisy = MockResponder(data, tokens[:1], noise=1.0).respond(prompt(generate_user_messages(data, tokens[:1])[0]))
+    assert noisy.rsplit("\n", 1)[0] == generate_assistant_messages(data, tokens[:1])[0].rsplit("\n", 1)[0] # only the trajectory changes
+    assert noisy != generate_assistant_messages(data, tokens[:1])[0]
+
+def test_mock_backend_counts_tokens(data):
+    counter = TokenCounter("gpt-3.5-turbo")
+    tokens = list(data)
+    backend = get_backend("mock", data=data, tokens=tokens, counter=counter)
+    assert isinstance(backend, MockBackend)
+    messages = prompt(generate_user_messages(data, tokens[:1])[0])
+    completion = backend.complete("m", messages, n=2)
+    assert completion.choices == [completion.text] * 2
+    assert completion.prompt_tokens == counter.count(system_message) + counter.count(messages[1]["content"])
+    assert completion.completion_tokens == 2 * counter.count(completion.text)
+
+def test_runner_against_the_server(data, tmp_path):
+    counter = TokenCounter("gpt-3.5-turbo")
+    tokens = list(data)
+    requests = build_requests(data, tokens[40:], tokens[:40], counter)
+    server = MockServer(MockResponder(data, tokens[40:]), counter, latency=0.01, rpm=0, tpm=0)
+
+    async def main():
+        runner = await start_server(server, port=0)
+        port = runner.addresses[0][1]
+        try:
+            return await run_inference(requests, "gpt-3.5-turbo", RateLimiter(rpm=0, tpm=0),
+                backend=OpenAIBackend(f"http://localhost:{port}/v1", api_key="mock"))
+        finally:
+            await runner.cleanup()
+
+    text_dict, traj_dict, invalid_tokens, failed_tokens = asyncio.run(main())
+    assert list(traj_dict) == tokens[40:] and invalid_tokens == [] and failed_tokens == []
+    assert list(text_dict.values()) == generate_assistant_messages(data, tokens[40:])
+    assert server.num_requests == 20
+
+def test_rate_limits_and_errors(data):
+    server = MockServer(MockResponder(data, list(data)), TokenCounter("gpt-3.5-turbo"), rpm=2)
+    assert server._admit(10) and server._admit(10) and not server._admit(10)
+    server = MockServer(MockResponder(data, list(data)), TokenCounter("gpt-3.5-turbo"), tpm=100)
+    assert server._admit(60) and not server._admit(60) and server._admit(40)
@@ -0,0 +1,54 @@
+import os
+import pickle
+import numpy as np
+from nuscenes_cache import convert, NuScenesInfo, load_nuscenes_info
+from prompt_message import generate_user_messages, generate_assistant_messages
+
+def test_round_trip(tmp_path, data):
+    convert(data, str(tmp_path / "info"))
+    info = NuScenesInfo(str(tmp_path / "info"))
+    assert list(info) == list(data) and len(info) == len(data) and "tok00003" in info
+    for token, data_dict in data.items():
+        converted = info[token]
+        assert sorted(converted) == sorted(data_dict)
+        for key, value in data_dict.items():
+            if value.size > 0:
+                np.testing.assert_array_equal(converted[key], value)
+            else:
+                assert converted[key].shape[0] == 0
+    assert isinstance(info.columns["gt_boxes"], np.memmap)
+    tokens = list(data)
+    assert generate_user_messages(info, tokens) == generate_user_messages(data, tokens)
+    assert generate_assistant_messages(info, tokens) == generate_assistant_messages(data, tokens)
+
+def test_values_without_a_column_are_extras(tmp_path, data):
+    data = {token: data[token] for token in list(data)[:3]}
+    tokens = list(data)
+    data[tokens[0]] = {**data[tokens[0]], 'scene_token': "scene-1", 'sweeps': [{"ts": 1}]}
+    data[tokens[1]] = {**data[tokens[1]], 'gt_ego_fut_masks': np.ones(7)} # ragged but one-dimensional
+    convert(data, str(tmp_path / "info"))
+    info = NuScenesInfo(str(tmp_path / "info"))
+    assert info[tokens[0]]['sweeps'] == [{"ts": 1}] and info[tokens[0]]['scene_token'] == "scene-1"
+    assert 'sweeps' not in info[tokens[1]]
+    np.testing.assert_array_equal(info[tokens[1]]['gt_ego_fut_masks'], np.ones(7))
+
+def test_load_prefers_the_columns(tmp_path, data):
+    filename = str(tmp_path / "cached_nuscenes_info.pkl")
+    with open(filename, "wb") as f:
+        pickle.dump(data, f)
+    assert isinstance(load_nuscenes_info(filename), dict)
+    convert(data, str(tmp_path / "cached_nuscenes_info"), source=filename)
+    assert isinstance(load_nuscenes_info(filename), NuScenesInfo)
+
+def test_load_ignores_the_columns_of_another_pickle(tmp_path, data):
+    filename = str(tmp_path / "cached_nuscenes_info.pkl")
+    with open(filename, "wb") as f:
+        pickle.dump(data, f)
+    convert(data, str(tmp_path / "cached_nuscenes_info")) # no source to check against
+    assert isinstance(load_nuscenes_info(filename), dict)
+    convert(data, str(tmp_path / "cached_nuscenes_info"), source=filename)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9)) # the pickle was regenerated
+    assert isinstance(load_nuscenes_info(filename), dict)
+    os.remove(filename) # the columns alone are enough
+    assert isinstance(load_nuscenes_info(filename), NuScenesInfo)
@@ -0,0 +1,40 @@
+import numpy as np
+from conftest import make_data
+from prompt_message import generate_user_message, generate_user_messages, generate_assistant_message, generate_assistant_messages
+
+def test_user_messages_match_the_scalar_builder(data):
+    tokens = list(data)
+    for short in [True, False]:
+        expected = [generate_user_message(data, token, short=short) for token in tokens]
+        assert generate_user_messages(data, tokens, short=short, batch_size=7) == expected
+    expected = [generate_user_message(data, token, perception_range=10.0) for token in tokens]
+    assert generate_user_messages(data, tokens, perception_range=10.0) == expected
+
+def test_float32_info_matches_the_scalar_builder(data):
+    tokens = list(data)[:20]
+    for token in tokens:
+        data[token] = {key: value.astype(np.float32) if value.dtype == np.float64 else value for key, value in data[token].items()}
+    assert generate_user_messages(data, tokens) == [generate_user_message(data, token) for token in tokens]
+
+def test_objects_on_the_range_border_and_behind():
+    data = make_data(num_samples=1, max_objects=2)
+    data_dict = data["tok00000"]
+    data_dict['gt_boxes'] = np.array([[20.0, 5.0, 0, 2, 2, 1, 0, 0, 0], [1.0, -3.0, 0, 2, 2, 1, 0, 0, 0], [1.0, 0.0, 0, 2, 2, 1, 0, 0, 0]])
+    data_dict['gt_names'] = np.array(["car", "vehicle.bus", "pedestrian"])
+    data_dict['gt_agent_fut_trajs'] = np.zeros((3, 12))
+    data_dict['gt_agent_fut_masks'] = np.ones((3, 6))
+    message, = generate_user_messages(data, ["tok00000"])
+    assert message == generate_user_message(data, "tok00000")
+    # an object on the range border is kept, one at y = 0 counts as behind
+    assert "\n - car at (20.00,5.00)" in message and " - bus" not in message and " - pedestrian" not in message
+
+def test_empty_batches(data):
+    tokens = [token for token in data if data[token]['gt_boxes'].shape[0] == 0] + list(data)[:2]
+    assert generate_user_messages(data, tokens, batch_size=1) == [generate_user_message(data, token) for token in tokens]
+    assert generate_user_messages(data, []) == []
+
+def test_assistant_messages_match_the_scalar_builder(data):
+    tokens = list(data)
+    for traj_only in [True, False]:
+        expected = [generate_assistant_message(data, token, traj_only=traj_only) for token in tokens]
+        assert generate_assistant_messages(data, tokens, traj_only=traj_only, batch_size=16) == expected
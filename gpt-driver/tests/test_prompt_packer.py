@@ -0,0 +1,52 @@
+from token_counter import TokenCounter
+from prompt_message import system_message, generate_user_messages, generate_user_message_parts
+from prompt_packer import PromptPacker, budget_for_cost
+
+def crowded_token(data):
+    return max(data, key=lambda token: len(generate_user_message_parts(data, [token])[0]["objects"]))
+
+def test_everything_fits(data):
+    tokens = list(data)
+    packer = PromptPacker(TokenCounter("gpt-3.5-turbo"), budget=10 ** 6)
+    user_parts = generate_user_message_parts(data, tokens)
+    examples = ["example one\n" * 10, "example two\n" * 20]
+    for parts, counts, user_message in zip(user_parts, packer.count_user_parts(user_parts), generate_user_messages(data, tokens)):
+        system, user, num_system_tokens, num_user_tokens = packer.pack(parts, counts, examples, [30, 60])
+        assert system == system_message + "".join(examples) and user == user_message
+        assert num_system_tokens == packer.num_system_message_tokens + 90
+        assert num_user_tokens == sum(counts[0]) + counts[1]
+    assert packer.num_dropped_examples == packer.num_dropped_objects == packer.num_dropped_system == 0
+
+def test_examples_that_do_not_fit_are_skipped(data):
+    token = crowded_token(data)
+    packer = PromptPacker(TokenCounter("gpt-3.5-turbo"))
+    parts, = generate_user_message_parts(data, [token])
+    counts, = packer.count_user_parts([parts])
+    num_user_tokens = sum(counts[0]) + counts[1]
+    packer.budget = num_user_tokens + packer.num_system_message_tokens + 100
+    system, user, num_system_tokens, _ = packer.pack(parts, counts, ["a", "b", "c", "d"], [60, 80, 41, 1])
+    assert system == system_message + "a" + "d" # "b" and "c" would go over, "d" still fits
+    assert num_system_tokens == packer.num_system_message_tokens + 61 and packer.num_dropped_examples == 2
+
+def test_nearest_objects_are_kept_and_system_dropped(data):
+    token = crowded_token(data)
+    packer = PromptPacker(TokenCounter("gpt-3.5-turbo"))
+    parts, = generate_user_message_parts(data, [token])
+    counts, = packer.count_user_parts([parts])
+    object_counts, num_fixed_tokens = counts
+    nearest = sorted(range(len(object_counts)), key=lambda i: parts["distances"][i])[:3]
+    packer.budget = num_fixed_tokens + sum(object_counts[i] for i in nearest)
+    system, user, num_system_tokens, num_user_tokens = packer.pack(parts, counts, ["example"], [2])
+    assert system == "" and num_system_tokens == 0 and packer.num_dropped_system == 1
+    kept = [line for i, line in enumerate(parts["objects"]) if i in nearest] # in the order of the full message
+    assert user == parts["head"] + "".join(kept) + parts["tail"]
+    assert num_user_tokens <= packer.budget and packer.num_dropped_objects == len(object_counts) - 3
+
+def test_budget_for_cost():
+    assert budget_for_cost(0.0035, "gpt-3.5-turbo") == 2333
+    assert budget_for_cost(0.0035, "gpt-3.5-turbo", completion_tokens=1000) == 1000
+    assert budget_for_cost(0.012, "ft:gpt-3.5-turbo-0613:org::abc") == 1000
+    assert budget_for_cost(0.0035, "gpt-3.5-turbo", completion_tokens=2000) == 0
+    packer = PromptPacker(TokenCounter("gpt-3.5-turbo"), budget=4096, max_cost=0.0015)
+    assert packer.budget == 1000
+    assert PromptPacker(TokenCounter("gpt-3.5-turbo"), budget=500, max_cost=1.0).budget == 500
@@ -0,0 +1,62 @@
+import types
+import asyncio
+import contextlib
+import itertools
+import response_cache
+from response_cache import ResponseCache
+from completion_backend import Completion
+from async_inference import RateLimiter, run_inference
+
+MESSAGES = [{"role": "system", "content": "plan"}, {"role": "user", "content": "scene"}]
+
+class CountingBackend:
+    cache_params = {"backend": "counting"}
+
+    def __init__(self):
+        self.calls = 0
+
+    async def acomplete(self, model, messages, n=1, **params):
+        self.calls += 1
+        text = "Trajectory:\n[(0.00,1.00), (0.00,2.00), (0.00,3.00), (0.00,4.00), (0.00,5.00), (0.00,6.00)]"
+        return Completion(text, 10, 5, [text] * n)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        yield
+
+def test_get_and_put(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    assert cache.get("m", MESSAGES, temperature=0) is None
+    cache.put("m", MESSAGES, "answer", temperature=0)
+    assert cache.get("m", MESSAGES, temperature=0) == "answer"
+    assert cache.get("m", MESSAGES, temperature=1) is None # other parameters, other key
+    assert cache.get("other", MESSAGES, temperature=0) is None
+    assert (cache.num_hits, cache.num_misses) == (1, 3)
+    cache.close()
+    reopened = ResponseCache(str(tmp_path / "cache.db"))
+    assert reopened.get("m", MESSAGES, temperature=0) == "answer" and reopened.size == len("answer")
+    assert ResponseCache(str(tmp_path / "cache.db"), refresh=True).get("m", MESSAGES, temperature=0) is None
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(time=lambda: next(clock)))
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_size_mb=25 / 1024 / 1024)
+    for i in range(3):
+        cache.put("m", [{"role": "user", "content": str(i)}], "x" * 10)
+    assert len(cache) == 2 and cache.size == 20 # the first one made room
+    cache.get("m", [{"role": "user", "content": "1"}])
+    cache.put("m", [{"role": "user", "content": "3"}], "x" * 10)
+    assert cache.get("m", [{"role": "user", "content": "1"}]) == "x" * 10 # recently read, kept
+    assert cache.get("m", [{"role": "user", "content": "2"}]) is None
+    cache.put("m", [{"role": "user", "content": "1"}], "y" * 5) # replaced in place
+    assert cache.size == 15
+
+def test_rerun_is_served_from_the_cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    requests = [{"token": token, "messages": [{"role": "user", "content": token}], "num_tokens": 1,
+        "num_system_tokens": 0, "num_user_tokens": 1, "GT": ""} for token in ["a", "b"]]
+    backend = CountingBackend()
+    first = asyncio.run(run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), cache=cache, backend=backend))
+    second = asyncio.run(run_inference(requests, "m", RateLimiter(rpm=0, tpm=0), cache=cache, backend=backend))
+    assert backend.calls == 2 and cache.num_hits == 2
+    assert second[0] == first[0] and list(second[1]) == ["a", "b"]
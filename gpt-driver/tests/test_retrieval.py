@@ -0,0 +1,52 @@
+import os
+import pickle
+import numpy as np
+from retrieval import scene_features, RetrievalIndex, load_or_build_index, sequential_examples
+
+def test_query_is_exact(data):
+    tokens = list(data)
+    index = RetrievalIndex.build(data, tokens[:40])
+    features = scene_features(data, tokens[40:], batch_size=7)
+    assert features.shape == (20, 26)
+    np.testing.assert_array_equal(features, scene_features(data, tokens[40:]))
+    neighbors = index.query(features, k=5, batch_size=3)
+    vectors = index._normalize(features)
+    dists = ((vectors[:, None, :] - index.vectors[None, :, :]) ** 2).sum(axis=-1)
+    np.testing.assert_array_equal(neighbors, np.argsort(dists, axis=1, kind="stable")[:, :5])
+
+def test_train_tokens_retrieve_themselves(data):
+    tokens = list(data)[:40]
+    index = RetrievalIndex.build(data, tokens)
+    examples = index.query_tokens(data, tokens[:10], k=3)
+    assert all(examples[token][0] == token for token in tokens[:10])
+    assert len(index.query_tokens(data, tokens[:1], k=100)[tokens[0]]) == 40 # at most all train tokens
+
+def test_load_or_build_index(tmp_path, data):
+    tokens = list(data)
+    filename = str(tmp_path / "index.npz")
+    index = load_or_build_index(data, tokens[:40], filename)
+    assert os.path.exists(filename)
+    loaded = load_or_build_index(data, tokens[:40], filename)
+    assert loaded.tokens == index.tokens
+    np.testing.assert_array_equal(loaded.query(scene_features(data, tokens[40:])), index.query(scene_features(data, tokens[40:])))
+    assert load_or_build_index(data, tokens[:30], filename).tokens == tokens[:30] # rebuilt for another split
+
+def test_sequential_examples():
+    train_tokens = [f"t{i}" for i in range(12)]
+    assert sequential_examples(0, train_tokens) == ["t0", "t1", "t2", "t3", "t4"]
+    assert sequential_examples(2, train_tokens) == ["t10", "t11", "t0", "t1", "t2"]
+
+def test_index_is_rebuilt_for_other_info(workdir, data):
+    tokens = list(data)[:40]
+    filename = "data/incontext_index.npz"
+    index = load_or_build_index(data, tokens, filename)
+    assert RetrievalIndex.load(filename).key == index.key
+    assert load_or_build_index(data, tokens, filename).key == index.key
+    data[tokens[0]]["gt_ego_lcf_feat"] = data[tokens[0]]["gt_ego_lcf_feat"] + 1.0
+    with open("data/cached_nuscenes_info.pkl", "wb") as f: # the info was regenerated
+        pickle.dump(data, f)
+    stat = os.stat("data/cached_nuscenes_info.pkl")
+    os.utime("data/cached_nuscenes_info.pkl", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    rebuilt = load_or_build_index(data, tokens, filename)
+    assert rebuilt.key != index.key
+    np.testing.assert_array_equal(rebuilt.features[0], scene_features(data, tokens[:1])[0])
@@ -0,0 +1,62 @@
+import json
+import numpy as np
+import pytest
+from completion_backend import Completion
+from trajectory_parser import OK
+from self_consistency import medoid, aggregate, SelfConsistency
+
+def straight(dx, dy=2.0):
+    return np.stack([dx * np.arange(1, 7), dy * np.arange(1, 7)], axis=1)
+
+def text(traj):
+    return "Trajectory:\n[" + ", ".join(f"({x:.2f},{y:.2f})" for x, y in traj) + "]"
+
+def test_median_and_medoid():
+    trajs = np.stack([[straight(0.0), straight(0.1), straight(-0.1), straight(5.0)]])
+    valid = np.array([[True, True, True, True]])
+    plans, selected = aggregate(trajs, valid, "median")
+    np.testing.assert_allclose(plans[0], np.median(trajs[0], axis=0))
+    assert selected.tolist() == [0]
+    plans, selected = aggregate(trajs, valid, "medoid")
+    assert selected.tolist() == [0] and (plans[0] == straight(0.0)).all()
+    assert medoid(trajs, np.array([[False, False, True, True]])).tolist() == [2] # invalid samples never win
+
+def test_invalid_samples_are_ignored():
+    trajs = np.stack([[straight(0.0), np.full((6, 2), np.nan), straight(1.0)], [np.full((6, 2), np.nan)] * 3])
+    valid = np.array([[True, False, True], [False, False, False]])
+    for method in ["median", "medoid"]:
+        plans, selected = aggregate(trajs, valid, method)
+        assert valid[0, selected[0]] and np.isfinite(plans[0]).all()
+        assert np.isnan(plans[1]).all() # no valid sample
+    with pytest.raises(ValueError):
+        aggregate(trajs, valid, "mean")
+
+def test_collision_prefers_safe_samples():
+    data = {"a": {
+        'gt_boxes': np.array([[0.0, 6.0, 0, 2, 2, 1.5, 0, 0, 0]]), # in the way of the straight plans
+        'gt_agent_fut_trajs': np.zeros((1, 12)),
+        'gt_agent_fut_masks': np.ones((1, 6)),
+    }}
+    trajs = np.stack([[straight(0.0), straight(0.05), straight(2.0, 1.0)]])
+    valid = np.ones((1, 3), dtype=bool)
+    assert aggregate(trajs, valid, "medoid")[1].tolist() != [2]
+    assert aggregate(trajs, valid, "collision", data=data, tokens=["a"])[1].tolist() == [2]
+
+def test_select_samples():
+    sampler = SelfConsistency(num_samples=3, method="medoid", temperature=0.7)
+    assert sampler.params == {"n": 3, "temperature": 0.7}
+    answers = [text(straight(0.0)), "garbage", text(straight(0.1))]
+    result = sampler.encode(Completion(answers[0], 10, 5, answers))
+    assert json.loads(result) == answers
+    texts, trajs, reasons = sampler.select(["a", "b"], [result, json.dumps(["garbage", "nothing"])])
+    assert texts[0] in (answers[0], answers[2]) and reasons[0] == OK
+    assert trajs[1] is None and reasons[1] != OK and texts[1] == "garbage"
+
+def test_single_sample_is_parsed_as_is():
+    sampler = SelfConsistency()
+    assert sampler.params == {}
+    answer = text(straight(0.5))
+    assert sampler.encode(Completion(answer, 10, 5, [answer])) == answer
+    result_text, traj, reason = sampler.select_one("a", answer)
+    assert result_text == answer and reason == OK
+    np.testing.assert_allclose(traj, straight(0.5))
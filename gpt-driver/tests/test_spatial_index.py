@@ -0,0 +1,69 @@
+import os
+import json
+import numpy as np
+import spatial_index
+import dataset_builder
+from prompt_message import generate_user_messages
+from spatial_index import SpatialIndex, load_spatial_index
+
+def kept_objects(data_dict, perception_range=20.0):
+    """The objects that generate_user_message lists, by its own filters."""
+    boxes = data_dict['gt_boxes']
+    trajs = np.cumsum(data_dict['gt_agent_fut_trajs'].reshape(-1, 6, 2), axis=1) + boxes[:, None, :2]
+    kept = []
+    for i in range(len(boxes)):
+        if (trajs[i, :, 1] <= 0).all() and boxes[i, 1] <= 0:
+            continue
+        if (np.abs(trajs[i]) > perception_range).any() or (np.abs(boxes[i, :2]) > perception_range).any():
+            continue
+        kept.append(i)
+    return kept
+
+def test_select_matches_the_prompt_filters(data):
+    index = SpatialIndex(data, batch_size=16)
+    for token, data_dict in data.items():
+        selected = index.select(token)
+        assert sorted(selected.tolist()) == kept_objects(data_dict)
+        distances = np.linalg.norm(data_dict['gt_boxes'][selected, :2], axis=-1)
+        assert (np.diff(distances) >= 0).all() # nearest first
+        assert index.select(token, max_objects=3).tolist() == selected[:3].tolist()
+        assert sorted(index.select(token, perception_range=10.0).tolist()) == kept_objects(data_dict, 10.0)
+
+def test_save_and_load(tmp_path, data):
+    index = SpatialIndex(data)
+    index.key = "k"
+    index.save(str(tmp_path / "index"))
+    loaded = SpatialIndex.load(str(tmp_path / "index"))
+    assert loaded.key == "k" and loaded.tokens == index.tokens
+    assert not os.path.exists(tmp_path / "index" / "meta.json.tmp")
+    for token in data:
+        assert loaded.select(token, max_objects=5).tolist() == index.select(token, max_objects=5).tolist()
+
+def test_index_is_kept_next_to_the_info(workdir, data, monkeypatch):
+    built = []
+
+    class CountingIndex(SpatialIndex):
+        def __init__(self, *args, **kwargs):
+            built.append(args)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(spatial_index, "SpatialIndex", CountingIndex)
+    cache_dir = "data/cached_nuscenes_info_index_gt"
+    index = load_spatial_index(data)
+    assert os.path.exists(os.path.join(cache_dir, "meta.json")) and len(built) == 1
+    assert load_spatial_index(data).key == index.key and len(built) == 1 # loaded, not rebuilt
+
+    stat = os.stat("data/cached_nuscenes_info.pkl")
+    os.utime("data/cached_nuscenes_info.pkl", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9)) # the info changed
+    assert load_spatial_index(data).key != index.key and len(built) == 2
+    assert json.load(open(os.path.join(cache_dir, "meta.json")))["key"] == spatial_index.index_key()
+    assert load_spatial_index(data, perception_range=10.0).perception_range == 10.0 and len(built) == 3
+
+def test_dataset_builder_uses_the_saved_index(workdir, data):
+    tokens = list(data)[:20]
+    dataset_builder.build_dataset(tokens, "train.json", num_workers=1, max_objects=4)
+    assert os.path.exists("data/cached_nuscenes_info_index_gt/meta.json")
+    expected = generate_user_messages(data, tokens, index=SpatialIndex(data, tokens), max_objects=4)
+    with open("train.json") as f:
+        user_messages = [json.loads(line)["messages"][1]["content"] for line in f]
+    assert user_messages == expected
@@ -0,0 +1,30 @@
+import pytest
+from token_counter import TokenCounter, TokenUsage, estimate_cost
+
+def test_count_is_memoized():
+    counter = TokenCounter("gpt-3.5-turbo")
+    assert counter.count("a" * 40) == 10
+    assert counter.count("a" * 40) == 10
+    assert counter.count.cache_info().hits == 1
+
+def test_count_batch_matches_count():
+    counter = TokenCounter("gpt-3.5-turbo")
+    texts = ["", "abcd", "x" * 4001, "system message\n" * 7]
+    assert counter.count_batch(texts) == [counter.count(text) for text in texts]
+    assert counter.count_batch(iter(texts)) == counter.count_batch(texts)
+
+def test_estimate_cost():
+    assert estimate_cost("gpt-3.5-turbo", 1000, 1000) == pytest.approx(0.0035)
+    assert estimate_cost("ft:gpt-3.5-turbo-0613:org::abc", 1000) == pytest.approx(0.012)
+    assert estimate_cost("unknown-model", 1000) == estimate_cost("gpt-3.5-turbo", 1000)
+
+def test_token_usage(capsys):
+    usage = TokenUsage()
+    usage.add(system=10, user=20)
+    other = TokenUsage()
+    other.add(user=5, assistant=7)
+    usage.merge(other)
+    assert (usage.num_system_tokens, usage.num_user_tokens, usage.num_assistant_tokens) == (10, 25, 7)
+    assert usage.num_prompt_tokens == 35 and usage.num_total_tokens == 42
+    usage.summary("gpt-3.5-turbo")
+    assert "Number of total tokens: 42" in capsys.readouterr().out
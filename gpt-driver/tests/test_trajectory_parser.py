@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+from trajectory_parser import (
+    OK, EMPTY, NO_TRAJECTORY, WRONG_SHAPE, TRUNCATED,
+    parse_trajectory, parse_trajectories, parse_responses, to_traj_dict,
+)
+
+GPT_DRIVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_parse_prompt_format():
+    traj, reason = parse_trajectory("Thoughts:\n - None\nTrajectory:\n[(0.10,2.00), (0.20,4.10), (0.30,6.20), (0.40,8.30), (0.50,10.40), (0.60,12.50)]")
+    assert reason == OK
+    np.testing.assert_allclose(traj[:, 0], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+    np.testing.assert_allclose(traj[-1], [0.6, 12.5])
+
+def test_parse_number_forms_and_last_list():
+    text = "[(9,9), (9,9)] then [[1.5, 2.25], [3., 4], [.5, -6e1], [+1, 2], [3, 4], [5, 6]]"
+    traj, reason = parse_trajectory(text)
+    assert reason == OK
+    np.testing.assert_allclose(traj[:3], [[1.5, 2.25], [3.0, 4.0], [0.5, -60.0]])
+
+def test_parse_integer_waypoints():
+    traj, reason = parse_trajectory("[(1,20),(2,41),(3,62),(4,83),(5,104),(6,125)]")
+    assert reason == OK
+    np.testing.assert_allclose(traj[:, 1], [20, 41, 62, 83, 104, 125])
+
+def test_failure_reasons():
+    assert parse_trajectory("")[1] == EMPTY
+    assert parse_trajectory("no trajectory here")[1] == NO_TRAJECTORY
+    assert parse_trajectory("[(1,2), (3,4)]")[1] == WRONG_SHAPE
+    assert parse_trajectory("[(1,2), (3,4), (5,")[1] == TRUNCATED
+
+def test_parse_trajectories_bulk():
+    texts = ["[(1,2), (3,4), (5,6), (7,8), (9,10), (11,12)]", None, "[(1,2)]"]
+    trajs, reasons = parse_trajectories(texts)
+    assert reasons.tolist() == [OK, EMPTY, WRONG_SHAPE]
+    assert np.isnan(trajs[1:]).all()
+    np.testing.assert_allclose(trajs[0].reshape(-1), np.arange(1, 13))
+
+def test_parse_responses_later_record_wins(tmp_path):
+    name = tmp_path / "temp.jsonl"
+    with open(name, "w") as f:
+        f.write(json.dumps({"token": "a", "GPT": "[(0,1), (0,2), (0,3), (0,4), (0,5), (0,6)]"}) + "\n")
+        f.write(json.dumps({"token": "a", "GPT": "[(1,1), (1,2), (1,3), (1,4), (1,5), (1,6)]"}) + "\n")
+        f.write(json.dumps({"token": "b", "GPT": "garbage"}) + "\n")
+    traj_dict = to_traj_dict(*parse_responses(name))
+    assert list(traj_dict) == ["a"]
+    assert traj_dict["a"][0, 0] == 1
+
+def test_malformed_long_integers_parse_in_time():
+    # ambiguous number patterns backtrack exponentially on runs of digits, which a regex cannot be interrupted in
+    script = (
+        "from trajectory_parser import parse_trajectory, parse_trajectories\n"
+        "points = ['(' + '1234567' + ',' + '7654321' + ')'] * 7\n"
+        "texts = ['[' + ', '.join(points[:n]) for n in range(1, 8)]\n"
+        "texts += ['[' + ', '.join(points) + ']', '[' + ', '.join(['(12345,67890)'] * 5) + ']', '[' + ','.join(['(1234,5678)'] * 7) + ']']\n"
+        "texts += ['[' + ', '.join(points[:5]) + ', (1234567,']\n"
+        "for text in texts:\n"
+        "    parse_trajectory(text)\n"
+        "parse_trajectories(texts * 100)\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=GPT_DRIVER_DIR, check=True, timeout=20)
@@ -0,0 +1,61 @@
+import os
+import json
+import numpy as np
+from uniad_cache import convert_detections, build_cache, load_uniad_perceptions, PerceptionOverride
+
+def detection(name, box, start=(0.0, 0.0)):
+    return {"name": name, "box": box, "traj": [[start[0] + t, start[1] + 2 * t] for t in range(1, 13)]}
+
+def write_detections(name, records):
+    with open(name, "w") as f:
+        for token, detections in records:
+            f.write(json.dumps({"token": token, "detections": detections}) + "\n")
+
+def test_convert_detections():
+    boxes, names, trajs = convert_detections([detection("car", [1.0, 2.0, 0, 4, 2, 1.5, 0.1])])
+    assert boxes.shape == (1, 7) and names == ["car"]
+    np.testing.assert_allclose(trajs[0, 0], [0.0, -0.0]) # from the box center to (1, 2)
+    np.testing.assert_allclose(trajs[0, 1:], [[1.0, 2.0]] * 5)
+    boxes, names, trajs = convert_detections([], box_dim=7)
+    assert boxes.shape == (0, 7) and names == [] and trajs.shape == (0, 6, 2)
+
+def test_box_width_of_tokens_without_detections(tmp_path):
+    name = str(tmp_path / "detections.jsonl")
+    write_detections(name, [
+        ("empty_first", []),
+        ("one", [detection("car", [1.0, 2.0, 0, 4, 2, 1.5, 0.1], (1.0, 2.0))]),
+        ("empty", []),
+        ("two", [detection("pedestrian", [3.0, 4.0, 0, 1, 1, 1.8, 0.0], (3.0, 4.0)), detection("car", [5.0, 6.0, 0, 4, 2, 1.5, 0.2], (5.0, 6.0))]),
+    ])
+    build_cache(name, str(tmp_path / "detections"), chunk_size=2) # the first chunk starts with an empty token
+    perceptions = load_uniad_perceptions(name)
+    assert list(perceptions) == ["empty_first", "one", "empty", "two"]
+    assert perceptions["empty_first"]['gt_boxes'].shape == (0, 7)
+    assert perceptions["empty"]['gt_boxes'].shape == (0, 7)
+    boxes = np.concatenate([perceptions[token]['gt_boxes'] for token in perceptions])
+    np.testing.assert_allclose(boxes[:, :2], [[1, 2], [3, 4], [5, 6]])
+    assert perceptions["two"]['gt_names'].tolist() == ["pedestrian", "car"]
+    assert perceptions["two"]['gt_agent_fut_masks'].shape == (2, 6)
+
+def test_rebuilt_when_the_source_changes(tmp_path):
+    name = str(tmp_path / "detections.jsonl")
+    write_detections(name, [("a", [detection("car", [1.0, 2.0, 0, 4, 2, 1.5, 0.1, 0, 0])])])
+    assert len(load_uniad_perceptions(name)) == 1
+    write_detections(name, [("a", []), ("b", [])])
+    stat = os.stat(name)
+    os.utime(name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    perceptions = load_uniad_perceptions(name)
+    assert list(perceptions) == ["a", "b"]
+    assert perceptions["a"]['gt_boxes'].shape == (0, 9)
+
+def test_perception_override(tmp_path, data):
+    name = str(tmp_path / "detections.jsonl")
+    tokens = list(data)[:3]
+    write_detections(name, [(token, [detection("truck", [1.0, 2.0, 0, 4, 2, 1.5, 0.1, 0, 0])]) for token in tokens])
+    perceptions = load_uniad_perceptions(name)
+    gt_names = data[tokens[0]]['gt_names']
+    overridden = PerceptionOverride({token: data[token] for token in tokens}, perceptions)
+    d = overridden[tokens[0]]
+    assert d['gt_names'].tolist() == ["truck"]
+    assert d['gt_ego_fut_cmd'] is data[tokens[0]]['gt_ego_fut_cmd']
+    assert data[tokens[0]]['gt_names'] is gt_names # not mutated
@@ -0,0 +1,68 @@
+import functools
+import tiktoken
+
+# USD per 1K tokens as (prompt, completion) from the OpenAI price list at the time of writing, please check the pricing page
+PRICES = {
+    "fine-tune": (0.008, 0.008), # training tokens, billed per epoch
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "ft:gpt-3.5-turbo": (0.012, 0.016),
+}
+
+def model_prices(model):
+    """(prompt, completion) USD per 1K tokens of a model id, the gpt-3.5-turbo prices for unknown ids."""
+    if model.startswith("ft:"): # fine-tuned model ids look like ft:gpt-3.5-turbo-0613:org::id
+        model = "ft:gpt-3.5-turbo"
+    return PRICES.get(model, PRICES["gpt-3.5-turbo"])
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0):
+    prompt_price, completion_price = model_prices(model)
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+class TokenCounter:
+    """
+    tiktoken accounting for prompts.
+    Repeated strings (system messages, in-context examples) are memoized with an LRU cache,
+    variable strings (user and assistant messages) are encoded in batches.
+    """
+    def __init__(self, model="gpt-3.5-turbo", cache_size=4096, num_threads=8):
+        self.encoding = tiktoken.encoding_for_model(model)
+        self.num_threads = num_threads
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text):
+        return len(self.encoding.encode(text))
+
+    def count_batch(self, texts):
+        return [len(tokens) for tokens in self.encoding.encode_batch(list(texts), num_threads=self.num_threads)]
+
+class TokenUsage:
+    """Running system / user / assistant token totals with a cost estimate."""
+    def __init__(self):
+        self.num_system_tokens = 0
+        self.num_user_tokens = 0
+        self.num_assistant_tokens = 0
+
+    def add(self, system=0, user=0, assistant=0):
+        self.num_system_tokens += system
+        self.num_user_tokens += user
+        self.num_assistant_tokens += assistant
+
+    def merge(self, other):
+        self.add(other.num_system_tokens, other.num_user_tokens, other.num_assistant_tokens)
+
+    @property
+    def num_prompt_tokens(self):
+        return self.num_system_tokens + self.num_user_tokens
+
+    @property
+    def num_total_tokens(self):
+        return self.num_prompt_tokens + self.num_assistant_tokens
+
+    def summary(self, model="fine-tune"):
+        print("#### Cost Summarization ####")
+        print(f"Number of system tokens: {self.num_system_tokens}")
+        print(f"Number of user tokens: {self.num_user_tokens}")
+        print(f"Number of assistant tokens: {self.num_assistant_tokens}")
+        print(f"Number of total tokens: {self.num_total_tokens}")
+        print(f"Estimated cost ({model}): {estimate_cost(model, self.num_prompt_tokens, self.num_assistant_tokens):.2f} USD")
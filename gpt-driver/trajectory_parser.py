@@ -0,0 +1,115 @@
+import re
+import time
+import argparse
+import numpy as np
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+"""
+Trajectory extraction from the planner outputs.
+The planned trajectory is the last list of 6 (x, y) waypoints anywhere in the response,
+in the [(x1,y1), ..., (x6,y6)] format of the prompts or with [x, y] points.
+"""
+
+OK, EMPTY, NO_TRAJECTORY, WRONG_SHAPE, TRUNCATED = range(5)
+REASONS = ("ok", "empty", "no_trajectory", "wrong_shape", "truncated")
+
+NUMBER = r"[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?" # one way to match each number, against catastrophic backtracking
+POINT = r"[\(\[]\s*" + NUMBER + r"\s*,\s*" + NUMBER + r"\s*[\)\]]"
+TRAJECTORY_RE = re.compile(r"\[\s*" + POINT + r"(?:\s*,\s*" + POINT + r")*\s*,?\s*\]")
+OPEN_RE = re.compile(r"\[\s*[\(\[]\s*" + NUMBER) # the start of a point list
+CAPTURE_POINT = r"[\(\[]\s*(" + NUMBER + r")\s*,\s*(" + NUMBER + r")\s*[\)\]]"
+_waypoints_res = {}
+
+def _waypoints_re(num_waypoints):
+    """A list of exactly num_waypoints points, capturing the coordinates."""
+    if num_waypoints not in _waypoints_res:
+        _waypoints_res[num_waypoints] = re.compile(
+            r"\[\s*" + r"\s*,\s*".join([CAPTURE_POINT] * num_waypoints) + r"\s*,?\s*\]")
+    return _waypoints_res[num_waypoints]
+
+def _extract(text, num_waypoints=6):
+    """Returns (numbers, reason) with the 2 * num_waypoints coordinate strings of the trajectory if found."""
+    if not text or text.isspace():
+        return None, EMPTY
+    numbers = None
+    for match in _waypoints_re(num_waypoints).finditer(text):
+        numbers = match.groups()
+    if numbers is not None:
+        return numbers, OK
+    # the reason of the failure, only for the few failed responses
+    last_end = 0
+    for match in TRAJECTORY_RE.finditer(text):
+        last_end = match.end()
+    if OPEN_RE.search(text, last_end) is not None: # a list that was cut off, e.g. by max_tokens
+        return None, TRUNCATED
+    if last_end > 0:
+        return None, WRONG_SHAPE
+    return None, NO_TRAJECTORY
+
+def parse_trajectory(text, num_waypoints=6):
+    """Returns (traj, reason), traj is a [num_waypoints, 2] array or None when reason is not OK."""
+    numbers, reason = _extract(text, num_waypoints)
+    if reason != OK:
+        return None, reason
+    return np.array([float(number) for number in numbers]).reshape(num_waypoints, 2), reason
+
+def parse_trajectories(texts, num_waypoints=6):
+    """
+    Bulk parsing, returns (trajs [N, num_waypoints, 2] with NaN rows for failures, reasons [N] int8).
+    The coordinates of all responses are converted to floats in one call.
+    """
+    reasons = np.zeros(len(texts), dtype=np.int8)
+    all_numbers = []
+    for i, text in enumerate(texts):
+        numbers, reasons[i] = _extract(text, num_waypoints)
+        if numbers is not None:
+            all_numbers.extend(numbers)
+    trajs = np.full((len(texts), num_waypoints, 2), np.nan)
+    if len(all_numbers) > 0:
+        trajs[reasons == OK] = np.fromstring(" ".join(all_numbers), dtype=np.float64, sep=" ").reshape(-1, num_waypoints, 2)
+    return trajs, reasons
+
+def parse_responses(filename, key="GPT", num_waypoints=6):
+    """Parse a JSONL of {"token", key} records like outputs/*_temp.jsonl, returns (tokens, trajs, reasons)."""
+    tokens, texts = [], []
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = loads(line)
+            tokens.append(record["token"])
+            texts.append(record.get(key))
+    trajs, reasons = parse_trajectories(texts, num_waypoints)
+    return tokens, trajs, reasons
+
+def to_traj_dict(tokens, trajs, reasons):
+    """{token: [6, 2] array} of the valid trajectories, a later record of a token overrides an earlier one."""
+    traj_dict = {}
+    for token, traj, reason in zip(tokens, trajs, reasons.tolist()):
+        if reason == OK:
+            traj_dict[token] = traj
+    return traj_dict
+
+def summary(reasons):
+    print("#### Parsing Summary ####")
+    counts = np.bincount(reasons, minlength=len(REASONS))
+    for reason, count in zip(REASONS, counts.tolist()):
+        print(f"{reason}: {count}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse the trajectories of a JSONL of responses.")
+    parser.add_argument("-i", "--input", type=str, help="JSONL of responses, e.g. outputs/your_output_file_name_temp.jsonl")
+    parser.add_argument("-o", "--output", type=str, default=None, help="npz with tokens, trajs [N, 6, 2] and reasons")
+    parser.add_argument("-k", "--key", type=str, default="GPT", help="field of the response text")
+    args = parser.parse_args()
+
+    start = time.time()
+    tokens, trajs, reasons = parse_responses(args.input, key=args.key)
+    print(f"Parsed {len(tokens)} responses in {time.time() - start:.2f}s")
+    summary(reasons)
+    if args.output is not None:
+        np.savez(args.output, tokens=np.array(tokens), trajs=trajs, reasons=reasons)
@@ -0,0 +1,178 @@
+import os
+import json
+import argparse
+import numpy as np
+from collections.abc import Mapping
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+"""
+Binary per-token cache of UniAD detections (detection_motion_result_trainval.jsonl):
+    meta.json: tokens, box dimension, class name vocabulary and the size / mtime of the source file
+    offsets.npy: [T+1] object offsets of every token
+    boxes.bin: float64 [M, box_dim]
+    trajs.bin: float64 [M, 6, 2] diff movements, same as gt_agent_fut_trajs
+    names.bin: int16 [M] indices into the vocabulary
+"""
+
+def convert_detections(detections, box_dim=9):
+    """
+    Convert the detections of one token into (boxes [N, box_dim], names [N], rel_diff_trajs [N, 6, 2]),
+    box_dim is the width of the boxes of a token without detections.
+    """
+    names = [obj['name'] for obj in detections]
+    if len(detections) == 0:
+        return np.zeros((0, box_dim)), names, np.zeros((0, 6, 2))
+    boxes = np.array([obj['box'] for obj in detections], dtype=np.float64)
+    full_trajs = np.array([obj['traj'][:6] for obj in detections], dtype=np.float64) # [N, 6, 2]
+    rel_trajs = full_trajs - boxes[:, None, :2]
+    rel_trajs = np.concatenate([np.zeros((len(detections), 1, 2)), rel_trajs], axis=1) # [N, 7, 2]
+    rel_diff_trajs = rel_trajs[:, 1:] - rel_trajs[:, :-1] # [N, 6, 2]
+    return boxes, names, rel_diff_trajs
+
+def build_cache(filename, cache_dir, chunk_size=1024):
+    """Stream the JSONL once and append the converted detections chunk by chunk, memory is bounded by chunk_size tokens."""
+    os.makedirs(cache_dir, exist_ok=True)
+    tokens, counts, vocab = [], [], {}
+    box_dim = None
+    chunk = []
+
+    files = {key: open(os.path.join(cache_dir, key + ".bin"), "wb") for key in ("boxes", "trajs", "names")}
+
+    def flush():
+        if len(chunk) == 0:
+            return
+        # row bytes one token after the other, the tokens without detections before the first box do not know its width
+        files["boxes"].write(b"".join(boxes.tobytes() for boxes, _, _ in chunk))
+        files["trajs"].write(b"".join(trajs.tobytes() for _, _, trajs in chunk))
+        files["names"].write(b"".join(names.tobytes() for _, names, _ in chunk))
+        chunk.clear()
+
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            json_obj = loads(line)
+            boxes, names, trajs = convert_detections(json_obj['detections'], box_dim if box_dim is not None else 9)
+            if len(names) > 0:
+                if box_dim is None:
+                    box_dim = boxes.shape[1]
+                assert boxes.shape[1] == box_dim, f"Inconsistent box dimension for token {json_obj['token']}"
+            names = np.array([vocab.setdefault(name, len(vocab)) for name in names], dtype=np.int16)
+            tokens.append(json_obj['token'])
+            counts.append(len(names))
+            chunk.append((boxes, names, trajs))
+            if len(chunk) >= chunk_size:
+                flush()
+    flush()
+    for file in files.values():
+        file.close()
+
+    offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(np.array(counts, dtype=np.int64))])
+    np.save(os.path.join(cache_dir, "offsets.npy"), offsets)
+    stat = os.stat(filename)
+    meta = {
+        "tokens": tokens,
+        "box_dim": box_dim if box_dim is not None else 9,
+        "names": sorted(vocab, key=vocab.get),
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime,
+    }
+    # meta.json is written last, so an interrupted build is never mistaken for a complete cache
+    with open(os.path.join(cache_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+class UniADPerceptions(Mapping):
+    """
+    Memory-mapped UniAD perception cache.
+    perceptions[token] returns gt_boxes, gt_names, gt_agent_fut_trajs and gt_agent_fut_masks in the cached info format.
+    """
+    def __init__(self, cache_dir):
+        meta = json.load(open(os.path.join(cache_dir, "meta.json"), "r"))
+        self.meta = meta
+        self.tokens = meta["tokens"]
+        self.token_index = {token: i for i, token in enumerate(self.tokens)}
+        self.names = np.array(meta["names"]) if len(meta["names"]) > 0 else np.array([])
+        self.offsets = np.load(os.path.join(cache_dir, "offsets.npy")).tolist()
+        num_objects = self.offsets[-1]
+        self.boxes = self._open(cache_dir, "boxes", np.float64, (num_objects, meta["box_dim"]))
+        self.trajs = self._open(cache_dir, "trajs", np.float64, (num_objects, 6, 2))
+        self.name_ids = self._open(cache_dir, "names", np.int16, (num_objects,))
+
+    @staticmethod
+    def _open(cache_dir, key, dtype, shape):
+        if shape[0] == 0: # np.memmap cannot map an empty file
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(cache_dir, key + ".bin"), dtype=dtype, mode="r", shape=shape)
+
+    def __getitem__(self, token):
+        i = self.token_index[token]
+        start, end = self.offsets[i], self.offsets[i+1]
+        if start == end:
+            return {
+                'gt_boxes': np.zeros((0, self.meta["box_dim"])),
+                'gt_names': np.array([]),
+                'gt_agent_fut_trajs': np.zeros((0, 6, 2)), # [num_objs, 6, 2]
+                'gt_agent_fut_masks': np.ones((0, 6)), # [num_objs, 6]
+            }
+        return {
+            'gt_boxes': np.asarray(self.boxes[start:end]),
+            'gt_names': self.names[self.name_ids[start:end]],
+            'gt_agent_fut_trajs': np.asarray(self.trajs[start:end]), # [num_objs, 6, 2]
+            'gt_agent_fut_masks': np.ones((end - start, 6)), # [num_objs, 6]
+        }
+
+    def __contains__(self, token):
+        return token in self.token_index
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+class PerceptionOverride(Mapping):
+    """Cached info whose perception fields are replaced by another source, without mutating either of them."""
+    def __init__(self, data, perceptions):
+        self.data = data
+        self.perceptions = perceptions
+
+    def __getitem__(self, token):
+        data_dict = dict(self.data[token])
+        data_dict.update(self.perceptions[token])
+        return data_dict
+
+    def __contains__(self, token):
+        return token in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+def load_uniad_perceptions(filename='data/detection_motion_result_trainval.jsonl', chunk_size=1024):
+    """Open the binary cache next to `filename`, (re)building it first if it is missing or older than the JSONL."""
+    cache_dir = os.path.splitext(filename)[0]
+    meta_name = os.path.join(cache_dir, "meta.json")
+    if os.path.exists(meta_name):
+        meta = json.load(open(meta_name, "r"))
+        stat = os.stat(filename) if os.path.exists(filename) else None
+        if stat is None or (meta["source_size"] == stat.st_size and meta["source_mtime"] == stat.st_mtime):
+            return UniADPerceptions(cache_dir)
+    build_cache(filename, cache_dir, chunk_size=chunk_size)
+    return UniADPerceptions(cache_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the binary UniAD perception cache.")
+    parser.add_argument("-i", "--input", type=str, default="data/detection_motion_result_trainval.jsonl", help="UniAD detection JSONL")
+    parser.add_argument("--chunk_size", type=int, default=1024, help="number of tokens converted in memory at once")
+    args = parser.parse_args()
+
+    cache_dir = os.path.splitext(args.input)[0]
+    build_cache(args.input, cache_dir, chunk_size=args.chunk_size)
+    print(f"Cached {len(UniADPerceptions(cache_dir))} tokens to {cache_dir}")